@@ -675,6 +675,16 @@ class Complex( models.Model ):  # group of Structures, ie a cluster
 
     return foundation
 
+  @cinp.action( return_type={ 'type': 'Integer', 'is_array': True }, paramater_type_list=[ '_USER_', 'String' ] )
+  def doJobs( self, user, name ):
+    """
+    Submit a job to run the script name for each of the member Structures.  Either all the
+    jobs are created, or none are.
+    """
+    from contractor.Foreman.lib import createJobs
+    structure_list = self.members.all().select_related( 'site', 'blueprint', 'structurejob', 'foundation', 'foundation__foundationjob' ).order_by( 'pk' )
+    return createJobs( name, list( structure_list ), user )
+
   @cinp.list_filter( name='site', paramater_type_list=[ { 'type': 'Model', 'model': Site } ] )
   @staticmethod
   def filter_site( site ):
@@ -683,7 +693,7 @@ class Complex( models.Model ):  # group of Structures, ie a cluster
   @cinp.check_auth()
   @staticmethod
   def checkAuth( user, verb, id_list, action=None ):
-    return cinp.basic_auth_check( user, verb, action, Complex, { 'createFoundation': 'Building.can_create_foundation' } )
+    return cinp.basic_auth_check( user, verb, action, Complex, { 'createFoundation': 'Building.can_create_foundation', 'doJobs': 'Building.can_create_structure_job' } )
 
   def clean( self, *args, **kwargs ):
     super().clean( *args, **kwargs )
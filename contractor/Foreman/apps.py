@@ -0,0 +1,15 @@
+from django.apps import AppConfig, apps
+from django.db.models.signals import post_save
+
+
+class ForemanConfig( AppConfig ):
+  name = 'contractor.Foreman'
+
+  def ready( self ):
+    from contractor.Building.models import Foundation
+    from contractor.Foreman.models import _foundation_post_save
+
+    # the Foundation subclasses are their own senders, and are in other apps (the plugins), so they are all loaded by now
+    for model in apps.get_models():
+      if issubclass( model, Foundation ):
+        post_save.connect( _foundation_post_save, sender=model, dispatch_uid='foreman_foundation_post_save_{0}'.format( model._meta.label ) )
@@ -0,0 +1,245 @@
+import time
+import logging
+
+from django.db import connection
+
+from contractor.Site.models import Site
+from contractor.BluePrint.models import FoundationBluePrint, StructureBluePrint, Script, BluePrintScript
+from contractor.Building.models import Foundation, Structure
+from contractor.Foreman.models import BaseJob
+from contractor.Foreman import lib
+from contractor.Foreman.lib import createJob, processJobs, jobResults
+from contractor.tscript.runner import ExternalFunction
+
+# Foreman throughput benchmark, builds a site of Foundations and Structures whose create scripts call
+# benchmark.work() (a remote function), creates the jobs, and plays subcontractor, polling with processJobs and
+# handing the results back with jobResults until all the jobs are done.  This is everything but the HTTP/CInP
+# layer, run it against a database like the one in production, the numbers from sqlite are not going to mean much.
+# see lib/util/foremanBenchmark, for the tests, see Foreman/tests.py test_benchmark
+#
+# NOTE: this creates (and removes) real Sites/BluePrints/Foundations/Structures, don't run it against a production database
+
+
+class CLIUser():
+  username = 'benchmark'
+
+
+class Work( ExternalFunction ):
+  def __init__( self, *args, **kwargs ):
+    super().__init__( *args, **kwargs )
+    self.size = 0
+    self.result = None
+
+  @property
+  def done( self ):
+    return self.result is not None
+
+  @property
+  def message( self ):
+    if self.result is None:
+      return 'Working'
+
+    return 'Worked'
+
+  @property
+  def value( self ):
+    return self.result
+
+  def setup( self, parms ):
+    try:
+      self.size = int( parms.get( 'size', 0 ) )
+    except ValueError:
+      self.size = 0
+
+  def toSubcontractor( self ):
+    return ( 'work', { 'payload': 'x' * self.size } )
+
+  def fromSubcontractor( self, data ):
+    self.result = data.get( 'result', True )
+
+  def __getstate__( self ):
+    return ( self.size, self.result )
+
+  def __setstate__( self, state ):
+    ( self.size, self.result ) = state
+
+
+TSCRIPT_NAME = 'benchmark'
+
+TSCRIPT_FUNCTIONS = {
+                      'work': Work
+                    }
+
+TSCRIPT_VALUES = {}
+
+
+def _percentile( value_list, percent ):
+  if not value_list:
+    return 0.0
+
+  value_list = sorted( value_list )
+  return value_list[ min( len( value_list ) - 1, int( len( value_list ) * percent / 100.0 ) ) ]
+
+
+def _paramSize( param ):
+  if param is None:
+    return 0
+
+  if isinstance( param, ( bytes, bytearray, memoryview ) ):
+    return len( param )
+
+  if isinstance( param, ( list, tuple ) ):
+    return sum( _paramSize( i ) for i in param )
+
+  return len( str( param ) )
+
+
+class _DBCounter():
+  def __init__( self ):
+    super().__init__()
+    self.queries = 0
+    self.bytes_written = 0
+
+  def __call__( self, execute, sql, params, many, context ):
+    self.queries += 1
+    if sql.lstrip()[ 0:6 ].upper() in ( 'INSERT', 'UPDATE' ):
+      self.bytes_written += _paramSize( params )
+
+    return execute( sql, params, many, context )
+
+
+def buildSite( name, count, step_count=3, payload_size=100 ):
+  """
+  Build a site with count Foundations, each with a Structure, the Foundation and Structure BluePrint's create
+  scripts call benchmark.work() step_count times.
+  """
+  site = Site( name=name, description='Foreman Benchmark' )
+  site.full_clean()
+  site.save()
+
+  script = Script( name='{0}-create'.format( name ), description='Foreman Benchmark' )
+  script.script = '\n'.join( [ 'benchmark.work( size={0} )'.format( payload_size ) ] * step_count )
+  script.full_clean()
+  script.save()
+
+  foundation_blueprint = FoundationBluePrint( name='{0}-fdn'.format( name ), description='Foreman Benchmark' )
+  foundation_blueprint.foundation_type_list = [ 'Unknown' ]
+  foundation_blueprint.full_clean()
+  foundation_blueprint.save()
+
+  structure_blueprint = StructureBluePrint( name='{0}-str'.format( name ), description='Foreman Benchmark' )
+  structure_blueprint.full_clean()
+  structure_blueprint.save()
+  structure_blueprint.foundation_blueprint_list.add( foundation_blueprint )
+
+  for blueprint in ( foundation_blueprint, structure_blueprint ):
+    blueprint_script = BluePrintScript( blueprint=blueprint, script=script, name='create' )
+    blueprint_script.full_clean()
+    blueprint_script.save()
+
+  for i in range( 0, count ):
+    foundation = Foundation( site=site, blueprint=foundation_blueprint, locator='{0}-{1}'.format( name, i ) )
+    foundation.full_clean()
+    foundation.save()
+    foundation.setLocated()
+
+    structure = Structure( site=site, blueprint=structure_blueprint, foundation=foundation, hostname='{0}-{1}'.format( name, i ) )
+    structure.full_clean()
+    structure.save()
+
+  return site
+
+
+def removeSite( name ):
+  """
+  Remove what buildSite built.
+  """
+  BaseJob.objects.filter( site_id=name ).delete()
+  Structure.objects.filter( site_id=name ).delete()
+  Foundation.objects.filter( site_id=name ).delete()
+  Site.objects.filter( pk=name ).delete()
+  StructureBluePrint.objects.filter( pk='{0}-str'.format( name ) ).delete()
+  FoundationBluePrint.objects.filter( pk='{0}-fdn'.format( name ) ).delete()
+  Script.objects.filter( pk='{0}-create'.format( name ) ).delete()
+
+
+def runBenchmark( count=100, step_count=3, max_jobs=50, payload_size=100, name='foreman-benchmark', keep=False ):
+  """
+  Build the site, create a job for each Foundation and Structure, and run them to completion.  Returns a dict of:
+    jobs: number of jobs run
+    tasks: number of tasks handed to the fake subcontractor
+    polls: number of processJobs calls
+    seconds: wall time from the first createJob to the last job done
+    jobs_per_second: jobs / seconds
+    poll_p50, poll_p99: processJobs latency in seconds
+    queries_per_job: DB queries for creating, running and finishing the jobs, divided by jobs
+    bytes_per_job: size of the paramaters of the INSERT and UPDATE queries, divided by jobs
+  """
+  if Site.objects.filter( pk=name ).exists():
+    raise ValueError( 'Site "{0}" allready exists, remove it first'.format( name ) )
+
+  site = buildSite( name, count, step_count, payload_size )
+  module_added = False
+  if __name__ not in lib.RUNNER_MODULE_LIST:
+    lib.RUNNER_MODULE_LIST.append( __name__ )
+    module_added = True
+
+  try:
+    counter = _DBCounter()
+    poll_list = []
+    task_count = 0
+    with connection.execute_wrapper( counter ):
+      start = time.perf_counter()
+      for foundation in Foundation.objects.filter( site=site ):
+        createJob( 'create', foundation, CLIUser() )
+
+      for structure in Structure.objects.filter( site=site ).select_related( 'foundation' ):
+        createJob( 'create', structure, CLIUser() )
+
+      job_count = BaseJob.objects.filter( site=site ).count()
+      idle = 0
+      while True:
+        poll_start = time.perf_counter()
+        task_list = processJobs( site, [ TSCRIPT_NAME ], max_jobs )
+        poll_list.append( time.perf_counter() - poll_start )
+
+        for task in task_list:  # the fake subcontractor
+          jobResults( task[ 'job_id' ], task[ 'cookie' ], { 'result': True } )
+
+        task_count += len( task_list )
+        if task_list:
+          idle = 0
+          continue
+
+        if not BaseJob.objects.filter( site=site ).exists():
+          break
+
+        idle += 1
+        if idle > 5:
+          state_list = list( BaseJob.objects.filter( site=site ).values_list( 'pk', 'state', 'message' )[ 0:5 ] )
+          raise Exception( 'Jobs are not progressing, first few: {0}'.format( state_list ) )
+
+      seconds = time.perf_counter() - start
+
+  finally:
+    if module_added:
+      lib.RUNNER_MODULE_LIST.remove( __name__ )
+
+    if not keep:
+      removeSite( name )
+
+  result = {
+             'jobs': job_count,
+             'tasks': task_count,
+             'polls': len( poll_list ),
+             'seconds': seconds,
+             'jobs_per_second': job_count / seconds if seconds else 0.0,
+             'poll_p50': _percentile( poll_list, 50 ),
+             'poll_p99': _percentile( poll_list, 99 ),
+             'queries_per_job': counter.queries / job_count if job_count else 0.0,
+             'bytes_per_job': counter.bytes_written / job_count if job_count else 0.0
+           }
+
+  logging.info( 'Foreman Benchmark: {0}'.format( result ) )
+
+  return result
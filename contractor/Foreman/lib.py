@@ -1,17 +1,50 @@
-import pickle
-from django.core.exceptions import ObjectDoesNotExist
-
+import time
+import zlib
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import models, transaction, connection, DataError, IntegrityError
+from django.db.models import Q, F, Value, Window, Count, Sum, ExpressionWrapper, ProtectedError
+from django.db.models.functions import Coalesce, RowNumber, TruncDate
+from django.utils import timezone
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+
+from contractor.Site.models import Site
 from contractor.Building.models import Foundation, Structure, Dependency
+from contractor.BluePrint.models import BluePrint
 from contractor.Foreman.runner_plugins.building import ConfigPlugin, FoundationPlugin, ROFoundationPlugin, StructurePlugin, ROStructurePlugin, SignalingPlugin
-from contractor.Foreman.models import BaseJob, FoundationJob, StructureJob, DependencyJob, JobLog, ForemanException
+from contractor.Foreman.models import BaseJob, FoundationJob, StructureJob, DependencyJob, JobLog, JobLogRollup, ParsedScript, LocateRequest, PreparedTask, ScriptProfile, ForemanException, JOB_PRIORITY_DEFAULT, JOB_PRIORITY_MIN, JOB_PRIORITY_MAX
+from contractor.Foreman.notifier import notifyWork, flushWork, workGeneration, waitForWork, tasksKey
+from contractor.Foreman.planner import planStart
+from contractor.Foreman.stats import foreman_stats
 from contractor.PostOffice.lib import registerEvent
 
-from contractor.tscript.parser import parse
-from contractor.tscript.runner import Runner, Pause, ExecutionError, UnrecoverableError, ParamaterError, NotDefinedError, ScriptError
+from contractor.tscript.parser import parse, scriptHash
+from contractor.tscript.runner import Runner, Profile, Pause, ExecutionError, Timeout, UnrecoverableError, ParamaterError, NotDefinedError, ScriptError
 
 
 RUNNER_MODULE_LIST = []
 
+RUNNER_TTL = 1000  # number of operations a job's script gets each time it is run
+FAIR_SCAN_FACTOR = 5  # _claimJobs picks the fair batch of jobs from up to count * FAIR_SCAN_FACTOR of the oldest queued jobs
+JOB_LEASE_TIME = timedelta( minutes=5 )  # how long a poller has to run the jobs it has claimed before other pollers can claim them
+AUTO_LOCATE_SWEEP_INTERVAL = 300  # in seconds, how often _autoLocate checks all the unlocated foundations, even if nothing has requested it
+MAX_WAIT_SECONDS = 60  # longest processJobs will wait for work
+MIN_WAIT_SECONDS = 1  # shortest wait when a sleeping job is due, so a due job that is leased by another poller does not make the wait spin
+MAX_PAGE_JOBS = 500  # largest page processJobsPage will return
+PAGE_CURSOR_MAX_AGE = 300  # in seconds, after this a processJobsPage cursor is ignored and a new poll is started
+WORKER_MAX_JOBS = 100  # number of tasks prepareTasks prepares before returning
+
+_auto_locate_sweep_map = {}  # site -> time.monotonic() of the last _autoLocate sweep
+
+# the job types and what to select_related for them when loading jobs in bulk, these should cover what the job's can_start and done use
+JOB_RELATED_MAP = (
+                    ( FoundationJob, ( 'site', 'foundation' ) ),
+                    ( StructureJob, ( 'site', 'structure', 'structure__foundation' ) ),
+                    ( DependencyJob, ( 'site', 'dependency', 'dependency__structure', 'dependency__dependency', 'dependency__foundation', 'dependency__script_structure' ) )
+                  )
+
 #  Job Can Create Matrix
 #                                    Associated Asset
 #                   | Structure | Structure | Structure | Foundation | Foundation | Foundation | Foundation | Dependency | Dependency | Dependency |
@@ -52,10 +85,7 @@ def _target_class( target ):
     raise ForemanException( 'INVALID_TARGET', 'target must be a Structure, Foundation, or Dependency' )
 
 
-def createJob( script_name, target, creator ):
-  if not creator:
-    raise ForemanException( 'INVALID_CREATOR', 'creator is blank' )
-
+def _checkCreateJob( script_name, target ):
   target_class = _target_class( target )
 
   if isinstance( target, Dependency ) and script_name not in ( 'create', 'destroy' ):
@@ -110,8 +140,19 @@ def createJob( script_name, target, creator ):
     if target.state != 'built':
       raise ForemanException( 'NOT_BUILT', 'target not built' )
 
-  blueprint = target.blueprint
 
+def _getScript( blueprint, script_name ):
+  script = blueprint.get_script( script_name )
+  if script is None:
+    script = '# empty place holder'
+
+  return script
+
+
+def _newJob( script_name, target, priority ):
+  """
+  Returns a new, unsaved, job for target, and the list of objects to register with it's runner.
+  """
   obj_list = []
   if isinstance( target, Structure ):
     job = StructureJob()
@@ -151,11 +192,18 @@ def createJob( script_name, target, creator ):
 
   job.site = target.site
 
-  script = blueprint.get_script( script_name )
-  if script is None:
-    script = '# empty place holder'
+  job.state = 'waiting'
+  job.script_name = script_name
+  job.priority = priority
+
+  return ( job, obj_list )
+
+
+def _newRunner( ast, obj_list ):
+  runner = Runner( ast )
+  if getattr( settings, 'TSCRIPT_PROFILE', False ):
+    runner.profile = Profile()
 
-  runner = Runner( parse( script ) )
   for module in RUNNER_MODULE_LIST:
     runner.registerModule( module )
 
@@ -165,34 +213,335 @@ def createJob( script_name, target, creator ):
   for obj in obj_list:
     runner.registerObject( obj )
 
-  job.state = 'waiting'
-  job.script_name = script_name
-  job.script_runner = pickle.dumps( runner )
+  return runner
+
+
+def _checkCreator( creator, priority ):
+  if not creator:
+    raise ForemanException( 'INVALID_CREATOR', 'creator is blank' )
+
+  if priority < JOB_PRIORITY_MIN or priority > JOB_PRIORITY_MAX:
+    raise ForemanException( 'INVALID_PRIORITY', 'priority must be from {0} to {1}'.format( JOB_PRIORITY_MIN, JOB_PRIORITY_MAX ) )
+
+
+def createJob( script_name, target, creator, priority=JOB_PRIORITY_DEFAULT ):
+  _checkCreator( creator, priority )
+  _checkCreateJob( script_name, target )
+
+  ( job, obj_list ) = _newJob( script_name, target, priority )
+
+  script = _getScript( target.blueprint, script_name )
+  ast = parse( script )
+  runner = _newRunner( ast, obj_list )
+
+  job.parsed_script = ParsedScript.fromAST( ast, script )
+  job.storeRunner( runner )
   job.full_clean()
   job.save()
 
-  runner = pickle.loads( job.script_runner )
+  runner = job.loadRunner()
   runner.registerObject( SignalingPlugin( target, job ) )  # this is special it needs the pk, which is after the save
-  job.script_runner = pickle.dumps( runner )
+  job.storeRunner( runner )
   job.full_clean()
   job.save()
 
   JobLog.fromJob( job, creator )
+  notifyWork( job.site_id )
 
   return job.pk
 
 
-def processJobs( site, module_list, max_jobs=10 ):
-  if max_jobs > 100:
-    max_jobs = 100
+def createJobs( script_name, target_list, creator, priority=JOB_PRIORITY_DEFAULT ):
+  """
+  Create a job running script_name for each target in target_list, all or none of the jobs are created.  All the
+  targets are checked before anything is created, each distinct script is parsed once, and the jobs and their
+  JobLogs are inserted in bulk.  Returns the list of job ids, in the same order as target_list.
+  """
+  _checkCreator( creator, priority )
+
+  seen = set()
+  for target in target_list:
+    key = ( _target_class( target ), target.pk )
+    if key in seen:
+      raise ForemanException( 'DUPLICATE_TARGET', 'target "{0}" is in the list more than once'.format( target ) )
+    seen.add( key )
+
+    try:
+      _checkCreateJob( script_name, target )
+    except ForemanException as e:
+      raise ForemanException( e.code, '{0}: {1}'.format( target, e.message ) )
+
+  if not target_list:
+    return []
+
+  script_map = {}  # blueprint -> ( ast, parsed_script )
+  entry_list = []
+  for target in target_list:
+    ( job, obj_list ) = _newJob( script_name, target, priority )
+    blueprint = target.blueprint
+    try:
+      ( ast, parsed_script ) = script_map[ blueprint.pk ]
+    except KeyError:
+      script = _getScript( blueprint, script_name )
+      ast = parse( script )  # blueprints that share the script will get the same ast from parse's cache
+      parsed_script = ParsedScript.fromAST( ast, script )
+      script_map[ blueprint.pk ] = ( ast, parsed_script )
+
+    job.parsed_script = parsed_script
+    job.script_runner = b''  # stored after the insert, the SignalingPlugin needs the pk
+    job.full_clean( exclude=[ 'site', 'parsed_script', 'foundation', 'structure', 'dependency' ], validate_unique=False )  # the related objects are in hand, and _checkCreateJob has allready made sure there is not an existing job, skip the lookups
+    entry_list.append( ( job, target, _newRunner( ast, obj_list ) ) )
+
+  with transaction.atomic():
+    job_list = [ entry[0] for entry in entry_list ]
+    _bulkCreateJobs( job_list )
+
+    for job, target, runner in entry_list:
+      runner.registerObject( SignalingPlugin( target, job ) )
+      job.storeRunner( runner )
+
+    BaseJob.objects.bulk_update( job_list, [ 'script_runner' ] )
+
+    log_list = [ JobLog.newFromJob( job, creator ) for job in job_list ]
+    for log in log_list:
+      log.full_clean( exclude=[ 'site' ] )
+
+    JobLog.objects.bulk_create( log_list )
+
+  for site_id in set( job.site_id for job in job_list ):
+    notifyWork( site_id )
+
+  return [ job.pk for job in job_list ]
+
+
+def _bulkCreateJobs( job_list ):
+  """
+  bulk_create dosen't do multi-table inheritance, so insert the BaseJob rows with bulk_create, then the
+  job type rows directly.  Sets the pk on the jobs in job_list.
+  """
+  parent_field_list = [ field for field in BaseJob._meta.concrete_fields if not field.primary_key ]
+  parent_list = [ BaseJob( **dict( ( field.attname, getattr( job, field.attname ) ) for field in parent_field_list ) ) for job in job_list ]
+  BaseJob.objects.bulk_create( parent_list )
+
+  for job, parent in zip( job_list, parent_list ):
+    job.id = parent.pk
+    job.basejob_ptr_id = parent.pk
+    job.created = parent.created
+    job.updated = parent.updated
+    job._state.adding = False
+
+  class_map = {}
+  for job in job_list:
+    class_map.setdefault( job.__class__, [] ).append( job )
+
+  with connection.cursor() as cursor:
+    for job_class, class_job_list in class_map.items():
+      field_list = job_class._meta.local_concrete_fields
+      column_list = [ connection.ops.quote_name( field.column ) for field in field_list ]
+      sql = 'INSERT INTO {0} ( {1} ) VALUES ( {2} )'.format( connection.ops.quote_name( job_class._meta.db_table ), ', '.join( column_list ), ', '.join( [ '%s' ] * len( field_list ) ) )
+      cursor.executemany( sql, [ [ field.get_db_prep_save( getattr( job, field.attname ), connection ) for field in field_list ] for job in class_job_list ] )
+
+
+def _realJobs( job_id_list ):
+  """
+  Returns the job_id_list jobs as their job type (ie: what job.realJob would return), in the same order
+  as job_id_list.  The jobs and their targets are loaded with one query per job type.
+  """
+  if not job_id_list:
+    return []
+
+  job_map = {}
+  for job_class, related_list in JOB_RELATED_MAP:
+    for job in job_class.objects.filter( pk__in=job_id_list ).select_related( *related_list ):
+      job_map[ job.pk ] = job
+
+  missing_list = [ i for i in job_id_list if i not in job_map ]
+  if missing_list:
+    for job in BaseJob.objects.filter( pk__in=missing_list ).select_related( 'site' ):
+      job_map[ job.pk ] = job
+
+  return [ job_map[ i ] for i in job_id_list ]
+
+
+def _commit():
+  # Dispatch.getJobs is called with autocommit off (cinp's transaction), commit as we go so the locks
+  # and leases are visible to other pollers, if we are inside an atomic block, the caller is in charge of the commits
+  connection = transaction.get_connection()
+  if not connection.get_autocommit() and not connection.in_atomic_block:
+    transaction.commit()
+    flushWork()
+
+
+def _lockJobs( site_list, state ):
+  """
+  Lock and return the jobs in the sites in site_list with state, skipping the jobs locked by other pollers, the job rows are
+  locked first, then loaded with _realJobs
+  """
+  queryset = BaseJob.objects.select_for_update( skip_locked=True ).filter( site__in=site_list, state=state )
+
+  return _realJobs( list( queryset.values_list( 'pk', flat=True ) ) )
+
+
+def _claimableJobs( site_list, now ):
+  queryset = BaseJob.objects.filter( site__in=site_list, state='queued' )
+  queryset = queryset.filter( Q( waiting_on='', wake_at__isnull=True ) | Q( wake_at__lte=now ) )  # only the jobs that may be able to get somewhere, see Runner.wakeHint
+  return queryset.filter( Q( lease_expires__isnull=True ) | Q( lease_expires__lt=now ) )
+
+
+def _fairOrder( candidate_list, count ):
+  """
+  candidate_list is a list of ( job_id, priority, group ), oldest first.  Returns up to count of the job_ids,
+  highest priority first, and within a priority one job from each group in turn, so a large group (ie: a big
+  batch of create jobs for one blueprint) can not starve the other groups.
+  """
+  priority_map = {}  # priority -> { group: [ job_id, ... ] }, the groups stay in the order of their oldest job
+  for job_id, priority, group in candidate_list:
+    priority_map.setdefault( priority, {} ).setdefault( group, [] ).append( job_id )
+
+  result = []
+  for priority in sorted( priority_map.keys(), reverse=True ):
+    group_list = list( priority_map[ priority ].values() )
+    while group_list:
+      for group in group_list:
+        if len( result ) >= count:
+          return result
+
+        result.append( group.pop( 0 ) )
+
+      group_list = [ group for group in group_list if group ]
+
+  return result
+
+
+def _fairShare( site_candidate_map, count ):
+  """
+  site_candidate_map is site_id -> candidate_list (see _fairOrder).  Returns up to count of the job_ids, one
+  from each site in turn, so each site gets an equal share of count, the share a site does not need goes to the
+  other sites.  Within a site the jobs are in _fairOrder.
+  """
+  order_list = [ _fairOrder( site_candidate_map[ site_id ], count ) for site_id in sorted( site_candidate_map.keys() ) ]
+
+  result = []
+  while order_list:
+    for order in order_list:
+      if len( result ) >= count:
+        return result
+
+      result.append( order.pop( 0 ) )
+
+    order_list = [ order for order in order_list if order ]
+
+  return result
+
+
+def _afterKey( queryset, key ):
+  """
+  Returns the jobs of queryset that come after key, a ( priority, job_id ), in the highest priority, then lowest
+  job id order.  An empty key is before all the jobs.
+  """
+  if not key:
+    return queryset
+
+  ( priority, job_id ) = key
+  return queryset.filter( Q( priority__lt=priority ) | Q( priority=priority, pk__gt=job_id ) )
+
+
+def _claimJobs( site_list, count, skip_list, after=None ):
+  """
+  Lease up to count queued jobs from the sites in site_list, skipping the jobs that are locked or leased by other
+  pollers and the jobs in skip_list.  The jobs are picked by _fairShare from the oldest count * FAIR_SCAN_FACTOR
+  jobs of each site, grouped by blueprint and script name.  If after is not None, the jobs are instead the next
+  count jobs after the key after (see _afterKey), in that order, for processJobsPage's cursor.  The lease is
+  committed before returning so other pollers will pass these jobs by.
+  """
+  now = timezone.now()
+  skip_list = list( skip_list )
+  while True:
+    queryset = _claimableJobs( site_list, now ).exclude( pk__in=skip_list )
+    if after is not None:
+      job_id_list = list( _afterKey( queryset, after ).order_by( '-priority', 'pk' ).values_list( 'pk', flat=True )[ :count ] )
+
+    else:
+      queryset = queryset.annotate( blueprint=Coalesce( 'foundationjob__foundation__blueprint', 'structurejob__structure__blueprint', Value( '' ), output_field=models.CharField() ) )
+      queryset = queryset.annotate( site_rank=Window( RowNumber(), partition_by=F( 'site' ), order_by=( F( 'priority' ).desc(), F( 'updated' ).asc() ) ) )
+      queryset = queryset.filter( site_rank__lte=count * FAIR_SCAN_FACTOR )
+      queryset = queryset.order_by( '-priority', 'updated' ).values_list( 'pk', 'site_id', 'priority', 'blueprint', 'script_name' )
+      site_candidate_map = {}
+      for job_id, site_id, priority, blueprint, script_name in queryset:
+        site_candidate_map.setdefault( site_id, [] ).append( ( job_id, priority, ( blueprint, script_name ) ) )
+
+      job_id_list = _fairShare( site_candidate_map, count )
+
+    if not job_id_list:
+      return []
+
+    # only the picked jobs are locked, and checked again, another poller may of gotten to some of them first
+    locked_list = set( _claimableJobs( site_list, now ).select_for_update( skip_locked=True ).filter( pk__in=job_id_list ).values_list( 'pk', flat=True ) )
+    if locked_list:
+      break
+
+    skip_list += job_id_list
+
+  job_id_list = [ i for i in job_id_list if i in locked_list ]
+  BaseJob.objects.filter( pk__in=job_id_list ).update( lease_expires=now + JOB_LEASE_TIME )
+  job_list = _realJobs( job_id_list )
+  _commit()
+
+  return job_list
+
+
+def _relockJob( job ):
+  """
+  Lock a claimed job, while it is run, anything else that wants to change the job (jobResults, signalComplete, etc) will wait.
+  Returns the job, reloaded if it was changed since it was claimed, or None if it is no longer queued.
+  """
+  try:
+    ( state, updated ) = BaseJob.objects.select_for_update().filter( pk=job.pk ).values_list( 'state', 'updated' ).get()
+  except BaseJob.DoesNotExist:
+    return None
+
+  if state != 'queued':
+    BaseJob.objects.filter( pk=job.pk ).update( lease_expires=None )
+    return None
+
+  if updated != job.updated:
+    job = _realJobs( [ job.pk ] )[0]
+
+  job.lease_expires = None
+  return job
+
+
+def _autoLocate( site_list ):
+  """
+  Locate the unlocated Foundations of the sites in site_list that are in a built Complex.  This only looks at the
+  Foundations of a site when something has requested it (see LocateRequest), or every AUTO_LOCATE_SWEEP_INTERVAL
+  in case something was missed.
+  """
+  now = time.monotonic()
+  site_id_set = LocateRequest.takeList( [ site.pk for site in site_list ] )
+  site_id_set |= set( site.pk for site in site_list if now - _auto_locate_sweep_map.get( site.pk, -AUTO_LOCATE_SWEEP_INTERVAL ) >= AUTO_LOCATE_SWEEP_INTERVAL )
+  if not site_id_set:
+    return
+
+  for site_id in site_id_set:
+    _auto_locate_sweep_map[ site_id ] = now
 
   # how to know if something can just be located, for now, if it has a complex and the complex is up and running
   # then we can auto locate.  The question is, should we go back to the foundation haveing a can_auto_locate
   # flag again, do we need that kind of detail?
-  for foundation in Foundation.objects.filter( site=site, located_at__isnull=True, built_at__isnull=True ):
+  complex_state_map = {}
+  for foundation in Foundation.objects.filter( site__in=site_id_set, located_at__isnull=True, built_at__isnull=True ):
     foundation = foundation.subclass
     complex = foundation.complex
-    if complex is not None and complex.state == 'built':
+    if complex is None:
+      continue
+
+    try:
+      complex_state = complex_state_map[ complex.pk ]
+    except KeyError:
+      complex_state = complex_state_map[ complex.pk ] = complex.state
+
+    if complex_state == 'built':
       try:
         job = foundation.foundationjob
       except ObjectDoesNotExist:
@@ -201,19 +550,38 @@ def processJobs( site, module_list, max_jobs=10 ):
       if foundation._canSetState( job ):
         foundation.setLocated()
 
-  # start waiting jobs
-  for job in BaseJob.objects.select_for_update().filter( site=site, state='waiting' ):
-    job = job.realJob
-    if job.can_start:
+
+def _startWaitingJobs( site_list ):
+  job_list = _lockJobs( site_list, 'waiting' )
+  plan_map = planStart( job_list )
+  message_list = []
+  started_list = []
+  for job in job_list:
+    foreman_stats.add( 'waiting_examined' )
+    reason = plan_map[ job.pk ]
+    if reason is None:
+      foreman_stats.add( 'waiting_started' )
       job.state = 'queued'
+      job.message = ''
       job.full_clean()
       job.save()
 
-      JobLog.started( job )
+      started_list.append( job.pk )
+
+    elif job.message != reason:  # let the user know what it is waiting for
+      job.message = reason[ 0:1024 ]
+      message_list.append( job )
+
+  if message_list:
+    BaseJob.objects.bulk_update( message_list, [ 'message' ] )
 
-  # clean up completed jobs
-  for job in BaseJob.objects.select_for_update().filter( site=site, state='done' ):
-    job = job.realJob
+  JobLog.startedList( started_list )
+
+
+def _finishDoneJobs( site_list ):
+  finished_list = []
+  for job in _lockJobs( site_list, 'done' ):
+    foreman_stats.add( 'done_finished' )
     job.done()
     if isinstance( job, StructureJob ):
       registerEvent( job.structure, job=job )
@@ -221,30 +589,36 @@ def processJobs( site, module_list, max_jobs=10 ):
     elif isinstance( job, FoundationJob ):
       registerEvent( job.foundation, job=job )
 
-    JobLog.finished( job )
+    finished_list.append( job.pk )
 
     job.delete()
 
-  # iterate over the curent jobs
-  results = []
-  for job in BaseJob.objects.select_for_update().filter( site=site, state='queued' ).order_by( 'updated' ):
-    job = job.realJob
-    runner = pickle.loads( job.script_runner )
+  JobLog.finishedList( finished_list )
 
-    if runner.aborted:
-      job.state = 'aborted'
-      job.full_clean()
-      job.save()
-      continue
 
-    if runner.done:
-      job.state = 'done'
-      job.full_clean()
-      job.save()
-      continue
+def _runJob( job, module_list ):
+  """
+  Run the job's script, returns the task for subcontractor ( None if there isn't one ), and if the job was
+  saved.  The job is only saved if running it changed something, and then only the columns that changed.
+  """
+  with foreman_stats.timer( 'job_load' ):
+    runner = job.loadRunner()
+
+  prev_state = job.state
+  prev_message = job.message
+  task = None
 
+  if runner.aborted:
+    job.state = 'aborted'
+
+  elif runner.done:
+    job.state = 'done'
+
+  else:
     try:
-      msg = runner.run()
+      with foreman_stats.timer( 'job_run' ):
+        msg = runner.run( ttl=RUNNER_TTL )
+
       if msg is not None:
         job.message = msg
 
@@ -253,6 +627,9 @@ def processJobs( site, module_list, max_jobs=10 ):
       job.message = str( e )[ 0:1024 ]
 
     except ExecutionError as e:
+      if isinstance( e, Timeout ):
+        foreman_stats.add( 'runner_ttl_exhausted' )
+
       job.state = 'error'
       job.message = str( e )[ 0:1024 ]
 
@@ -264,34 +641,361 @@ def processJobs( site, module_list, max_jobs=10 ):
       job.state = 'aborted'
       job.message = 'Unknown Runtime Exception ({0}): "{1}"'.format( type( e ).__name__, str( e ) )[ 0:1024 ]
 
+    if runner.profile is not None and ( runner.done or runner.aborted ):
+      ScriptProfile.record( job, runner.profile )
+
+    ops = RUNNER_TTL - runner.ttl
+    foreman_stats.add( 'runner_ops', ops )
+    foreman_stats.max( 'runner_ops_max', ops )
+
     if job.state == 'queued':
-      task = runner.toSubcontractor( module_list )
+      with foreman_stats.timer( 'job_dispatch' ):
+        redispatch = runner.dispatchExpired()
+        task = runner.toSubcontractor( module_list )
+
       if task is not None:
         task.update( { 'job_id': job.pk } )
-        results.append( task )
+        if redispatch:
+          logging.warning( 'Foreman: job "{0}" dispatch lease expired, re-dispatching to "{1}"'.format( job.pk, task[ 'module' ] ) )
+          foreman_stats.add( 'redispatch_{0}'.format( task[ 'module' ] ) )
+
+  update_field_list = []
+  if job.storeRunner( runner ):
+    job.status = runner.status  # NOTE: the time elapsed/remaining in the status is only updated when the state changes
+    update_field_list += [ 'script_runner', 'parsed_script', 'status' ]
+    foreman_stats.add( 'runner_pickle_bytes', len( job.script_runner ) )
+    foreman_stats.max( 'runner_pickle_bytes_max', len( job.script_runner ) )
+
+  ( waiting_on, wake_at ) = runner.wakeHint()
+  if waiting_on != job.waiting_on or wake_at != job.wake_at:
+    job.waiting_on = waiting_on
+    job.wake_at = wake_at
+    update_field_list += [ 'waiting_on', 'wake_at' ]
 
-    job.status = runner.status
-    job.script_runner = pickle.dumps( runner )
+  if job.state != prev_state:
+    update_field_list.append( 'state' )
+
+  if job.message != prev_message:
+    update_field_list.append( 'message' )
+
+  if not update_field_list:
+    return ( task, False )
+
+  with foreman_stats.timer( 'job_store' ):
     job.full_clean()
-    job.save()
+    job.save( update_fields=update_field_list + [ 'lease_expires', 'updated' ] )
+
+  return ( task, True )
+
+
+def _runQueuedJobs( site_list, module_list, max_jobs, skip_list=None, tag_site=False, prepare=False, key=None ):
+  """
+  skip_list is the job ids that have allready been run this poll, the jobs run are appended to it.  If tag_site
+  is True, the tasks get the job's site as "site".  If prepare is True, the tasks are also stored as PreparedTasks,
+  with the job, for Dispatch.getJobs to pick up, see prepareTasks.  If key is not None, the jobs are run in order
+  from after key (see _claimJobs) instead of the fair order, and key is set to the ( priority, job_id ) of the
+  last job run.
+  """
+  results = []
+  if skip_list is None:
+    skip_list = []
 
-    if len( results ) >= max_jobs:
+  while len( results ) < max_jobs:
+    job_list = _claimJobs( site_list, max_jobs, skip_list, key )
+    if not job_list:
       break
 
+    release_list = []  # jobs that were not saved still have their lease
+    while job_list:
+      job = job_list.pop( 0 )
+      skip_list.append( job.pk )
+      if key is not None:
+        key[:] = [ job.priority, job.pk ]
+
+      job = _relockJob( job )
+      if job is not None:
+        foreman_stats.add( 'queued_examined' )
+        ( task, saved ) = _runJob( job, module_list )
+        if task is not None:
+          foreman_stats.add( 'tasks_dispatched' )
+          if tag_site:
+            task[ 'site' ] = job.site_id
+
+          if prepare:
+            foreman_stats.add( 'tasks_prepared' )
+            PreparedTask.prepare( job, task )
+            notifyWork( tasksKey( job.site_id ) )
+
+          results.append( task )
+
+        if saved:
+          foreman_stats.add( 'queued_advanced' )
+        else:
+          release_list.append( job.pk )
+
+      _commit()
+
+      if len( results ) >= max_jobs:
+        break
+
+    release_list += [ job.pk for job in job_list ]  # and the ones we did not get to
+    if release_list:
+      BaseJob.objects.filter( pk__in=release_list ).update( lease_expires=None )
+      _commit()
+
+  deferred = 0
+  if len( results ) >= max_jobs:
+    deferred = _claimableJobs( site_list, timezone.now() ).exclude( pk__in=skip_list )
+    if key is not None:
+      deferred = _afterKey( deferred, key )
+
+    deferred = deferred.count()
+    if deferred:
+      foreman_stats.add( 'queued_deferred', deferred )
+      logging.info( 'processJobs: max_jobs ({0}) reached for site(s) "{1}", {2} runnable jobs deferred'.format( max_jobs, '", "'.join( site.pk for site in site_list ), deferred ) )
+
+  return ( results, deferred )
+
+
+def _nextWake( site_list ):
+  """
+  Returns the number of seconds till the next sleeping job for the sites in site_list wakes up, or None if there are none.
+  """
+  wake_at = BaseJob.objects.filter( site__in=site_list, state='queued', wake_at__isnull=False ).order_by( 'wake_at' ).values_list( 'wake_at', flat=True ).first()
+  if wake_at is None:
+    return None
+
+  return ( wake_at - timezone.now() ).total_seconds()
+
+
+def processJobs( site, module_list, max_jobs=10, wait_seconds=0 ):
+  """
+  Advance the jobs for site and return up to max_jobs tasks for subcontractor.  The queued jobs are leased, and
+  each job is commited as it is done (if not in an atomic block), so more than one poller can work the same site.
+
+  If wait_seconds is more than 0 and there are no tasks, wait up to wait_seconds (max of MAX_WAIT_SECONDS) for a
+  job to be created, results to arrive, a signal, or a sleeping job to wake up, and try again.
+  """
+  if max_jobs > 100:
+    max_jobs = 100
+
+  ( results, _ ) = _waitProcessJobs( [ site ], module_list, max_jobs, wait_seconds, [] )
+  return results
+
+
+def _siteFamily( site_list ):
+  """
+  Returns site_list and all the sites under them (children, their children, etc), one query per generation.
+  """
+  result = {}
+  generation = list( site_list )
+  while generation:
+    for site in generation:
+      result[ site.pk ] = site
+
+    generation = [ site for site in Site.objects.filter( parent__in=[ site.pk for site in generation ] ) if site.pk not in result ]
+
+  return list( result.values() )
+
+
+def processJobsMulti( site_list, module_list, max_jobs=10, wait_seconds=0, include_children=False ):
+  """
+  processJobs for a subcontractor that serves more than one site.  The phases are run once over all the sites
+  in site_list (and their children, if include_children is True), each site gets an equal share of max_jobs
+  (max of MAX_PAGE_JOBS), any share a site does not use goes to the other sites.  Returns the tasks of all the
+  sites, each with the job's site as "site".
+  """
+  max_jobs = min( max( max_jobs or 0, 1 ), MAX_PAGE_JOBS )
+
+  if include_children:
+    site_list = _siteFamily( site_list )
+
+  if not site_list:
+    return []
+
+  ( results, _ ) = _waitProcessJobs( site_list, module_list, max_jobs, wait_seconds, [], tag_site=True )
   return results
 
 
+def _loadCursor( cursor ):
+  """
+  Returns ( started, key ) from a processJobsPage cursor, or None if a new poll should be started.
+  """
+  if not cursor:
+    return None
+
+  try:
+    ( started, key ) = cursor.split( ':' )
+    started = int( started )
+    key = [ int( i ) for i in key.split( ',' ) if i ]
+  except ValueError:
+    raise ForemanException( 'INVALID_CURSOR', 'cursor is not valid' )
+
+  if len( key ) not in ( 0, 2 ):
+    raise ForemanException( 'INVALID_CURSOR', 'cursor is not valid' )
+
+  if time.time() - started > PAGE_CURSOR_MAX_AGE:
+    return None
+
+  return ( started, key )
+
+
+def processJobsPage( site, module_list, max_jobs=10, cursor=None, wait_seconds=0 ):
+  """
+  Like processJobs, but for draining more tasks than fit in one processJobs call.  Returns
+  { 'job_list': [ <tasks> ], 'cursor': <cursor> }, while cursor is not None, there may be more tasks, call again
+  with the cursor to get the next page.  Only the first page (cursor is None) does the auto locate, waiting and
+  done job phases (and waits up to wait_seconds for work), following pages only run the queued jobs that have not
+  been run yet this poll.  max_jobs is the page size, max of MAX_PAGE_JOBS.  The queued jobs of a paged poll are
+  run highest priority, then oldest (lowest job id) first, not in the fair order of processJobs, the poll walks
+  the queued jobs once, so every runnable job gets its turn before the poll ends.
+
+  The cursor is a string, treat it as opaque, it expires after PAGE_CURSOR_MAX_AGE seconds, after which the
+  next call starts a new poll.
+  """
+  max_jobs = min( max( max_jobs or 0, 1 ), MAX_PAGE_JOBS )
+
+  poll = _loadCursor( cursor )
+  if poll is None:
+    started = int( time.time() )
+    key = []
+    ( results, deferred ) = _waitProcessJobs( [ site ], module_list, max_jobs, wait_seconds, [], key=key )
+
+  else:
+    ( started, key ) = poll
+    if _externalWorker():
+      ( results, deferred ) = _takeTasks( [ site ], module_list, max_jobs, False )
+
+    else:
+      with foreman_stats.timer( 'run_queued' ):
+        ( results, deferred ) = _runQueuedJobs( [ site ], module_list, max_jobs, key=key )
+
+  if not deferred:
+    return { 'job_list': results, 'cursor': None }
+
+  return { 'job_list': results, 'cursor': '{0}:{1}'.format( started, ','.join( str( i ) for i in key ) ) }
+
+
+def _waitProcessJobs( site_list, module_list, max_jobs, wait_seconds, skip_list, tag_site=False, prepare=False, key=None ):
+  if not prepare and _externalWorker():
+    return _waitTakeTasks( site_list, module_list, max_jobs, wait_seconds, tag_site )
+
+  site_id_list = [ site.pk for site in site_list ]
+  wait_seconds = min( max( wait_seconds or 0, 0 ), MAX_WAIT_SECONDS )
+  expires = time.monotonic() + wait_seconds
+  while True:
+    generation = workGeneration( site_id_list )
+    del skip_list[:]  # after waiting, the jobs allready run may be able to get further
+    if key is not None:
+      del key[:]
+
+    ( results, deferred ) = _processJobs( site_list, module_list, max_jobs, skip_list, tag_site, prepare, key )
+    remaining = expires - time.monotonic()
+    if results or remaining <= 0:
+      return ( results, deferred )
+
+    next_wake = _nextWake( site_list )
+    if next_wake is not None:
+      remaining = min( remaining, max( next_wake, MIN_WAIT_SECONDS ) )
+
+    _commit()
+    with foreman_stats.timer( 'wait' ):
+      waitForWork( site_id_list, generation, remaining )
+
+
+def _processJobs( site_list, module_list, max_jobs, skip_list, tag_site, prepare=False, key=None ):
+  with foreman_stats.timer( 'process_jobs' ):
+    with foreman_stats.timer( 'auto_locate' ):
+      _autoLocate( site_list )
+      _commit()
+
+    with foreman_stats.timer( 'start_waiting' ):
+      _startWaitingJobs( site_list )
+      _commit()
+
+    with foreman_stats.timer( 'finish_done' ):
+      _finishDoneJobs( site_list )
+      _commit()
+
+    with foreman_stats.timer( 'run_queued' ):
+      return _runQueuedJobs( site_list, module_list, max_jobs, skip_list, tag_site, prepare, key )
+
+
+def _externalWorker():
+  return getattr( settings, 'FOREMAN_EXTERNAL_WORKER', False )
+
+
+def _takeTasks( site_list, module_list, max_jobs, tag_site ):
+  """
+  Take up to max_jobs of the PreparedTasks for the sites in site_list and modules in module_list.
+  """
+  site_id_list = [ site.pk for site in site_list ]
+  results = []
+  for site_id, task in PreparedTask.take( site_id_list, module_list, max_jobs ):
+    if tag_site:
+      task[ 'site' ] = site_id
+
+    results.append( task )
+
+  foreman_stats.add( 'tasks_taken', len( results ) )
+
+  deferred = 0
+  if len( results ) >= max_jobs:
+    deferred = PreparedTask.objects.filter( site_id__in=site_id_list, module__in=module_list ).count()
+
+  _commit()
+
+  return ( results, deferred )
+
+
+def _waitTakeTasks( site_list, module_list, max_jobs, wait_seconds, tag_site ):
+  key_list = [ tasksKey( site.pk ) for site in site_list ]
+  wait_seconds = min( max( wait_seconds or 0, 0 ), MAX_WAIT_SECONDS )
+  expires = time.monotonic() + wait_seconds
+  while True:
+    generation = workGeneration( key_list )
+    with foreman_stats.timer( 'take_tasks' ):
+      ( results, deferred ) = _takeTasks( site_list, module_list, max_jobs, tag_site )
+
+    remaining = expires - time.monotonic()
+    if results or remaining <= 0:
+      return ( results, deferred )
+
+    with foreman_stats.timer( 'wait' ):
+      waitForWork( key_list, generation, remaining )
+
+
+def siteShard( site_id, shard_count ):
+  """
+  Returns the shard ( 0 to shard_count - 1 ) of site, this is stable across processes and restarts.
+  """
+  return zlib.crc32( str( site_id ).encode() ) % shard_count
+
+
+def workerSites( shard, shard_count ):
+  """
+  Returns the sites for shard of shard_count, see siteShard.
+  """
+  return [ site for site in Site.objects.all().order_by( 'pk' ) if siteShard( site.pk, shard_count ) == shard ]
+
+
+def prepareTasks( site_list, max_jobs=WORKER_MAX_JOBS, wait_seconds=0 ):
+  """
+  The Foreman worker's (lib/util/foremanWorker) side of processJobs, when FOREMAN_EXTERNAL_WORKER is True, the
+  jobs are advanced here, out of the API request path, and the tasks for subcontractor (for any module) are
+  stored as PreparedTasks, Dispatch.getJobs then only picks up the PreparedTasks for it's site and modules.
+  Returns ( number of tasks prepared, number of runnable jobs deferred ), waits up to wait_seconds for work the
+  same as processJobs.
+  """
+  ( results, deferred ) = _waitProcessJobs( site_list, None, max_jobs, wait_seconds, [], prepare=True )
+  return ( len( results ), deferred )
+
+
 # TODO: we will need some kind of job record locking, so only one thing can happen at a time, ie: rolling back when things are still comming in,
 #   trying to handler.run() when fromsubContractor is happening, pretty much, anything the runner is unpickled, nothing else should  happen to
 #   the job till it is pickled and saved
-def jobResults( job_id, cookie, data ):
-  try:
-    job = BaseJob.objects.select_for_update().get( pk=job_id )
-  except BaseJob.DoesNotExist:
-    raise ForemanException( 'JOB_NOT_FOUND', 'Error saving job results: "Job Not Found"' )
-
-  job = job.realJob
-  runner = pickle.loads( job.script_runner )
+def _jobResults( job, cookie, data ):
+  runner = job.loadRunner()
   ( result, message ) = runner.fromSubcontractor( cookie, data )
   if result != 'Accepted':  # it wasn't valid/taken, no point in saving anything
     raise ForemanException( 'INVALID_RESULT', 'Error saving job results: "{0}"'.format( result ) )
@@ -301,25 +1005,221 @@ def jobResults( job_id, cookie, data ):
     job.message = ''
   else:
     job.message = message
-  job.script_runner = pickle.dumps( runner )
+  job.storeRunner( runner )
+  job.clearWakeHint()
   job.full_clean()
   job.save()
 
   return result
 
 
+def _jobError( job, cookie, msg ):
+  runner = job.loadRunner()
+  if cookie != runner.contractor_cookie:  # we do our own out of bad cookie check b/c this type of error dosen't need to be propagated to the script runner
+    raise ForemanException( 'BAD_COOKIE', 'Error setting job to error: "Bad Cookie"' )
+
+  job.message = msg[ 0:1024 ]
+  job.state = 'error'
+  job.full_clean()
+  job.save()
+
+
+def jobResults( job_id, cookie, data ):
+  try:
+    job = BaseJob.objects.select_for_update().get( pk=job_id )
+  except BaseJob.DoesNotExist:
+    raise ForemanException( 'JOB_NOT_FOUND', 'Error saving job results: "Job Not Found"' )
+
+  return _jobResults( job.realJob, cookie, data )
+
+
 def jobError( job_id, cookie, msg ):
   try:
     job = BaseJob.objects.select_for_update().get( pk=job_id )
   except BaseJob.DoesNotExist:
     raise ForemanException( 'JOB_NOT_FOUND', 'Error setting job to error: "Job Not Found"' )
 
-  job = job.realJob
-  runner = pickle.loads( job.script_runner )
-  if cookie != runner.contractor_cookie:  # we do our own out of bad cookie check b/c this type of error dosen't need to be propagated to the script runner
-    raise ForemanException( 'BAD_COOKIE', 'Error setting job to error: "Bad Cookie"' )
+  _jobError( job.realJob, cookie, msg )
 
-  job.message = msg[ 0:1024 ]
-  job.state = 'error'
-  job.full_clean
-  job.save()
+
+def _batchItemError( item ):  # check the shape of a jobResultsBatch item, returns None if it is ok, otherwise why it is not
+  if not isinstance( item, dict ):
+    return 'Item is not a map'
+
+  if not isinstance( item.get( 'cookie' ), str ):
+    return 'cookie is missing or not a string'
+
+  if 'msg' in item and not isinstance( item[ 'msg' ], str ):
+    return 'msg is not a string'
+
+  return None
+
+
+def jobResultsBatch( result_list ):
+  """
+  Apply a list of results from subcontractor, each item is a dict with job_id, cookie, and either data
+  (same as jobResults) or msg (same as jobError).  The jobs are locked and loaded together and the results
+  applied in one transaction, each item in it's own savepoint, so one bad item does not lose the others.  Returns a
+  list, in the same order as result_list, of { 'job_id': <job_id>, 'result': <jobResults result> }, or for jobError
+  items { 'job_id': <job_id>, 'result': 'Error Set' }, or if the item failed
+  { 'job_id': <job_id>, 'error': <ForemanException code>, 'message': <ForemanException message> }.
+  """
+  job_id_list = []
+  for item in result_list:
+    try:
+      job_id = int( item[ 'job_id' ] )
+    except ( KeyError, TypeError, ValueError ):
+      continue
+
+    if job_id not in job_id_list:
+      job_id_list.append( job_id )
+
+  with transaction.atomic():
+    # lock in pk order so concurrent batches do not deadlock each other
+    job_id_list = list( BaseJob.objects.select_for_update().filter( pk__in=job_id_list ).order_by( 'pk' ).values_list( 'pk', flat=True ) )
+    job_map = dict( ( job.pk, job ) for job in _realJobs( job_id_list ) )
+
+    results = []
+    for item in result_list:
+      job_id = item.get( 'job_id' ) if isinstance( item, dict ) else None
+      error = _batchItemError( item )
+      if error is not None:
+        results.append( { 'job_id': job_id, 'error': 'INVALID_ITEM', 'message': 'Error saving job results: "{0}"'.format( error ) } )
+        continue
+
+      job = None
+      try:
+        try:
+          job = job_map[ int( job_id ) ]
+        except ( KeyError, TypeError, ValueError ):
+          raise ForemanException( 'JOB_NOT_FOUND', 'Error saving job results: "Job Not Found"' )
+
+        with transaction.atomic():
+          if 'msg' in item:
+            _jobError( job, item[ 'cookie' ], item[ 'msg' ] )
+            result = 'Error Set'
+          else:
+            result = _jobResults( job, item[ 'cookie' ], item.get( 'data' ) )
+
+      except ForemanException as e:
+        results.append( { 'job_id': job_id, 'error': e.code, 'message': e.message } )
+        continue
+
+      except ( ValidationError, DataError, TypeError, KeyError ) as e:
+        if job is not None:  # the savepoint was rolled back, the job may of been changed before it failed
+          job.refresh_from_db()
+
+        results.append( { 'job_id': job_id, 'error': 'INVALID_RESULT', 'message': 'Error saving job results: "{0}"'.format( str( e )[ 0:200 ] ) } )
+        continue
+
+      results.append( { 'job_id': job_id, 'result': result } )
+
+  return results
+
+
+def rollupJobLog( before ):
+  """
+  Sum up the JobLog entries created before "before" (a datetime) into JobLogRollup, and remove them.  Only the entries that
+  are closed, ie: finished, canceled, or the job no longer exists, are rolled up.  Returns the number of entries rolled up.
+  """
+  queryset = JobLog.objects.filter( created__lt=before )
+  queryset = queryset.filter( Q( finished_at__isnull=False ) | Q( canceled_at__isnull=False ) | ~Q( job_id__in=BaseJob.objects.values( 'pk' ) ) )
+
+  with transaction.atomic():
+    id_list = list( queryset.select_for_update( skip_locked=True ).values_list( 'pk', flat=True ) )
+    if not id_list:
+      return 0
+
+    run_time = ExpressionWrapper( F( 'finished_at' ) - F( 'started_at' ), output_field=models.DurationField() )
+    summary = JobLog.objects.filter( pk__in=id_list ).annotate( day=TruncDate( 'created' ) ).values( 'site_id', 'day', 'target_class', 'script_name' )
+    summary = summary.annotate( job_count=Count( 'pk' ), finished_count=Count( 'finished_at' ), canceled_count=Count( 'canceled_at' ), run_time=Sum( run_time ) ).order_by()
+    for item in summary:
+      ( rollup, _ ) = JobLogRollup.objects.select_for_update().get_or_create( site_id=item[ 'site_id' ], day=item[ 'day' ], target_class=item[ 'target_class' ], script_name=item[ 'script_name' ] )
+      rollup.job_count += item[ 'job_count' ]
+      rollup.finished_count += item[ 'finished_count' ]
+      rollup.canceled_count += item[ 'canceled_count' ]
+      if item[ 'run_time' ] is not None:
+        rollup.run_seconds += item[ 'run_time' ].total_seconds()
+
+      rollup.full_clean()
+      rollup.save()
+
+    JobLog.objects.filter( pk__in=id_list ).delete()  # the queryset delete, JobLog.delete is blocked for everything else
+
+  return len( id_list )
+
+
+def cleanParsedScripts( before ):
+  """
+  Remove the ParsedScripts no job is using, that were last used before "before" (a datetime).  Returns the number removed.
+  """
+  used_queryset = BaseJob.objects.filter( parsed_script__isnull=False ).values( 'parsed_script_id' )
+  count = 0
+  for script_hash in ParsedScript.objects.filter( last_used__lt=before ).exclude( script_hash__in=used_queryset ).values_list( 'pk', flat=True ):
+    try:
+      with transaction.atomic():
+        # waits for a ParsedScript.fromAST that is touching it, and is checked again once we have it, a job may of started using it since
+        if not ParsedScript.objects.select_for_update().filter( pk=script_hash, last_used__lt=before ).exists():
+          continue
+
+        ( deleted, _ ) = ParsedScript.objects.filter( pk=script_hash, last_used__lt=before ).exclude( script_hash__in=used_queryset ).delete()
+
+    except ( ProtectedError, IntegrityError ):  # a job started using it since, IntegrityError is from the (deferred) foreign key of a job that has not committed yet
+      continue
+
+    if deleted:
+      count += 1
+
+  return count
+
+
+def scriptProfileReport( blueprint=None, script_name=None ):
+  """
+  The ScriptProfile totals, for blueprint (name) and/or script_name, or everything if None.  Returns a list, one for
+  each version of each script, the most time spent first, of dicts of:
+    blueprint, script_name, script_hash
+    current: True if it is the version of the script the blueprint has now
+    job_count: number of jobs
+    seconds, dispatch_seconds: total for all the lines
+    line_list: list of dicts of line, source (None if not current), job_count, ops, seconds, dispatch_seconds, resumptions
+  """
+  queryset = ScriptProfile.objects.all()
+  if blueprint is not None:
+    queryset = queryset.filter( blueprint=blueprint )
+
+  if script_name is not None:
+    queryset = queryset.filter( script_name=script_name )
+
+  script_map = {}  # ( blueprint, script_name, script_hash ) -> entry
+  for profile in queryset.order_by( 'line' ):
+    key = ( profile.blueprint, profile.script_name, profile.script_hash )
+    try:
+      entry = script_map[ key ]
+    except KeyError:
+      entry = script_map[ key ] = { 'blueprint': profile.blueprint, 'script_name': profile.script_name, 'script_hash': profile.script_hash, 'current': False, 'job_count': 0, 'seconds': 0.0, 'dispatch_seconds': 0.0, 'line_list': [] }
+
+    entry[ 'job_count' ] = max( entry[ 'job_count' ], profile.job_count )  # the first line is run by every job
+    entry[ 'seconds' ] += profile.seconds
+    entry[ 'dispatch_seconds' ] += profile.dispatch_seconds
+    entry[ 'line_list' ].append( { 'line': profile.line, 'source': None, 'job_count': profile.job_count, 'ops': profile.ops, 'seconds': profile.seconds, 'dispatch_seconds': profile.dispatch_seconds, 'resumptions': profile.resumptions } )
+
+  source_map = {}  # ( blueprint, script_name ) -> current script
+  for entry in script_map.values():
+    key = ( entry[ 'blueprint' ], entry[ 'script_name' ] )
+    if key not in source_map:
+      source_map[ key ] = None
+      blueprint = BluePrint.objects.filter( pk=entry[ 'blueprint' ] ).first()
+      if blueprint is not None:
+        source_map[ key ] = blueprint.subclass.get_script( entry[ 'script_name' ] )
+
+    script = source_map[ key ]
+    if script is None or scriptHash( script ) != entry[ 'script_hash' ]:
+      continue
+
+    entry[ 'current' ] = True
+    source_line_list = script.splitlines()
+    for line in entry[ 'line_list' ]:
+      if 0 < line[ 'line' ] <= len( source_line_list ):
+        line[ 'source' ] = source_line_list[ line[ 'line' ] - 1 ]
+
+  return sorted( script_map.values(), key=lambda entry: ( -( entry[ 'seconds' ] + entry[ 'dispatch_seconds' ] ), entry[ 'blueprint' ], entry[ 'script_name' ] ) )
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Foreman', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ParsedScript',
+            fields=[
+                ('script_hash', models.CharField(max_length=64, serialize=False, primary_key=True)),
+                ('ast', models.BinaryField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='basejob',
+            name='parsed_script',
+            field=models.ForeignKey(null=True, blank=True, editable=False, to='Foreman.ParsedScript', on_delete=django.db.models.deletion.PROTECT),
+        ),
+    ]
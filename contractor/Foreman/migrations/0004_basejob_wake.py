@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Site', '0001_initial'),
+        ('Foreman', '0003_basejob_lease_expires'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basejob',
+            name='waiting_on',
+            field=models.CharField(default='', max_length=10, blank=True, editable=False, choices=[('', ''), ('signal', 'signal'), ('dispatch', 'dispatch')]),
+        ),
+        migrations.AddField(
+            model_name='basejob',
+            name='wake_at',
+            field=models.DateTimeField(null=True, blank=True, editable=False),
+        ),
+        migrations.AddIndex(
+            model_name='basejob',
+            index=models.Index(fields=['site', 'state', 'waiting_on', 'wake_at'], name='foreman_basejob_wake'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Foreman', '0004_basejob_wake'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='basejob',
+            name='priority',
+            field=models.IntegerField(default=50, editable=False),
+        ),
+    ]
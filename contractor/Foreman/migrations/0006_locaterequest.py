@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Site', '0001_initial'),
+        ('Foreman', '0005_basejob_priority'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LocateRequest',
+            fields=[
+                ('site', models.OneToOneField(primary_key=True, serialize=False, to='Site.Site', on_delete=django.db.models.deletion.CASCADE)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Site', '0001_initial'),
+        ('Foreman', '0006_locaterequest'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='joblog',
+            index=models.Index(fields=['job_id'], name='foreman_joblog_job'),
+        ),
+        migrations.AddIndex(
+            model_name='joblog',
+            index=models.Index(fields=['site', 'target_class', 'target_id'], name='foreman_joblog_target'),
+        ),
+        migrations.AddIndex(
+            model_name='joblog',
+            index=models.Index(fields=['created'], name='foreman_joblog_created'),
+        ),
+        migrations.CreateModel(
+            name='JobLogRollup',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('site', models.ForeignKey(to='Site.Site', on_delete=django.db.models.deletion.CASCADE)),
+                ('day', models.DateField()),
+                ('target_class', models.CharField(max_length=50)),
+                ('script_name', models.CharField(max_length=50)),
+                ('job_count', models.IntegerField(default=0)),
+                ('finished_count', models.IntegerField(default=0)),
+                ('canceled_count', models.IntegerField(default=0)),
+                ('run_seconds', models.FloatField(default=0.0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'default_permissions': ('view',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='joblogrollup',
+            unique_together=set([('site', 'day', 'target_class', 'script_name')]),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import contractor.fields
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Site', '0001_initial'),
+        ('Foreman', '0007_joblog_index_rollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PreparedTask',
+            fields=[
+                ('job', models.OneToOneField(primary_key=True, serialize=False, to='Foreman.BaseJob', on_delete=django.db.models.deletion.CASCADE)),
+                ('site', models.ForeignKey(to='Site.Site', on_delete=django.db.models.deletion.CASCADE)),
+                ('module', models.CharField(max_length=50)),
+                ('task', contractor.fields.JSONField()),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['site', 'created'], name='foreman_preparedtask_site')],
+            },
+        ),
+    ]
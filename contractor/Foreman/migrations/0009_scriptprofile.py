@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Foreman', '0008_preparedtask'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScriptProfile',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('blueprint', models.CharField(max_length=40)),
+                ('script_name', models.CharField(max_length=50)),
+                ('script_hash', models.CharField(max_length=64)),
+                ('line', models.IntegerField()),
+                ('job_count', models.IntegerField(default=0)),
+                ('ops', models.IntegerField(default=0)),
+                ('seconds', models.FloatField(default=0.0)),
+                ('dispatch_seconds', models.FloatField(default=0.0)),
+                ('resumptions', models.IntegerField(default=0)),
+                ('updated', models.DateTimeField(auto_now=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'default_permissions': ('view',),
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='scriptprofile',
+            unique_together=set([('blueprint', 'script_name', 'script_hash', 'line')]),
+        ),
+    ]
@@ -1,18 +1,32 @@
+import time
 import pickle
+import hashlib
+from datetime import timedelta
 
+from django.conf import settings
 from django.utils import timezone
-from django.db import models
+from django.db import models, transaction
+from django.db.models.signals import post_init, post_save, post_delete
 from django.core.exceptions import ValidationError, ObjectDoesNotExist
 
 from cinp.orm_django import DjangoCInP as CInP
 
 from contractor.fields import JSONField
 from contractor.Site.models import Site
-from contractor.Building.models import Foundation, Structure, Dependency
+from contractor.Building.models import Foundation, Structure, Dependency, ComplexStructure
+from contractor.Foreman.notifier import notifyWork
+from contractor.Foreman.stats import foreman_stats
+from contractor.tscript.parser import ast_cache, scriptHash
+from contractor.tscript.runner import Runner, Tracer, Profile
 
 # stuff for getting handeling tasks, everything here should be ephemerial, only things that are in progress/flight
 
 PICKLE_PROTOCOL = 4
+JOB_PRIORITY_MIN = 0
+JOB_PRIORITY_MAX = 100
+JOB_PRIORITY_DEFAULT = 50
+JOB_STATS_CACHE_SECONDS = 5
+PARSED_SCRIPT_TOUCH_INTERVAL = timedelta( hours=1 )
 cinp = CInP( 'Foreman', '0.1' )
 
 
@@ -30,15 +44,163 @@ class ForemanException( ValueError ):
     return 'ForemanException ({0}): {1}'.format( self.code, self.message )
 
 
-@cinp.model( not_allowed_verb_list=[ 'LIST', 'GET', 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', ), property_list=( 'can_start', ) )
+@cinp.staticModel( not_allowed_verb_list=[ 'LIST', 'GET', 'DELETE', 'CREATE', 'UPDATE' ] )
+class Stats():
+  @cinp.action( return_type={ 'type': 'Map' }, paramater_type_list=[ 'Boolean' ] )
+  @staticmethod
+  def getStats( reset=False ):
+    """
+    Returns the timings and counters of the job loop (Dispatch.getJobs) for the process that
+    handles the request, since the process started or was last reset.
+    """
+    return foreman_stats.snapshot( reset )
+
+  @cinp.check_auth()
+  @staticmethod
+  def checkAuth( user, verb, id_list, action=None ):
+    return cinp.basic_auth_check( user, verb, action, Stats, { 'getStats': None } )
+
+  class Meta:
+    default_permissions = ()  # only CALL
+
+  def __str__( self ):
+    return 'Stats'
+
+
+# not exposed to CInP, a site that needs it's unlocated Foundations checked for auto locating, see Foreman.lib._autoLocate
+class LocateRequest( models.Model ):
+  site = models.OneToOneField( Site, primary_key=True, on_delete=models.CASCADE )
+  created = models.DateTimeField( editable=False, auto_now_add=True )
+
+  @classmethod
+  def request( cls, site_id ):
+    cls.objects.bulk_create( [ cls( site_id=site_id ) ], ignore_conflicts=True )
+    notifyWork( site_id )
+
+  @classmethod
+  def take( cls, site_id ):  # returns True if there was a request for the site, and clears it
+    ( count, _ ) = cls.objects.filter( site_id=site_id ).delete()
+    return count > 0
+
+  @classmethod
+  def takeList( cls, site_id_list ):  # returns the set of the site_ids in site_id_list that had a request, and clears them
+    result = set( cls.objects.filter( site_id__in=site_id_list ).values_list( 'site_id', flat=True ) )
+    if result:
+      cls.objects.filter( site_id__in=result ).delete()
+
+    return result
+
+  def __str__( self ):
+    return 'LocateRequest for "{0}"'.format( self.site_id )
+
+
+# not exposed to CInP, this is only the storage for the parsed scripts the jobs are running
+class ParsedScript( models.Model ):
+  script_hash = models.CharField( max_length=64, primary_key=True )
+  ast = models.BinaryField( editable=False )
+  last_used = models.DateTimeField( editable=False, default=timezone.now )  # updated at most once an hour, see fromAST and Foreman.lib.cleanParsedScripts
+  created = models.DateTimeField( editable=False, auto_now_add=True )
+
+  @classmethod
+  def fromAST( cls, ast, script=None ):
+    """
+    Returns the ParsedScript for ast, creating it if it does not exist.  If script (the source of ast) is
+    provided the hash is of the script, otherwise it is of the ast.
+    """
+    if script is not None:
+      script_hash = scriptHash( script )
+    else:
+      script_hash = hashlib.sha256( pickle.dumps( ast, protocol=PICKLE_PROTOCOL ) ).hexdigest()
+
+    ( parsed_script, created ) = cls.objects.get_or_create( script_hash=script_hash, defaults={ 'ast': pickle.dumps( ast, protocol=PICKLE_PROTOCOL ) } )
+    if not created and parsed_script.last_used < timezone.now() - PARSED_SCRIPT_TOUCH_INTERVAL:  # so cleanParsedScripts dosen't remove it out from under the job about to use it
+      parsed_script.last_used = timezone.now()
+      if not cls.objects.filter( pk=script_hash ).update( last_used=parsed_script.last_used ):  # cleanParsedScripts removed it after we got it
+        ( parsed_script, _ ) = cls.objects.get_or_create( script_hash=script_hash, defaults={ 'ast': pickle.dumps( ast, protocol=PICKLE_PROTOCOL ) } )
+
+    ast_cache.set( script_hash, ast )
+
+    return parsed_script
+
+  @staticmethod
+  def getAST( script_hash ):
+    ast = ast_cache.get( script_hash )
+    if ast is not None:
+      return ast
+
+    ast = pickle.loads( ParsedScript.objects.get( pk=script_hash ).ast )
+    ast_cache.set( script_hash, ast )
+
+    return ast
+
+  def __str__( self ):
+    return 'ParsedScript "{0}"'.format( self.script_hash )
+
+
+_job_stats_cache = {}  # site_id( or None for all sites ) -> ( expires, stats )
+
+
+def _emptyJobStats():
+  return { 'total': 0, 'type': { 'foundation': 0, 'structure': 0, 'dependency': 0 }, 'state': {} }
+
+
+def _jobStats( site_id ):
+  """
+  Returns the job stats, by site, for site_id or all sites if site_id is None.  Computed with one grouped
+  query, and cached for JOB_STATS_CACHE_SECONDS.
+  """
+  now = time.monotonic()
+  try:
+    ( expires, result ) = _job_stats_cache[ site_id ]
+    if expires > now:
+      return result
+
+  except KeyError:
+    pass
+
+  queryset = BaseJob.objects.all()
+  if site_id is not None:
+    queryset = queryset.filter( site_id=site_id )
+
+  queryset = queryset.values( 'site_id', 'state' ).order_by()  # the order_by() clears the default ordering, otherwise it would be part of the grouping
+  queryset = queryset.annotate( count=models.Count( 'pk' ), oldest=models.Min( 'created' ), foundation=models.Count( 'foundationjob' ), structure=models.Count( 'structurejob' ), dependency=models.Count( 'dependencyjob' ) )
+
+  result = {}
+  current = timezone.now()
+  for row in queryset:
+    stats = result.setdefault( row[ 'site_id' ], _emptyJobStats() )
+    stats[ 'total' ] += row[ 'count' ]
+    for job_type in ( 'foundation', 'structure', 'dependency' ):
+      stats[ 'type' ][ job_type ] += row[ job_type ]
+
+    stats[ 'state' ][ row[ 'state' ] ] = {
+                                           'count': row[ 'count' ],
+                                           'foundation': row[ 'foundation' ],
+                                           'structure': row[ 'structure' ],
+                                           'dependency': row[ 'dependency' ],
+                                           'oldest_age': int( ( current - row[ 'oldest' ] ).total_seconds() )
+                                         }
+
+  _job_stats_cache[ site_id ] = ( now + JOB_STATS_CACHE_SECONDS, result )
+
+  return result
+
+
+@cinp.model( not_allowed_verb_list=[ 'LIST', 'GET', 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', 'parsed_script' ), property_list=( 'can_start', ) )
 class BaseJob( models.Model ):
   JOB_STATE_CHOICES = ( 'queued', 'waiting', 'done', 'paused', 'error', 'aborted' )
+  WAITING_ON_CHOICES = ( '', 'signal', 'dispatch' )
   site = models.ForeignKey( Site, editable=False, on_delete=models.CASCADE )
   state = models.CharField( max_length=10, choices=[ ( i, i ) for i in JOB_STATE_CHOICES ] )
   status = JSONField( default=[], blank=True )
   message = models.CharField( max_length=1024, default='', blank=True )  # messages can come from Script (Pause/___Error/Exception), Plugin (fromSubcontractor jobResults/jobError), PXE Image postMessage/signalAlert
-  script_runner = models.BinaryField( editable=False )
+  script_runner = models.BinaryField( editable=False )  # only the execution state of the runner, the ast is in parsed_script
+  parsed_script = models.ForeignKey( ParsedScript, editable=False, blank=True, null=True, on_delete=models.PROTECT )  # null for jobs stored before the ast was split out, in which case script_runner is the whole pickled runner
   script_name = models.CharField( max_length=40, editable=False, default=False )
+  lease_expires = models.DateTimeField( editable=False, blank=True, null=True )  # set while a poller is running the job, see Foreman.lib.processJobs
+  waiting_on = models.CharField( max_length=10, choices=[ ( i, i ) for i in WAITING_ON_CHOICES ], default='', blank=True, editable=False )  # waiting_on and wake_at are from the runner's wakeHint, a queued job is not run until wake_at or, if waiting_on is set, something clears them
+  wake_at = models.DateTimeField( editable=False, blank=True, null=True )
+  priority = models.IntegerField( default=JOB_PRIORITY_DEFAULT, editable=False )  # JOB_PRIORITY_MIN - JOB_PRIORITY_MAX, higher priority jobs are dispatched first, see Foreman.lib._claimJobs
   updated = models.DateTimeField( editable=False, auto_now=True )
   created = models.DateTimeField( editable=False, auto_now_add=True )
 
@@ -65,6 +227,59 @@ class BaseJob( models.Model ):
   def can_start( self ):
     return False
 
+  @property
+  def blueprint( self ):  # the blueprint the job's script is from
+    try:
+      return self.foundationjob.foundation.blueprint
+    except ObjectDoesNotExist:
+      pass
+
+    try:
+      return self.structurejob.structure.blueprint
+    except ObjectDoesNotExist:
+      pass
+
+    try:
+      dependency = self.dependencyjob.dependency
+      if dependency.script_structure is not None:
+        return dependency.script_structure.blueprint
+      else:
+        return dependency.structure.blueprint
+    except ObjectDoesNotExist:
+      pass
+
+    return None
+
+  def clearWakeHint( self ):  # the job has something to do, let processJobs see it, and wake up anything waiting on the site
+    self.waiting_on = ''
+    self.wake_at = None
+    notifyWork( self.site_id )
+
+  def loadRunner( self ):
+    if self.parsed_script_id is None:
+      return pickle.loads( self.script_runner )
+
+    runner = Runner( ParsedScript.getAST( self.parsed_script_id ) )
+    runner.__setstate__( pickle.loads( self.script_runner ) )
+
+    return runner
+
+  def storeRunner( self, runner ):
+    """
+    Stores the execution state of runner, returns True if it is diffrent from what was allready stored.
+    """
+    changed = False
+    if self.parsed_script_id is None:
+      self.parsed_script = ParsedScript.fromAST( runner.ast )
+      changed = True
+
+    script_runner = pickle.dumps( runner.__getstate__(), protocol=PICKLE_PROTOCOL )
+    if changed or self.script_runner is None or bytes( self.script_runner ) != script_runner:
+      self.script_runner = script_runner
+      changed = True
+
+    return changed
+
   @cinp.action()
   def pause( self ):
     """
@@ -92,6 +307,7 @@ class BaseJob( models.Model ):
       raise ForemanException( 'NOT_PAUSED', 'Can only resume a job if it is paused' )
 
     self.state = 'queued'
+    self.clearWakeHint()
     self.full_clean()
     self.save()
 
@@ -106,10 +322,12 @@ class BaseJob( models.Model ):
     if self.state != 'error':
       raise ForemanException( 'NOT_ERRORED', 'Can only reset a job if it is in error' )
 
-    runner = pickle.loads( self.script_runner )
+    runner = self.loadRunner()
     runner.clearDispatched()
     self.status = runner.status
-    self.script_runner = pickle.dumps( runner, protocol=PICKLE_PROTOCOL )
+    self.storeRunner( runner )
+    self.clearWakeHint()
+    PreparedTask.discard( self )
 
     self.state = 'queued'
     self.full_clean()
@@ -126,13 +344,15 @@ class BaseJob( models.Model ):
     if self.state != 'error':
       raise ForemanException( 'NOT_ERRORED', 'Can only rollback a job if it is in error' )
 
-    runner = pickle.loads( self.script_runner )
+    runner = self.loadRunner()
     msg = runner.rollback()
     if msg != 'Done':
       raise ValueError( 'Unable to rollback "{0}"'.format( msg ) )
 
     self.status = runner.status
-    self.script_runner = pickle.dumps( runner, protocol=PICKLE_PROTOCOL )
+    self.storeRunner( runner )
+    self.clearWakeHint()
+    PreparedTask.discard( self )
     self.state = 'queued'
     self.full_clean()
     self.save()
@@ -149,10 +369,12 @@ class BaseJob( models.Model ):
     if self.state != 'queued':
       raise ForemanException( 'NOT_ERRORED', 'Can only clear the dispatched flag a job if it is in queued state' )
 
-    runner = pickle.loads( self.script_runner )
+    runner = self.loadRunner()
     runner.clearDispatched()
     self.status = runner.status
-    self.script_runner = pickle.dumps( runner, protocol=PICKLE_PROTOCOL )
+    self.storeRunner( runner )
+    self.clearWakeHint()
+    PreparedTask.discard( self )
 
     self.full_clean()
     self.save()
@@ -163,7 +385,26 @@ class BaseJob( models.Model ):
     """
     Returns the job status
     """
-    return { 'running': BaseJob.objects.filter( site=site ).count(), 'error': BaseJob.objects.filter( site=site, state__in=( 'error', 'aborted', 'paused' ) ).count() }
+    stats = _jobStats( site.pk ).get( site.pk, _emptyJobStats() )
+    return { 'running': stats[ 'total' ], 'error': sum( stats[ 'state' ].get( state, {} ).get( 'count', 0 ) for state in ( 'error', 'aborted', 'paused' ) ) }
+
+  @cinp.action( return_type={ 'type': 'Map' }, paramater_type_list=[ { 'type': 'Model', 'model': Site } ] )
+  @staticmethod
+  def jobStatsDetail( site ):
+    """
+    Returns the job counts for the site, the total, per job type, and per state.  For each state
+    there is also the count per job type, and the age in seconds of the oldest job.  Cached for
+    JOB_STATS_CACHE_SECONDS.
+    """
+    return _jobStats( site.pk ).get( site.pk, _emptyJobStats() )
+
+  @cinp.action( return_type={ 'type': 'Map' } )
+  @staticmethod
+  def jobStatsAllSites():
+    """
+    Returns the same as jobStatsDetail, for all the sites that have jobs, keyed by site.
+    """
+    return _jobStats( None )
 
   @cinp.action( return_type={ 'type': 'Map' } )
   def jobRunnerVariables( self ):
@@ -171,7 +412,7 @@ class BaseJob( models.Model ):
     Returns variables internal to the job script
     """
     result = {}
-    runner = pickle.loads( self.script_runner )
+    runner = self.loadRunner()
 
     for module in runner.value_map:
       for name in runner.value_map[ module ]:
@@ -187,45 +428,70 @@ class BaseJob( models.Model ):
     Returns the state of the job script
     """
     result = {}
-    runner = pickle.loads( self.script_runner )
-
-    blueprint = None
-
-    try:
-      blueprint = self.foundationjob.foundation.blueprint
-    except ObjectDoesNotExist:
-      pass
-
-    try:
-      blueprint = self.structurejob.structure.blueprint
-    except ObjectDoesNotExist:
-      pass
-
-    try:
-      dependency = self.dependencyjob.dependency
-      if dependency.script_structure is not None:
-        blueprint = dependency.script_structure.blueprint
-      else:
-        blueprint = dependency.structure.blueprint
-    except ObjectDoesNotExist:
-      pass
+    runner = self.loadRunner()
 
+    blueprint = self.blueprint
     if blueprint is not None:
       result[ 'script' ] = blueprint.get_script( self.script_name )
 
     result[ 'cur_line' ] = runner.cur_line
-    result[ 'state' ] = runner.state
+    result[ 'state' ] = runner.dumpState()
+    if runner.tracer is not None:  # see setTrace
+      result[ 'trace' ] = runner.tracer.entries
+
+    if runner.profile is not None:  # see setProfile
+      result[ 'profile' ] = runner.profile.lines
 
     return result
 
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setTrace( self, enabled ):
+    """
+    Turn tracing of the job script on or off, while on, what the script does (nodes evaluated and how long they
+    took, functions called and dispatched) is recorded, the last entries are returned by jobRunnerState as 'trace'.
+    Turning it off discards the trace.
+    """
+    runner = self.loadRunner()
+    if enabled:
+      if runner.tracer is None:
+        runner.tracer = Tracer()
+
+    else:
+      runner.tracer = None
+
+    if self.storeRunner( runner ):
+      self.full_clean()
+      self.save()
+
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setProfile( self, enabled ):
+    """
+    Turn profiling of the job script on or off, while on, the operations, run time, time waiting on
+    subcontractor, and resumptions are totaled by line, and returned by jobRunnerState as 'profile'.  When
+    the script finishes the totals are added to the ScriptProfile of the script.  Turning it off discards the
+    totals.  To profile all new jobs, see the TSCRIPT_PROFILE setting.
+    """
+    runner = self.loadRunner()
+    if enabled:
+      if runner.profile is None:
+        runner.profile = Profile()
+
+    else:
+      runner.profile = None
+
+    if self.storeRunner( runner ):
+      self.full_clean()
+      self.save()
+
   @cinp.action( return_type='String', paramater_type_list=[ 'String' ] )
   def signalComplete( self, cookie ):
-    runner = pickle.loads( self.script_runner )
+    runner = self.loadRunner()
 
     for entry in runner.object_list:
       if entry.__class__.__name__ == 'SignalingPlugin':
         result = entry.signal( cookie )
-        self.script_runner = pickle.dumps( runner, protocol=PICKLE_PROTOCOL )
+        self.storeRunner( runner )
+        self.clearWakeHint()
         self.full_clean()
         self.save()
         return result
@@ -257,6 +523,8 @@ class BaseJob( models.Model ):
     # TODO: action "jobStatus": this may have sensitive stuff in it, probably should auth
     return cinp.basic_auth_check( user, verb, action, BaseJob, {
                                                                  'jobStats': None,
+                                                                 'jobStatsDetail': None,
+                                                                 'jobStatsAllSites': None,
                                                                  'signalComplete': 'Foreman.can_job_signal',
                                                                  'signalAlert': 'Foreman.can_job_signal',
                                                                  'postMessage': 'Foreman.can_job_signal',
@@ -270,6 +538,9 @@ class BaseJob( models.Model ):
     if self.state not in self.JOB_STATE_CHOICES:
       errors[ 'state' ] = 'Invalid'
 
+    if self.priority < JOB_PRIORITY_MIN or self.priority > JOB_PRIORITY_MAX:
+      errors[ 'priority' ] = 'Must be from {0} to {1}'.format( JOB_PRIORITY_MIN, JOB_PRIORITY_MAX )
+
     if errors:
       raise ValidationError( errors )
 
@@ -279,12 +550,13 @@ class BaseJob( models.Model ):
                     ( 'can_base_job', 'Can Work With Base Jobs' ),
                     ( 'can_job_signal', 'Can call the Job Signalling Actions' )
                   )
+    indexes = [ models.Index( fields=[ 'site', 'state', 'waiting_on', 'wake_at' ], name='foreman_basejob_wake' ) ]
 
   def __str__( self ):
     return 'BaseJob #{0} in "{1}"'.format( self.pk, self.site.pk )
 
 
-@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', ), property_list=( 'can_start', ) )
+@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', 'parsed_script' ), property_list=( 'can_start', ) )
 class FoundationJob( BaseJob ):
   foundation = models.OneToOneField( Foundation, editable=False, on_delete=models.CASCADE )
 
@@ -368,6 +640,20 @@ class FoundationJob( BaseJob ):
     """
     return super().jobRunnerState()
 
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setTrace( self, enabled ):
+    """
+    See BaseJob.setTrace
+    """
+    super().setTrace( enabled )
+
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setProfile( self, enabled ):
+    """
+    See BaseJob.setProfile
+    """
+    super().setProfile( enabled )
+
   @cinp.list_filter( name='site', paramater_type_list=[ { 'type': 'Model', 'model': Site } ] )
   @staticmethod
   def filter_site( site ):
@@ -388,7 +674,7 @@ class FoundationJob( BaseJob ):
     return 'FoundationJob #{0} for "{1}" in "{2}"'.format( self.pk, self.foundation.pk, self.foundation.site.pk )
 
 
-@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', ), property_list=( 'can_start', ) )
+@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', 'parsed_script' ), property_list=( 'can_start', ) )
 class StructureJob( BaseJob ):
   structure = models.OneToOneField( Structure, editable=False, on_delete=models.CASCADE )
 
@@ -471,6 +757,20 @@ class StructureJob( BaseJob ):
     """
     return super().jobRunnerState()
 
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setTrace( self, enabled ):
+    """
+    See BaseJob.setTrace
+    """
+    super().setTrace( enabled )
+
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setProfile( self, enabled ):
+    """
+    See BaseJob.setProfile
+    """
+    super().setProfile( enabled )
+
   @cinp.list_filter( name='site', paramater_type_list=[ { 'type': 'Model', 'model': Site } ] )
   @staticmethod
   def filter_site( site ):
@@ -491,7 +791,7 @@ class StructureJob( BaseJob ):
     return 'StructureJob #{0} for "{1}" in "{2}"'.format( self.pk, self.structure.pk, self.structure.site.pk )
 
 
-@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', ), property_list=( 'can_start' ) )
+@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE' ], hide_field_list=( 'script_runner', 'parsed_script' ), property_list=( 'can_start' ) )
 class DependencyJob( BaseJob ):
   dependency = models.OneToOneField( Dependency, editable=False, on_delete=models.CASCADE )
 
@@ -582,6 +882,20 @@ class DependencyJob( BaseJob ):
     """
     return super().jobRunnerState()
 
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setTrace( self, enabled ):
+    """
+    See BaseJob.setTrace
+    """
+    super().setTrace( enabled )
+
+  @cinp.action( paramater_type_list=[ 'Boolean' ] )
+  def setProfile( self, enabled ):
+    """
+    See BaseJob.setProfile
+    """
+    super().setProfile( enabled )
+
   @cinp.list_filter( name='site', paramater_type_list=[ { 'type': 'Model', 'model': Site } ] )
   @staticmethod
   def filter_site( site ):
@@ -602,6 +916,41 @@ class DependencyJob( BaseJob ):
     return 'DependencyJob #{0} for "{1}" in "{2}"'.format( self.pk, self.dependency.pk, self.dependency.site.pk )
 
 
+# not exposed to CInP, the tasks the Foreman worker (lib/util/foremanWorker) has prepared for subcontractor, waiting to be
+# picked up by Dispatch.getJobs, only used when FOREMAN_EXTERNAL_WORKER is True, see Foreman.lib.prepareTasks and takeTasks
+class PreparedTask( models.Model ):
+  job = models.OneToOneField( BaseJob, primary_key=True, on_delete=models.CASCADE )
+  site = models.ForeignKey( Site, on_delete=models.CASCADE )
+  module = models.CharField( max_length=50 )
+  task = JSONField()
+  created = models.DateTimeField( editable=False, auto_now_add=True )
+
+  @classmethod
+  def prepare( cls, job, task ):
+    cls.objects.update_or_create( job_id=job.pk, defaults={ 'site_id': job.site_id, 'module': task[ 'module' ], 'task': task } )
+
+  @classmethod
+  def take( cls, site_id_list, module_list, count ):  # returns up to count of ( site_id, task ), oldest first, and removes them
+    task_list = list( cls.objects.select_for_update( skip_locked=True ).filter( site_id__in=site_id_list, module__in=module_list ).order_by( 'created' ).values_list( 'job_id', 'site_id', 'task' )[ 0:count ] )
+    if task_list:
+      cls.objects.filter( job_id__in=[ i[0] for i in task_list ] ).delete()
+
+    return [ ( i[1], i[2] ) for i in task_list ]
+
+  @classmethod
+  def discard( cls, job ):  # the job's dispatch was cleared out from under the prepared task (reset, rollback, clearDispatched), the worker will prepare it again
+    if getattr( settings, 'FOREMAN_EXTERNAL_WORKER', False ):
+      cls.objects.filter( job_id=job.pk ).delete()
+
+  class Meta:
+    indexes = [
+                models.Index( fields=[ 'site', 'created' ], name='foreman_preparedtask_site' )
+              ]
+
+  def __str__( self ):
+    return 'PreparedTask for job #{0}'.format( self.job_id )
+
+
 @cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE', 'CALL' ] )
 class JobLog( models.Model ):
   site = models.ForeignKey( Site, on_delete=models.CASCADE )
@@ -620,8 +969,12 @@ class JobLog( models.Model ):
 
   @classmethod
   def fromJob( cls, job, creator ):
-    job = job.realJob
+    log = cls.newFromJob( job.realJob, creator )
+    log.full_clean()
+    log.save()
 
+  @classmethod
+  def newFromJob( cls, job, creator ):  # job must be the realJob, the JobLog is not saved
     log = cls()
     log.job_id = job.pk
     if isinstance( job, StructureJob ):
@@ -647,30 +1000,36 @@ class JobLog( models.Model ):
 
     log.script_name = job.script_name
     log.creator = creator.username
-    log.full_clean()
-    log.save()
+
+    return log
+
+  # the started/finished/canceled updates are done with update(), there is nothing to validate, and
+  # this way there is one query for the whole list, not a load and a save for each job
 
   @classmethod
   def started( cls, job ):
-    log = JobLog.objects.get( job_id=job.pk )
-    log.started_at = timezone.now()
-    log.full_clean()
-    log.save()
+    cls.startedList( [ job.pk ] )
+
+  @classmethod
+  def startedList( cls, job_id_list ):
+    if job_id_list:
+      now = timezone.now()
+      cls.objects.filter( job_id__in=job_id_list ).update( started_at=now, updated=now )
 
   @classmethod
   def finished( cls, job ):
-    log = JobLog.objects.get( job_id=job.pk )
-    log.finished_at = timezone.now()
-    log.full_clean()
-    log.save()
+    cls.finishedList( [ job.pk ] )
+
+  @classmethod
+  def finishedList( cls, job_id_list ):
+    if job_id_list:
+      now = timezone.now()
+      cls.objects.filter( job_id__in=job_id_list ).update( finished_at=now, updated=now )
 
   @classmethod
   def canceled( cls, job, by ):
-    log = JobLog.objects.get( job_id=job.pk )
-    log.canceled_at = timezone.now()
-    log.canceled_by = by
-    log.full_clean()
-    log.save()
+    now = timezone.now()
+    cls.objects.filter( job_id=job.pk ).update( canceled_at=now, canceled_by=by, updated=now )
 
   @cinp.list_filter( name='site', paramater_type_list=[ { 'type': 'Model', 'model': Site } ] )
   @staticmethod
@@ -707,6 +1066,139 @@ class JobLog( models.Model ):
 
   class Meta:
     default_permissions = ( 'view', )
+    indexes = [
+                models.Index( fields=[ 'job_id' ], name='foreman_joblog_job' ),
+                models.Index( fields=[ 'site', 'target_class', 'target_id' ], name='foreman_joblog_target' ),
+                models.Index( fields=[ 'created' ], name='foreman_joblog_created' )
+              ]
+
+  def __str__( self ):
+    return 'JobLog for Job #{0} for "{1}"({2}) at "{3}"'.format( self.job_id, self.target_id, self.target_class, self.created )
+
+
+# JobLog entries older than the retention are summed up into these, one per site, day, target class and script, see Foreman.lib.rollupJobLog
+@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE', 'CALL' ] )
+class JobLogRollup( models.Model ):
+  site = models.ForeignKey( Site, on_delete=models.CASCADE )
+  day = models.DateField()
+  target_class = models.CharField( max_length=50 )
+  script_name = models.CharField( max_length=50 )
+  job_count = models.IntegerField( default=0 )
+  finished_count = models.IntegerField( default=0 )
+  canceled_count = models.IntegerField( default=0 )
+  run_seconds = models.FloatField( default=0.0 )  # total time from started to finished of the finished jobs
+  updated = models.DateTimeField( editable=False, auto_now=True )
+  created = models.DateTimeField( editable=False, auto_now_add=True )
+
+  @cinp.list_filter( name='site', paramater_type_list=[ { 'type': 'Model', 'model': Site } ] )
+  @staticmethod
+  def filter_site( site ):
+    return JobLogRollup.objects.filter( site=site )
+
+  @cinp.check_auth()
+  @staticmethod
+  def checkAuth( user, verb, id_list, action=None ):
+    return cinp.basic_auth_check( user, verb, action, JobLogRollup )
+
+  class Meta:
+    default_permissions = ( 'view', )
+    unique_together = ( ( 'site', 'day', 'target_class', 'script_name' ), )
+
+  def __str__( self ):
+    return 'JobLogRollup for "{0}" on "{1}" of "{2}"({3})'.format( self.site_id, self.day, self.script_name, self.target_class )
+
+
+# the per line Profile totals of the finished jobs, by blueprint, script and version of the script (script_hash, see
+# ParsedScript), see BaseJob.setProfile, Foreman.lib.scriptProfileReport and lib/util/tscriptProfileReport
+@cinp.model( not_allowed_verb_list=[ 'CREATE', 'UPDATE', 'DELETE', 'CALL' ] )
+class ScriptProfile( models.Model ):
+  blueprint = models.CharField( max_length=40 )  # the name of the BluePrint, it is not a foreign key, so the profile outlives changes to the blueprint
+  script_name = models.CharField( max_length=50 )
+  script_hash = models.CharField( max_length=64 )
+  line = models.IntegerField()
+  job_count = models.IntegerField( default=0 )  # number of jobs that ran the line
+  ops = models.IntegerField( default=0 )
+  seconds = models.FloatField( default=0.0 )
+  dispatch_seconds = models.FloatField( default=0.0 )
+  resumptions = models.IntegerField( default=0 )
+  updated = models.DateTimeField( editable=False, auto_now=True )
+  created = models.DateTimeField( editable=False, auto_now_add=True )
+
+  @classmethod
+  def record( cls, job, profile ):  # add the totals of a job's profile, the lines are locked while they are added to, other pollers may be finishing jobs of the same script
+    blueprint = job.blueprint
+    if blueprint is None or job.parsed_script_id is None:
+      return
+
+    line_map = dict( ( line, totals ) for line, totals in profile.line_map.items() if line is not None )
+    if not line_map:
+      return
+
+    key_map = { 'blueprint': blueprint.pk, 'script_name': job.script_name, 'script_hash': job.parsed_script_id }
+    now = timezone.now()
+    with transaction.atomic():
+      cls.objects.bulk_create( [ cls( line=line, **key_map ) for line in line_map ], ignore_conflicts=True )
+      entry_list = list( cls.objects.select_for_update().filter( line__in=list( line_map.keys() ), **key_map ).order_by( 'line' ) )
+      for entry in entry_list:
+        ( ops, seconds, dispatch_seconds, resumptions ) = line_map[ entry.line ]
+        entry.job_count += 1
+        entry.ops += ops
+        entry.seconds += seconds
+        entry.dispatch_seconds += dispatch_seconds
+        entry.resumptions += resumptions
+        entry.updated = now
+
+      cls.objects.bulk_update( entry_list, [ 'job_count', 'ops', 'seconds', 'dispatch_seconds', 'resumptions', 'updated' ] )
+
+  @cinp.list_filter( name='blueprint', paramater_type_list=[ 'String' ] )
+  @staticmethod
+  def filter_blueprint( blueprint ):
+    return ScriptProfile.objects.filter( blueprint=blueprint )
+
+  @cinp.check_auth()
+  @staticmethod
+  def checkAuth( user, verb, id_list, action=None ):
+    return cinp.basic_auth_check( user, verb, action, ScriptProfile )
+
+  class Meta:
+    default_permissions = ( 'view', )
+    unique_together = ( ( 'blueprint', 'script_name', 'script_hash', 'line' ), )
 
   def __str__( self ):
-    return 'JobLog for Job #{0} for "{1}"({2}) at "{3}"'.format( self.job_id, self.target_id, self.target_class, self.at )
+    return 'ScriptProfile for line {0} of "{1}" of "{2}" ({3})'.format( self.line, self.script_name, self.blueprint, self.script_hash[ 0:8 ] )
+
+
+# things that can make an unlocated Foundation auto locatable, see Foreman.lib._autoLocate
+def _foundation_post_save( sender, instance, **kwargs ):  # connected for Foundation and each of it's subclasses by ForemanConfig.ready
+  if instance.located_at is not None or instance.built_at is not None:
+    return
+
+  if instance.complex is not None:  # the Foundation subclasses that can be in a complex, provide complex
+    LocateRequest.request( instance.site_id )
+
+
+def _structure_post_init( sender, instance, **kwargs ):  # so _structure_post_save can tell if the structure became built/unbuilt
+  instance._loaded_built = instance.built_at is not None
+
+
+def _structure_post_save( sender, instance, update_fields=None, **kwargs ):  # the built percentage of the complexes the structure is in may of changed
+  if update_fields is not None and 'built_at' not in update_fields:
+    return
+
+  built = instance.built_at is not None
+  if built == instance._loaded_built:
+    return
+
+  instance._loaded_built = built
+  for site_id in set( ComplexStructure.objects.filter( structure=instance ).values_list( 'complex__site_id', flat=True ) ):
+    LocateRequest.request( site_id )
+
+
+def _complexstructure_change( sender, instance, **kwargs ):
+  LocateRequest.request( instance.complex.site_id )
+
+
+post_init.connect( _structure_post_init, sender=Structure )
+post_save.connect( _structure_post_save, sender=Structure )
+post_save.connect( _complexstructure_change, sender=ComplexStructure )
+post_delete.connect( _complexstructure_change, sender=ComplexStructure )
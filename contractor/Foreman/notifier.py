@@ -0,0 +1,144 @@
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+NOTIFY_CHANNEL = 'contractor_foreman'
+LISTEN_RECONNECT_DELAY = 10
+
+_condition = threading.Condition()
+_generation_map = {}  # site_id -> number of times work has been signaled for the site, waiters wait for this to change
+_listener = None
+_pending = threading.local()  # site_set: sites signaled in a transaction managed by hand, woken up by flushWork
+
+
+# The notifier lets Dispatch.getJobs (processJobs with wait_seconds) sleep until there is something for the
+# site to do.  Work is signaled by notifyWork, on commit, so the waiter does not wake up before the change is visible.
+# Within the process the waiters are woken up directly, if the database is PostgreSQL, the signal is also sent
+# with NOTIFY and a listener thread (one per process, started on the first wait) wakes up the waiters for the other
+# processes.  If the listener can not be started, waiters still wake up for local signals and at their timeout.
+# When the transaction is managed by hand (cinp's requests run with autocommit off, outside an atomic block),
+# on_commit is not available, the sites are kept untill flushWork is called after the commit.
+
+def _wakeLocal( site_id ):
+  with _condition:
+    _generation_map[ site_id ] = _generation_map.get( site_id, 0 ) + 1
+    _condition.notify_all()
+
+
+def _listen():
+  while True:
+    conn = None
+    try:
+      conn = connection.Database.connect( **connection.get_connection_params() )
+      conn.autocommit = True
+      cursor = conn.cursor()
+      cursor.execute( 'LISTEN {0};'.format( NOTIFY_CHANNEL ) )
+      logging.debug( 'foreman notifier: listening on "{0}"'.format( NOTIFY_CHANNEL ) )
+
+      while True:
+        if select.select( [ conn ], [], [], 60 ) == ( [], [], [] ):
+          continue
+
+        conn.poll()
+        while conn.notifies:
+          _wakeLocal( conn.notifies.pop( 0 ).payload )
+
+    except Exception as e:
+      logging.warning( 'foreman notifier: listener error "{0}", reconnecting in {1} seconds'.format( e, LISTEN_RECONNECT_DELAY ) )
+      if conn is not None:
+        try:
+          conn.close()
+        except Exception:
+          pass
+
+      time.sleep( LISTEN_RECONNECT_DELAY )
+
+
+def _listenEnabled():
+  return connection.vendor == 'postgresql' and getattr( settings, 'FOREMAN_NOTIFY_LISTEN', True )
+
+
+def _startListener():
+  global _listener
+
+  if _listener is not None or not _listenEnabled():
+    return
+
+  _listener = threading.Thread( target=_listen, name='foreman-notifier', daemon=True )
+  _listener.start()
+
+
+def notifyWork( site_id ):
+  """
+  Signal that there is (or may be) work for the site, ie: a job was created, results came back, a signal
+  fired, or a job was resumed.  The waiters are woken up when the current transaction commits, if the
+  transaction is managed by hand (autocommit off, outside an atomic block), call flushWork after committing.
+  """
+  site_id = str( site_id )
+
+  if _listenEnabled():  # if nothing is listening, no point in sending it
+    with connection.cursor() as cursor:
+      cursor.execute( 'SELECT pg_notify( %s, %s );', [ NOTIFY_CHANNEL, site_id ] )
+
+  conn = transaction.get_connection()
+  if conn.get_autocommit() or conn.in_atomic_block:
+    transaction.on_commit( lambda: _wakeLocal( site_id ) )
+    return
+
+  try:
+    _pending.site_set.add( site_id )
+  except AttributeError:
+    _pending.site_set = set( [ site_id ] )
+
+
+def flushWork():
+  """
+  Wake up the waiters for the work signaled in a transaction managed by hand, call after the transaction is
+  committed.  If it was rolled back instead, the waiters wake up, find nothing new, and go back to waiting.
+  """
+  site_set = getattr( _pending, 'site_set', None )
+  if not site_set:
+    return
+
+  _pending.site_set = set()
+  for site_id in site_set:
+    _wakeLocal( site_id )
+
+
+def tasksKey( site_id ):
+  """
+  The key to notify/wait on for the tasks prepared for site by the Foreman worker (see Foreman.lib.prepareTasks),
+  kept separate from the site's key so the worker is not woken up by the tasks it prepared.
+  """
+  return '{0}:tasks'.format( site_id )
+
+
+def _generation( site_id ):
+  if isinstance( site_id, ( list, tuple ) ):
+    return tuple( _generation_map.get( str( i ), 0 ) for i in site_id )
+
+  return _generation_map.get( str( site_id ), 0 )
+
+
+def workGeneration( site_id ):
+  """
+  Returns a value for waitForWork to compare against, get this before looking for work so
+  work signaled while looking is not missed.  site_id can also be a list of site ids.
+  """
+  with _condition:
+    return _generation( site_id )
+
+
+def waitForWork( site_id, generation, timeout ):
+  """
+  Wait up to timeout seconds for work to be signaled for site (or any of the sites if site_id is a list),
+  returns True if work was signaled since generation was retrieved with workGeneration.
+  """
+  _startListener()
+
+  with _condition:
+    return _condition.wait_for( lambda: _generation( site_id ) != generation, timeout )
@@ -0,0 +1,184 @@
+from django.db.models import Q
+
+from contractor.Building.models import Structure, Dependency
+from contractor.Foreman.models import FoundationJob, StructureJob, DependencyJob
+
+# Works out which waiting jobs can start, the same rules as the job's can_start, but for a batch of jobs.  The
+# targets of the jobs (and what select_related loaded with them, see Foreman.lib._realJobs) are used as is, the
+# rest of the dependency edges the jobs need (the Foundation's Dependency and Structure, the Dependencies on a
+# Structure/Dependency, and which of those have jobs) are loaded in a handfull of queries for the whole batch,
+# instead of walking the edges job by job.
+
+
+def _blocked( type, id, state, needed ):
+  return '{0} "{1}" is {2}, needs to be {3}'.format( type, id, state, needed )
+
+
+def _hasJob( type, id ):
+  return '{0} "{1}" has a job'.format( type, id )
+
+
+def planStart( job_list ):
+  """
+  Returns a dict of job id -> None if the job can start, otherwise the reason it can not, for each job in job_list.
+  """
+  foundation_id_list = []   # the Dependency and Structure on these Foundations are needed
+  structure_id_list = []    # the Dependencies on these Structures are needed
+  dependency_id_list = []   # the Dependencies on these Dependencies are needed
+  dep_foundation_id_list = []  # the Foundations the Dependencies are for
+  for job in job_list:
+    if isinstance( job, FoundationJob ):
+      foundation_id_list.append( job.foundation_id )
+
+    elif isinstance( job, StructureJob ) and job.script_name == 'destroy':
+      structure_id_list.append( job.structure_id )
+
+    elif isinstance( job, DependencyJob ) and job.script_name == 'destroy':
+      if job.dependency.foundation_id is not None:
+        dep_foundation_id_list.append( job.dependency.foundation_id )
+      else:
+        dependency_id_list.append( job.dependency_id )
+
+  foundation_dependency_map = {}  # foundation_id -> ( dependency id, built_at )
+  structure_dependency_map = {}  # structure_id -> [ ( dependency id, built_at ) ]
+  dependency_dependency_map = {}  # dependency_id -> [ ( dependency id, built_at ) ]
+  if foundation_id_list or structure_id_list or dependency_id_list:
+    queryset = Dependency.objects.filter( Q( foundation_id__in=foundation_id_list ) | Q( structure_id__in=structure_id_list ) | Q( dependency_id__in=dependency_id_list ) )
+    for pk, foundation_id, structure_id, dependency_id, built_at in queryset.values_list( 'pk', 'foundation_id', 'structure_id', 'dependency_id', 'built_at' ):
+      if foundation_id in foundation_id_list:
+        foundation_dependency_map[ foundation_id ] = ( pk, built_at )
+
+      if structure_id in structure_id_list:
+        structure_dependency_map.setdefault( structure_id, [] ).append( ( pk, built_at ) )
+
+      if dependency_id in dependency_id_list:
+        dependency_dependency_map.setdefault( dependency_id, [] ).append( ( pk, built_at ) )
+
+  foundation_structure_map = {}  # foundation_id -> ( structure id, built_at )
+  if foundation_id_list:
+    for pk, foundation_id, built_at in Structure.objects.filter( foundation_id__in=foundation_id_list ).values_list( 'pk', 'foundation_id', 'built_at' ):
+      foundation_structure_map[ foundation_id ] = ( pk, built_at )
+
+  # which of the things the jobs are waiting on have jobs of their own
+  check_structure_id_list = [ i[0] for i in foundation_structure_map.values() ]
+  check_dependency_id_list = [ pk for dependency_list in structure_dependency_map.values() for pk, _ in dependency_list ]
+  structure_job_set = set( StructureJob.objects.filter( structure_id__in=check_structure_id_list ).values_list( 'structure_id', flat=True ) ) if check_structure_id_list else set()
+  dependency_job_set = set( DependencyJob.objects.filter( dependency_id__in=check_dependency_id_list ).values_list( 'dependency_id', flat=True ) ) if check_dependency_id_list else set()
+  foundation_job_set = set( FoundationJob.objects.filter( foundation_id__in=dep_foundation_id_list ).values_list( 'foundation_id', flat=True ) ) if dep_foundation_id_list else set()
+
+  result = {}
+  for job in job_list:
+    if isinstance( job, FoundationJob ):
+      result[ job.pk ] = _foundationPlan( job, foundation_dependency_map, foundation_structure_map, structure_job_set )
+
+    elif isinstance( job, StructureJob ):
+      result[ job.pk ] = _structurePlan( job, structure_dependency_map, dependency_job_set )
+
+    elif isinstance( job, DependencyJob ):
+      result[ job.pk ] = _dependencyPlan( job, dependency_dependency_map, foundation_job_set )
+
+    else:
+      result[ job.pk ] = 'Unknown job type'
+
+  return result
+
+
+def _foundationPlan( job, foundation_dependency_map, foundation_structure_map, structure_job_set ):
+  foundation = job.foundation
+  if job.script_name == 'create':
+    if foundation.state != 'located':
+      return _blocked( 'Foundation', foundation.dependencyId, foundation.state, 'located' )
+
+    try:
+      ( dependency_id, built_at ) = foundation_dependency_map[ foundation.pk ]
+    except KeyError:
+      return None
+
+    if built_at is None:
+      return _blocked( 'Dependency', 'd-{0}'.format( dependency_id ), 'planned', 'built' )
+
+    return None
+
+  elif job.script_name == 'destroy':
+    if foundation.state != 'built':
+      return _blocked( 'Foundation', foundation.dependencyId, foundation.state, 'built' )
+
+    try:
+      ( structure_id, built_at ) = foundation_structure_map[ foundation.pk ]
+    except KeyError:
+      return None
+
+    if built_at is not None:
+      return _blocked( 'Structure', 's-{0}'.format( structure_id ), 'built', 'planned' )
+
+    if structure_id in structure_job_set:
+      return _hasJob( 'Structure', 's-{0}'.format( structure_id ) )
+
+    return None
+
+  return None
+
+
+def _structurePlan( job, structure_dependency_map, dependency_job_set ):
+  structure = job.structure
+  if job.script_name == 'create':
+    if structure.state != 'planned':
+      return _blocked( 'Structure', structure.dependencyId, structure.state, 'planned' )
+
+    if structure.foundation.state != 'built':
+      return _blocked( 'Foundation', structure.foundation.dependencyId, structure.foundation.state, 'built' )
+
+    return None
+
+  elif job.script_name == 'destroy':
+    if structure.state != 'built':
+      return _blocked( 'Structure', structure.dependencyId, structure.state, 'built' )
+
+    for dependency_id, built_at in structure_dependency_map.get( structure.pk, [] ):
+      if built_at is not None:
+        return _blocked( 'Dependency', 'd-{0}'.format( dependency_id ), 'built', 'planned' )
+
+      if dependency_id in dependency_job_set:
+        return _hasJob( 'Dependency', 'd-{0}'.format( dependency_id ) )
+
+    return None
+
+  return None
+
+
+def _dependencyPlan( job, dependency_dependency_map, foundation_job_set ):
+  dependency = job.dependency
+  if job.script_name == 'create':
+    if dependency.state != 'planned':
+      return _blocked( 'Dependency', dependency.dependencyId, dependency.state, 'planned' )
+
+    if dependency.structure_id is not None:
+      target = ( 'Structure', dependency.structure )
+    else:
+      target = ( 'Dependency', dependency.dependency )
+
+    if target[1].state != 'built':
+      return _blocked( target[0], target[1].dependencyId, target[1].state, 'built' )
+
+    return None
+
+  elif job.script_name == 'destroy':
+    if dependency.state != 'built':
+      return _blocked( 'Dependency', dependency.dependencyId, dependency.state, 'built' )
+
+    if dependency.foundation_id is not None:
+      if dependency.foundation.state != 'planned':
+        return _blocked( 'Foundation', dependency.foundation.dependencyId, dependency.foundation.state, 'planned' )
+
+      if dependency.foundation_id in foundation_job_set:
+        return _hasJob( 'Foundation', dependency.foundation.dependencyId )
+
+      return None
+
+    for dependency_id, built_at in dependency_dependency_map.get( dependency.pk, [] ):
+      if built_at is not None:
+        return _blocked( 'Dependency', 'd-{0}'.format( dependency_id ), 'built', 'planned' )
+
+    return None
+
+  return None
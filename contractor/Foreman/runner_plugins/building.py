@@ -1,11 +1,20 @@
+import copy
+import threading
+
 from contractor.fields import config_name_regex
 from contractor.lib.config import getConfig
-from contractor.tscript.runner import ParamaterError, Interrupt
+from contractor.tscript.runner import ParamaterError, WaitForSignal
+
+# set_config's changes during the current run of the runner in this thread, see ConfigPlugin.getConfig
+_config_changed = threading.local()
 
 
-def getWrapper( target, key ):  # TODO: find a way to make this less expensive, mabey something that can detect if the target has changed, without calling getConfig
-  config = getConfig( target )
-  return config[ key ]
+def _configChangedMap():  # ( class name, pk ) -> updated of the target after the last time set_config changed it
+  try:
+    return _config_changed.target_map
+  except AttributeError:
+    result = _config_changed.target_map = {}
+    return result
 
 
 class SetConfig( object ):
@@ -45,7 +54,58 @@ class SetConfig( object ):
     config_values[ name ] = value
 
     self.structure.full_clean()
-    self.structure.save( update_fields=[ 'config_values' ] )
+    self.structure.save( update_fields=[ 'config_values', 'updated' ] )  # updated is part of the config's __last_modified
+    _configChangedMap()[ ( self.structure.__class__.__name__, self.structure.pk ) ] = self.structure.updated
+
+
+class ConfigValueMap( dict ):  # the config keys are not known untill getConfig is called, which is expensive, so wait untill something asks for them
+  def __init__( self, plugin ):
+    super().__init__()
+    self.plugin = plugin
+    self.loaded = False
+
+  def load( self ):
+    if self.loaded:
+      return
+
+    self.loaded = True
+    for name in self.plugin.getConfig():
+      super().__setitem__( name, ( lambda name=name: copy.deepcopy( self.plugin.getConfig()[ name ] ), None ) )  # a copy, so nothing can change the snapshot
+
+  def __missing__( self, key ):
+    if self.loaded:
+      raise KeyError( key )
+
+    self.load()
+    return self[ key ]
+
+  def __contains__( self, key ):
+    self.load()
+    return super().__contains__( key )
+
+  def __iter__( self ):
+    self.load()
+    return super().__iter__()
+
+  def __len__( self ):
+    self.load()
+    return super().__len__()
+
+  def get( self, key, default=None ):
+    self.load()
+    return super().get( key, default )
+
+  def keys( self ):
+    self.load()
+    return super().keys()
+
+  def values( self ):
+    self.load()
+    return super().values()
+
+  def items( self ):
+    self.load()
+    return super().items()
 
 
 class ConfigPlugin( object ):
@@ -56,20 +116,44 @@ class ConfigPlugin( object ):
     if isinstance( target, tuple ):
       self.target_class = target[0]
       self.target_pk = target[1]
-      self.target = self.target_class.objects.get( pk=self.target_pk )
+      self._target = None  # loaded when first used, so unpickling the runner dosen't cost a query for each plugin
 
     else:
-      self.target = target.subclass
-      self.target_class = self.target.__class__
-      self.target_pk = self.target.pk
+      self._target = target.subclass
+      self.target_class = self._target.__class__
+      self.target_pk = self._target.pk
 
-  def getValues( self ):
-    config = getConfig( self.target )
-    result = {}
-    for key in config:
-      result[ key ] = ( lambda key=key: getWrapper( self.target, key ), None )
+    self._config = None  # the config of the target for this run of the runner, see getConfig
 
-    return result
+  @property
+  def target( self ):
+    if self._target is None:
+      self._target = self.target_class.objects.get( pk=self.target_pk )
+
+    return self._target
+
+  def getConfig( self ):
+    """
+    Returns the config of the target, getConfig is expensive, so it is called once a run of the runner,
+    and again only if set_config has changed the target since (ie: is newer than the config's __last_modified).
+    """
+    if self._config is not None:
+      changed = _configChangedMap().get( ( self.target_class.__name__, self.target_pk ) )
+      if changed is None or changed <= self._config[ '__last_modified' ]:
+        return self._config
+
+      self._target = None  # set_config saved a diffrent instance of the target
+
+    self._config = getConfig( self.target )
+    return self._config
+
+  def startRun( self ):  # see Runner.run, the target could of changed since the last run
+    self._target = None
+    self._config = None
+    _configChangedMap().clear()  # the configs are all reloaded this run, so the earlier changes no longer matter
+
+  def getValues( self ):
+    return ConfigValueMap( self )
 
   def getFunctions( self ):
     result = {}
@@ -90,16 +174,23 @@ class FoundationPlugin( object ):  # TODO: really should have the RO version be
     if isinstance( foundation, tuple ):
       self.foundation_class = foundation[0]
       self.foundation_pk = foundation[1]
-      self.foundation = self.foundation_class.objects.get( pk=self.foundation_pk )
+      self._foundation = None  # loaded when first used
 
     else:
-      self.foundation = foundation.subclass
-      self.foundation_class = self.foundation.__class__
-      self.foundation_pk = self.foundation.pk
+      self._foundation = foundation.subclass
+      self.foundation_class = self._foundation.__class__
+      self.foundation_pk = self._foundation.pk
 
     self.value_map = self.foundation_class.getTscriptValues( write )
     self.function_map = self.foundation_class.getTscriptFunctions()
 
+  @property
+  def foundation( self ):
+    if self._foundation is None:
+      self._foundation = self.foundation_class.objects.get( pk=self.foundation_pk )
+
+    return self._foundation
+
   def _setValue( self, name, val ):
     setter = self.value_map[ name ][1]
     setter( self.foundation, val )
@@ -153,12 +244,19 @@ class StructurePlugin( object ):  # ie: structure with some settable attributes,
     if isinstance( structure, tuple ):
       self.structure_class = structure[0]
       self.structure_pk = structure[1]
-      self.structure = self.structure_class.objects.get( pk=self.structure_pk )
+      self._structure = None  # loaded when first used
 
     else:
-      self.structure = structure
-      self.structure_class = self.structure.__class__
-      self.structure_pk = self.structure.pk
+      self._structure = structure
+      self.structure_class = self._structure.__class__
+      self.structure_pk = self._structure.pk
+
+  @property
+  def structure( self ):
+    if self._structure is None:
+      self._structure = self.structure_class.objects.get( pk=self.structure_pk )
+
+    return self._structure
 
   def getValues( self ):
     result = {}
@@ -238,7 +336,7 @@ class SignalingPlugin( object ):
 
   def waitForCompletion( self ):
     if not self.complete:
-      raise Interrupt( 'Waiting for Complete Signal' )
+      raise WaitForSignal( 'Waiting for Complete Signal' )
 
   def signal( self, cookie ):
     if cookie != '{0}({1})'.format( self.cookie, self.pxe_name ):
@@ -1,12 +1,20 @@
 import pytest
 
-from contractor.Foreman.runner_plugins.building import SetConfig
-from contractor.tscript.runner import ParamaterError
+from contractor.Foreman.runner_plugins import building
+from contractor.Foreman.runner_plugins.building import SetConfig, ConfigPlugin, StructurePlugin
+from contractor.lib.config import getConfig
+from contractor.tscript.parser import parse
+from contractor.tscript.runner import Runner, ParamaterError
+from contractor.Site.models import Site
+from contractor.BluePrint.models import FoundationBluePrint, StructureBluePrint
+from contractor.Building.models import Foundation, Structure
 
 
 class fakeStructure():
   def __init__( self, config_map ):
     self.config_values = config_map
+    self.pk = 1
+    self.updated = None
 
   def full_clean( self ):
     pass
@@ -88,3 +96,69 @@ def test_setconfig():
   sc = SetConfig( s )
   sc( 'a.a|d', 4 )
   assert s.config_values == { 'a': { 'a|d': 4 }, 'b': 10 }
+
+
+@pytest.mark.django_db()
+def test_config_snapshot( mocker ):
+  si = Site( name='test', description='test' )
+  si.full_clean()
+  si.save()
+
+  fb = FoundationBluePrint( name='fdnb1', description='Foundation BluePrint 1' )
+  fb.foundation_type_list = [ 'Unknown' ]
+  fb.full_clean()
+  fb.save()
+
+  sb = StructureBluePrint( name='strb1', description='Structure BluePrint 1' )
+  sb.full_clean()
+  sb.save()
+  sb.foundation_blueprint_list.add( fb )
+
+  f = Foundation( site=si, blueprint=fb, locator='test' )
+  f.full_clean()
+  f.save()
+
+  s = Structure( site=si, blueprint=sb, foundation=f, hostname='test', config_values={ 'aa': 1 } )
+  s.full_clean()
+  s.save()
+
+  get_config = mocker.patch( 'contractor.Foreman.runner_plugins.building.getConfig', side_effect=getConfig )
+
+  runner = Runner( parse( 'cnt = 0\ntotal = 0\nwhile ( cnt < 10 ) do\nbegin()\n  cnt = ( cnt + 1 )\n  total = ( total + config.aa )\nend\nbb = config.aa' ) )
+  runner.registerObject( ConfigPlugin( s ) )
+  assert runner.run() == ''
+  assert runner.variable_map[ 'total' ] == 10
+  assert runner.variable_map[ 'bb' ] == 1
+  assert get_config.call_count == 1
+
+  # set_config changes the config, the snapshot is rebuilt
+  runner = Runner( parse( 'aa = config.aa\nstructure.set_config( name=\'aa\', value=5 )\nbb = config.aa\ncc = config.aa' ) )
+  runner.registerObject( ConfigPlugin( s ) )
+  runner.registerObject( StructurePlugin( s ) )
+  get_config.reset_mock()
+  assert runner.run() == ''
+  assert ( runner.variable_map[ 'aa' ], runner.variable_map[ 'bb' ], runner.variable_map[ 'cc' ] ) == ( 1, 5, 5 )
+  assert get_config.call_count == 2
+  assert list( building._configChangedMap().keys() ) == [ ( 'Structure', s.pk ) ]
+
+  # changes made outside the runner are picked up on the next run
+  s = Structure.objects.get( pk=s.pk )
+  s.config_values = { 'aa': 7 }
+  s.full_clean()
+  s.save()
+
+  runner = Runner( parse( 'aa = config.aa\ntesting.remote()\nbb = config.aa' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  runner.registerObject( ConfigPlugin( ( Structure, s.pk ) ) )
+  get_config.reset_mock()
+  assert runner.run() == 'Not Initilized'
+  assert runner.variable_map[ 'aa' ] == 7
+  assert get_config.call_count == 1
+  assert building._configChangedMap() == {}  # the set_config of the last run is not kept around
+
+  Structure.objects.filter( pk=s.pk ).update( config_values={ 'aa': 9 } )
+  runner.toSubcontractor( [ 'testing' ] )
+  runner.fromSubcontractor( runner.contractor_cookie, 'stuff' )
+  assert runner.run() == ''
+  assert ( runner.variable_map[ 'aa' ], runner.variable_map[ 'bb' ] ) == ( 7, 9 )
+  assert get_config.call_count == 2
@@ -0,0 +1,72 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from django.db import connection
+
+# Counters and timings for the Foreman job loop (processJobs), these are for this process only, and are since
+# the process started (or was reset).  Names ending in "_seconds" are accumulated wall time, "_queries" are
+# accumulated DB query counts, "_max" are the largest value seen, everything else is a count/total.
+
+
+class Stats():
+  def __init__( self ):
+    super().__init__()
+    self._lock = threading.Lock()
+    self._value_map = {}
+    self._started = time.time()
+
+  def add( self, name, value=1 ):
+    with self._lock:
+      self._value_map[ name ] = self._value_map.get( name, 0 ) + value
+
+  def max( self, name, value ):
+    with self._lock:
+      if value > self._value_map.get( name, 0 ):
+        self._value_map[ name ] = value
+
+  @contextmanager
+  def timer( self, name ):
+    """
+    Time the block, adds to "<name>_seconds", "<name>_queries" and "<name>_count".
+    """
+    query_count = [ 0 ]
+
+    def _counter( execute, sql, params, many, context ):
+      query_count[0] += 1
+      return execute( sql, params, many, context )
+
+    start = time.perf_counter()
+    try:
+      with connection.execute_wrapper( _counter ):
+        yield
+
+    finally:
+      elapsed = time.perf_counter() - start
+      with self._lock:
+        self._value_map[ name + '_seconds' ] = self._value_map.get( name + '_seconds', 0 ) + elapsed
+        self._value_map[ name + '_queries' ] = self._value_map.get( name + '_queries', 0 ) + query_count[0]
+        self._value_map[ name + '_count' ] = self._value_map.get( name + '_count', 0 ) + 1
+
+  def snapshot( self, reset=False ):
+    with self._lock:
+      result = dict( self._value_map )
+      result[ 'since' ] = self._started
+      if reset:
+        self._value_map = {}
+        self._started = time.time()
+
+    return result
+
+  def reset( self ):
+    self.snapshot( reset=True )
+
+
+foreman_stats = Stats()
+
+
+def metricsText( value_map, prefix='contractor_foreman_' ):
+  """
+  Render a snapshot as plain text, one "<prefix><name> <value>" per line, sorted by name.
+  """
+  return ''.join( '{0}{1} {2}\n'.format( prefix, name, value_map[ name ] ) for name in sorted( value_map.keys() ) )
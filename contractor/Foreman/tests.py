@@ -2,23 +2,53 @@ import pytest
 import pickle
 import time
 import threading
+from datetime import timedelta
 
-from django.db import transaction
+from django.db import transaction, connection, DataError
+from django.db.models import ProtectedError
+from django.utils import timezone
+from django.core.exceptions import ValidationError
+from django.test.utils import CaptureQueriesContext
 
 from contractor.tscript.parser import parse
-from contractor.tscript.runner import Runner
-from contractor.Site.models import Site
-from contractor.Foreman.models import BaseJob  # , FoundationJob, StructureJob, DependencyJob
-from contractor.Building.models import Foundation, Structure, Dependency
-from contractor.BluePrint.models import StructureBluePrint, FoundationBluePrint  # , BluePrintScript, Script
+from contractor.tscript.runner import Runner, Profile, DISPATCH_LEASE_DEFAULT
+from contractor.Site.models import Site, SiteException
+from contractor.Foreman.models import BaseJob, FoundationJob, StructureJob, DependencyJob, JobLog, JobLogRollup, ParsedScript, LocateRequest, PreparedTask, Stats, ForemanException, ScriptProfile
+from contractor.Foreman.runner_plugins.building import SignalingPlugin
+from contractor.Building.models import Foundation, Structure, Dependency, Complex, ComplexStructure
+from contractor.BluePrint.models import StructureBluePrint, FoundationBluePrint, Script  # , BluePrintScript
 
-from contractor.Foreman.lib import processJobs, jobResults, createJob
+from contractor.Foreman.lib import processJobs, processJobsPage, processJobsMulti, jobResults, jobResultsBatch, createJob, createJobs, _claimJobs, _fairOrder, _fairShare, _runQueuedJobs, _auto_locate_sweep_map, rollupJobLog, cleanParsedScripts, prepareTasks, siteShard, scriptProfileReport
+from contractor.Foreman import lib
+from contractor.Foreman.notifier import notifyWork, flushWork, workGeneration, waitForWork, tasksKey
+from contractor.Foreman.planner import planStart
+from contractor.Foreman.stats import foreman_stats
+from contractor.Foreman.benchmark import runBenchmark, buildSite, removeSite
 
 
 class TestUser():
   username = 'tester'
 
 
+def _queuedJob( site, script, priority=None, script_name='test' ):
+  """
+  A queued BaseJob for site running script, with the tscript testing module.
+  """
+  runner = Runner( parse( script ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  job = BaseJob( site=site )
+  job.state = 'queued'
+  job.script_name = script_name
+  if priority is not None:
+    job.priority = priority
+
+  job.storeRunner( runner )
+  job.full_clean()
+  job.save()
+
+  return job
+
+
 def _stripcookie( item_list ):
   for item in item_list:
     cookie = item[ 'cookie' ]
@@ -60,6 +90,8 @@ def _do_processJobs( site, module_list, count ):
     while not _process_jobs_can_finish:
       time.sleep( 0.1 )
 
+  connection.close()
+
 
 def fake_canSetState( self, job=None ):
   return True
@@ -112,6 +144,151 @@ def test_job_saving_loading( mocker ):
   job.save()
 
 
+@pytest.mark.django_db
+def test_job_parsed_script():
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  script = 'begin( expected_time=0:10, max_time=0:10 )\nvar = ( 1 + 2 )\ntesting.remote()\nend'
+  job_list = []
+  for _ in range( 0, 3 ):
+    runner = Runner( parse( script ) )
+    runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+    job = BaseJob( site=s )
+    job.state = 'queued'
+    job.script_name = 'test'
+    job.parsed_script = ParsedScript.fromAST( runner.ast, script )
+    job.storeRunner( runner )
+    job.full_clean()
+    job.save()
+    job_list.append( job )
+
+  assert ParsedScript.objects.count() == 1
+  assert len( set( [ job.script_runner for job in job_list ] ) ) == 1
+  assert len( job_list[0].script_runner ) < len( pickle.dumps( Runner( parse( script ) ) ) )
+
+  job = BaseJob.objects.get( pk=job_list[0].pk )
+  runner = job.loadRunner()
+  assert runner.ast == parse( script )
+  runner.run()
+  runner.toSubcontractor( [ 'testing' ] )
+  job.storeRunner( runner )
+  job.full_clean()
+  job.save()
+
+  job = BaseJob.objects.get( pk=job_list[0].pk )
+  runner = job.loadRunner()
+  assert runner.variable_map == { 'var': 3 }
+  assert runner.state[2][1][ 'dispatched' ] is True
+
+  # jobs saved with the whole runner pickled still load, and are moved to the ParsedScript table when saved
+  runner = Runner( parse( script ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  job = BaseJob( site=s )
+  job.state = 'queued'
+  job.script_name = 'test'
+  job.script_runner = pickle.dumps( runner )
+  job.full_clean()
+  job.save()
+
+  job = BaseJob.objects.get( pk=job.pk )
+  assert job.parsed_script is None
+  runner = job.loadRunner()
+  assert runner.ast == parse( script )
+  runner.run()
+  job.storeRunner( runner )
+  job.full_clean()
+  job.save()
+
+  job = BaseJob.objects.get( pk=job.pk )
+  assert job.parsed_script is not None
+  assert job.loadRunner().variable_map == { 'var': 3 }
+
+
+@pytest.mark.django_db()
+def test_clean_parsed_scripts():
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  used = ParsedScript.fromAST( parse( 'aa = 1' ), 'aa = 1' )
+  unused = ParsedScript.fromAST( parse( 'aa = 2' ), 'aa = 2' )
+  recent = ParsedScript.fromAST( parse( 'aa = 3' ), 'aa = 3' )
+  job = BaseJob( site=s, state='queued', script_name='test', script_runner=b'', parsed_script=used )
+  job.full_clean()
+  job.save()
+
+  old = timezone.now() - timedelta( days=10 )
+  ParsedScript.objects.filter( pk__in=[ used.pk, unused.pk ] ).update( last_used=old )
+  assert cleanParsedScripts( timezone.now() - timedelta( days=7 ) ) == 1
+  assert sorted( ParsedScript.objects.values_list( 'pk', flat=True ) ) == sorted( [ used.pk, recent.pk ] )
+
+  # using it again keeps it around
+  job.delete()
+  ParsedScript.fromAST( parse( 'aa = 1' ), 'aa = 1' )
+  assert ParsedScript.objects.get( pk=used.pk ).last_used > old
+  assert cleanParsedScripts( timezone.now() - timedelta( days=7 ) ) == 0
+
+  assert cleanParsedScripts( timezone.now() + timedelta( days=1 ) ) == 2
+  assert ParsedScript.objects.count() == 0
+
+
+@pytest.mark.timeout( 60, method='thread' )
+@pytest.mark.django_db( transaction=True )
+def test_clean_parsed_scripts_concurrent():
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  old = timezone.now() - timedelta( days=10 )
+  before = timezone.now() - timedelta( days=7 )
+  result_list = []
+
+  def _clean( hold ):
+    try:
+      with transaction.atomic():
+        result_list.append( cleanParsedScripts( before ) )
+        time.sleep( hold )
+    except Exception as e:
+      result_list.append( e )
+
+    connection.close()
+
+  # a job is started with the script while the cron job is removing it, the cron job waits, and leaves it
+  script_hash = ParsedScript.fromAST( parse( 'aa = 1' ), 'aa = 1' ).pk
+  ParsedScript.objects.filter( pk=script_hash ).update( last_used=old )
+  t = threading.Thread( target=_clean, args=( 0, ) )
+  with transaction.atomic():
+    parsed_script = ParsedScript.fromAST( parse( 'aa = 1' ), 'aa = 1' )
+    job = BaseJob( site=s, state='queued', script_name='test', script_runner=b'', parsed_script=parsed_script )
+    job.full_clean()
+    job.save()
+    t.start()
+    time.sleep( 1 )  # the cron job is now waiting on the script
+
+  t.join()
+  assert result_list == [ 0 ]
+  assert BaseJob.objects.get( pk=job.pk ).parsed_script_id == script_hash
+
+  # the cron job removes the script first, the job puts it back
+  job.delete()
+  ParsedScript.objects.filter( pk=script_hash ).update( last_used=old )
+  result_list = []
+  t = threading.Thread( target=_clean, args=( 1, ) )
+  t.start()
+  time.sleep( 0.5 )  # the cron job has removed it, and not committed yet
+  with transaction.atomic():
+    parsed_script = ParsedScript.fromAST( parse( 'aa = 1' ), 'aa = 1' )
+    job = BaseJob( site=s, state='queued', script_name='test', script_runner=b'', parsed_script=parsed_script )
+    job.full_clean()
+    job.save()
+
+  t.join()
+  assert result_list == [ 1 ]
+  assert BaseJob.objects.get( pk=job.pk ).parsed_script.last_used > old
+
+
 @pytest.mark.timeout( 60, method='thread' )
 @pytest.mark.django_db( transaction=True )
 def test_job_locking( mocker ):
@@ -178,7 +355,7 @@ def test_job_locking( mocker ):
 
   with transaction.atomic():
     cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
-    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "4"'}]
+    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "3"'}]
 
   with transaction.atomic():
     j = BaseJob.objects.get()
@@ -214,7 +391,7 @@ def test_job_locking( mocker ):
   # now we test intrupting the job checking with results, first during a slow toSubcontractor
   with transaction.atomic():
     cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
-    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "5"'}]
+    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "4"'}]
 
   with transaction.atomic():
     j = BaseJob.objects.get()
@@ -256,12 +433,15 @@ def test_job_locking( mocker ):
   # then just before the transaction commits
   with transaction.atomic():
     cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
-    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "7"'}]
+    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "5"'}]
 
   with transaction.atomic():
     j = BaseJob.objects.get()
     assert j.state == 'queued'
     assert j.jobRunnerState()[ 'state' ][2][1][ 'dispatched' ] is True
+    assert j.waiting_on == 'dispatch'
+
+  BaseJob.objects.filter( pk=job_id ).update( waiting_on='', wake_at=None )  # otherwise processJobs will not pick up the job while it is dispatched
 
   _to_can_continue = True
   _process_jobs_can_finish = False
@@ -310,7 +490,7 @@ def test_job_locking( mocker ):
   # and finish up the job
   with transaction.atomic():
     cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
-    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "9"'}]
+    assert rc == [{'function': 'remote_func', 'job_id': job_id, 'module': 'testing', 'paramaters': 'the fake count "7"'}]
 
   with transaction.atomic():
     jobResults( job_id, cookie, 'adf' )
@@ -324,6 +504,841 @@ def test_job_locking( mocker ):
     assert j.jobRunnerState() == {'cur_line': None, 'state': 'DONE'}
 
 
+@pytest.mark.timeout( 60, method='thread' )
+@pytest.mark.django_db( transaction=True )
+def test_job_leasing( mocker ):
+  global _to_can_continue, _process_jobs_can_finish
+
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  with transaction.atomic():
+    s = Site( name='test', description='test' )
+    s.full_clean()
+    s.save()
+
+    job_id_list = []
+    for _ in range( 0, 2 ):
+      job = _queuedJob( s, 'testing.remote()' )
+      job_id_list.append( job.pk )
+
+  # a leased job is passed over by the other pollers, untill the lease expires
+  with transaction.atomic():
+    assert [ job.pk for job in _claimJobs( [ s ], 1, [] ) ] == [ job_id_list[0] ]
+
+  assert BaseJob.objects.get( pk=job_id_list[0] ).lease_expires is not None
+
+  with transaction.atomic():
+    rc = processJobs( s, [ 'testing' ], 10 )
+    assert [ i[ 'job_id' ] for i in rc ] == [ job_id_list[1] ]
+
+  assert BaseJob.objects.get( pk=job_id_list[1] ).lease_expires is None
+
+  BaseJob.objects.filter( pk=job_id_list[0] ).update( lease_expires=timezone.now() - timedelta( seconds=1 ) )
+
+  with transaction.atomic():
+    rc = processJobs( s, [ 'testing' ], 10 )
+    assert [ i[ 'job_id' ] for i in rc ] == [ job_id_list[0] ]
+
+  assert BaseJob.objects.get( pk=job_id_list[0] ).lease_expires is None
+
+  for job in BaseJob.objects.all().order_by( 'pk' ):
+    job.clearDispatched()
+
+  # a poller that has not finished with it's jobs does not hold up the other pollers
+  _to_can_continue = True
+  _process_jobs_can_finish = False
+  t = threading.Thread( target=_do_processJobs, args=( s, [ 'testing' ], 1 ) )
+  try:
+    t.start()
+    time.sleep( 0.5 )
+
+    with transaction.atomic():
+      rc = processJobs( s, [ 'testing' ], 10 )
+      assert [ i[ 'job_id' ] for i in rc ] == [ job_id_list[1] ]
+
+    _process_jobs_can_finish = True
+    t.join()
+
+  except Exception as e:
+    _process_jobs_can_finish = True
+    t.join()
+    raise e
+
+  assert [ i[ 'job_id' ] for i in _process_job_results ] == [ job_id_list[0] ]
+
+
+@pytest.mark.django_db()
+def test_job_write_on_change():
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job_id_map = {}
+  for name, script in ( ( 'stuck', 'testing.count( count_by=0, stop_at=1 )' ), ( 'counting', 'testing.count( count_by=1, stop_at=3 )' ) ):
+    job = _queuedJob( s, script )
+    job_id_map[ name ] = job.pk
+
+  def _jobUpdates():
+    with CaptureQueriesContext( connection ) as ctx:
+      assert processJobs( s, [ 'testing' ], 10 ) == []
+
+    result = []
+    for query in ctx.captured_queries:
+      if query[ 'sql' ].startswith( 'UPDATE "Foreman_basejob" SET' ) and '"script_runner"' in query[ 'sql' ]:
+        result.append( int( query[ 'sql' ].split( '"id" = ' )[1] ) )
+
+    return result
+
+  assert _jobUpdates() == [ job_id_map[ 'stuck' ], job_id_map[ 'counting' ] ]  # both start running
+  stuck_updated = BaseJob.objects.get( pk=job_id_map[ 'stuck' ] ).updated
+  assert BaseJob.objects.get( pk=job_id_map[ 'stuck' ] ).message == 'at 0 of 1'
+
+  assert BaseJob.objects.get( pk=job_id_map[ 'counting' ] ).message == 'at 1 of 3'
+
+  assert _jobUpdates() == [ job_id_map[ 'counting' ] ]
+  assert BaseJob.objects.get( pk=job_id_map[ 'counting' ] ).message == 'at 2 of 3'
+  assert _jobUpdates() == [ job_id_map[ 'counting' ] ]
+  assert _jobUpdates() == [ job_id_map[ 'counting' ] ]  # finishes the script
+  assert _jobUpdates() == []
+
+  job = BaseJob.objects.get( pk=job_id_map[ 'stuck' ] )
+  assert job.updated == stuck_updated
+  assert job.lease_expires is None
+  assert job.loadRunner().state[2][1][ 'handler' ].counter == 0
+
+  job = BaseJob.objects.get( pk=job_id_map[ 'counting' ] )
+  assert job.state == 'done'  # only the state was saved
+  assert job.loadRunner().done is True
+  assert job.lease_expires is None
+
+
+@pytest.mark.django_db()
+def test_job_wake_hint( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job_id_map = {}
+  for name, script in ( ( 'delay', 'delay( minutes=1 )' ), ( 'remote', 'testing.remote()' ) ):
+    job = _queuedJob( s, script )
+    job_id_map[ name ] = job.pk
+
+  cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
+  assert rc == [ { 'function': 'remote_func', 'job_id': job_id_map[ 'remote' ], 'module': 'testing', 'paramaters': 'the fake count "1"' } ]
+
+  job = BaseJob.objects.get( pk=job_id_map[ 'delay' ] )
+  assert job.waiting_on == ''
+  assert timezone.now() + timedelta( seconds=50 ) < job.wake_at < timezone.now() + timedelta( seconds=61 )
+
+  job = BaseJob.objects.get( pk=job_id_map[ 'remote' ] )
+  assert job.waiting_on == 'dispatch'
+  assert timezone.now() + timedelta( seconds=DISPATCH_LEASE_DEFAULT - 10 ) < job.wake_at < timezone.now() + timedelta( seconds=DISPATCH_LEASE_DEFAULT + 1 )  # the dispatch lease
+
+  # neither job is loaded
+  with CaptureQueriesContext( connection ) as ctx:
+    assert processJobs( s, [ 'testing' ], 10 ) == []
+  assert [ query for query in ctx.captured_queries if 'script_runner' in query[ 'sql' ] ] == []
+
+  jobResults( job_id_map[ 'remote' ], cookie, None )
+  job = BaseJob.objects.get( pk=job_id_map[ 'remote' ] )
+  assert job.waiting_on == ''
+  assert job.wake_at is None
+
+  BaseJob.objects.filter( pk=job_id_map[ 'delay' ] ).update( wake_at=timezone.now() - timedelta( seconds=1 ) )
+
+  cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
+  assert rc == [ { 'function': 'remote_func', 'job_id': job_id_map[ 'remote' ], 'module': 'testing', 'paramaters': 'the fake count "2"' } ]
+  job = BaseJob.objects.get( pk=job_id_map[ 'delay' ] )
+  assert job.message.startswith( 'Waiting for ' )  # it was run, and the delay is not done
+  assert job.wake_at > timezone.now()
+
+  job = BaseJob.objects.get( pk=job_id_map[ 'remote' ] )
+  job.clearDispatched()
+  job = BaseJob.objects.get( pk=job_id_map[ 'remote' ] )
+  assert job.waiting_on == ''
+
+  # functions that can finish on their own stay claimable while dispatched
+  job = _queuedJob( s, 'testing.remote_polling()' )
+  mocker.patch( 'contractor.tscript.runner_plugins_test.RemotePolling.toSubcontractor', _fake_toSubcontractor )
+  cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
+  assert job.pk in [ i[ 'job_id' ] for i in rc ]
+  job = BaseJob.objects.get( pk=job.pk )
+  assert ( job.waiting_on, job.wake_at ) == ( '', None )
+
+
+@pytest.mark.django_db
+def test_job_trace( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job = _queuedJob( s, 'value = 1\ntesting.remote()' )
+
+  assert 'trace' not in job.jobRunnerState()
+
+  job.setTrace( True )
+  job = BaseJob.objects.get( pk=job.pk )
+  assert job.jobRunnerState()[ 'trace' ] == []
+
+  cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
+  assert len( rc ) == 1
+
+  job = BaseJob.objects.get( pk=job.pk )
+  trace = job.jobRunnerState()[ 'trace' ]
+  assert [ entry[1:] for entry in trace if entry[1] in ( 'call', 'dispatch' ) ] == [ [ 'call', 2, 'testing', 'remote' ], [ 'dispatch', 2, 'testing', 'remote_func', False ] ]
+  assert trace[0][1:] == [ 'enter', 0, 0, 'S' ]
+  assert trace[-2][1:4] == [ 'leave', 2, 0 ]  # the scope, interrupted waiting on the remote function
+  assert trace[-2][6] == 'Interrupt'
+
+  job.setTrace( True )  # allready on, the trace is kept
+  job = BaseJob.objects.get( pk=job.pk )
+  assert job.jobRunnerState()[ 'trace' ] == trace
+
+  job.setTrace( False )
+  job = BaseJob.objects.get( pk=job.pk )
+  assert 'trace' not in job.jobRunnerState()
+
+
+@pytest.mark.django_db()
+def test_script_profile( mocker, settings ):
+  mocker.patch( 'contractor.Foreman.lib.RUNNER_MODULE_LIST', lib.RUNNER_MODULE_LIST + [ 'contractor.Foreman.benchmark' ] )
+
+  def _run( site ):  # play subcontractor untill the jobs are done
+    for _ in range( 0, 20 ):
+      for task in processJobs( site, [ 'benchmark' ], 10 ):
+        jobResults( task[ 'job_id' ], task[ 'cookie' ], { 'result': True } )
+
+      if not BaseJob.objects.filter( site=site ).exists():
+        return
+
+    assert False, 'Jobs did not finish'
+
+  site = buildSite( 'prof', 3, step_count=2, payload_size=0 )
+  foundation_list = list( Foundation.objects.filter( site=site ).order_by( 'pk' ) )
+
+  # off by default
+  createJob( 'create', foundation_list[0], TestUser() )
+  job = BaseJob.objects.get( site=site )
+  assert 'profile' not in job.jobRunnerState()
+
+  job.setProfile( True )
+  job = BaseJob.objects.get( pk=job.pk )
+  assert job.jobRunnerState()[ 'profile' ] == []
+
+  job.setProfile( False )
+  job = BaseJob.objects.get( pk=job.pk )
+  assert 'profile' not in job.jobRunnerState()
+
+  _run( site )
+  assert BaseJob.objects.filter( site=site ).count() == 0
+  assert ScriptProfile.objects.count() == 0
+
+  settings.TSCRIPT_PROFILE = True
+  createJob( 'create', foundation_list[1], TestUser() )
+  job = BaseJob.objects.get( site=site )
+  assert job.jobRunnerState()[ 'profile' ] == []
+
+  task_list = processJobs( site, [ 'benchmark' ], 10 )  # dispatches the first line
+  job = BaseJob.objects.get( pk=job.pk )
+  assert [ ( i[ 'line' ], i[ 'ops' ] ) for i in job.jobRunnerState()[ 'profile' ] ] == [ ( 0, 1 ), ( 1, 3 ) ]
+  jobResults( task_list[0][ 'job_id' ], task_list[0][ 'cookie' ], { 'result': True } )
+
+  _run( site )
+  assert BaseJob.objects.filter( site=site ).count() == 0
+  assert sorted( ScriptProfile.objects.filter( blueprint='prof-fdn', script_name='create' ).values_list( 'line', 'job_count' ) ) == [ ( 0, 1 ), ( 1, 1 ), ( 2, 1 ) ]
+
+  report = scriptProfileReport( 'prof-fdn' )
+  assert len( report ) == 1
+  assert report[0][ 'current' ] is True
+  assert report[0][ 'job_count' ] == 1
+  assert [ ( i[ 'line' ], i[ 'source' ] ) for i in report[0][ 'line_list' ] ] == [ ( 0, None ), ( 1, 'benchmark.work( size=0 )' ), ( 2, 'benchmark.work( size=0 )' ) ]
+  assert report[0][ 'line_list' ][1][ 'resumptions' ] == 1
+  assert report[0][ 'dispatch_seconds' ] >= 0.0
+  assert scriptProfileReport( 'prof-str' ) == []
+
+  structure = Structure.objects.filter( site=site ).order_by( 'pk' )[1]
+  createJob( 'create', structure, TestUser() )
+  _run( site )
+  createJob( 'create', foundation_list[2], TestUser() )
+  _run( site )
+
+  assert ScriptProfile.objects.get( blueprint='prof-fdn', line=1 ).job_count == 2
+  assert ScriptProfile.objects.get( blueprint='prof-str', line=1 ).job_count == 1
+  assert [ i[ 'blueprint' ] for i in scriptProfileReport( script_name='create' ) ] == sorted( [ 'prof-fdn', 'prof-str' ], key=lambda i: -sum( j.seconds + j.dispatch_seconds for j in ScriptProfile.objects.filter( blueprint=i ) ) )
+
+  script = Script.objects.get( pk='prof-create' )  # the blueprint's script changes, the profiles are kept, but are no longer current
+  script.script = 'benchmark.work( size=1 )'
+  script.full_clean()
+  script.save()
+  report = scriptProfileReport( 'prof-fdn' )
+  assert report[0][ 'current' ] is False
+  assert report[0][ 'line_list' ][1][ 'source' ] is None
+
+  job = mocker.Mock( blueprint=FoundationBluePrint.objects.get( pk='prof-fdn' ), script_name='create', parsed_script_id='0' * 64 )
+  profile = Profile()
+  profile.line_map = dict( ( line, [ 2, 0.5, 0.0, 1 ] ) for line in range( 0, 50 ) )
+  with CaptureQueriesContext( connection ) as ctx:
+    ScriptProfile.record( job, profile )
+
+  assert len( ctx.captured_queries ) < 10  # the lines are written together, not a few queries each
+  assert ScriptProfile.objects.filter( script_hash=job.parsed_script_id ).count() == 50
+  ScriptProfile.record( job, profile )
+  entry = ScriptProfile.objects.get( script_hash=job.parsed_script_id, line=10 )
+  assert ( entry.job_count, entry.ops, entry.seconds, entry.resumptions ) == ( 2, 4, 1.0, 2 )
+
+  removeSite( 'prof' )
+
+
+@pytest.mark.django_db()
+def test_dispatch_lease( mocker, settings ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+  settings.DISPATCH_LEASE_MAP = { 'testing': 0 }
+  foreman_stats.reset()
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job = _queuedJob( s, 'testing.remote()' )
+
+  old_cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
+  assert rc == [ { 'function': 'remote_func', 'job_id': job.pk, 'module': 'testing', 'paramaters': 'the fake count "1"' } ]
+  assert 'redispatch_testing' not in foreman_stats.snapshot()
+
+  # the lease is expired, so it is offered again, with a new cookie
+  cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
+  assert rc == [ { 'function': 'remote_func', 'job_id': job.pk, 'module': 'testing', 'paramaters': 'the fake count "2"' } ]
+  assert cookie != old_cookie
+  assert foreman_stats.snapshot()[ 'redispatch_testing' ] == 1
+
+  with pytest.raises( ForemanException ):
+    jobResults( job.pk, old_cookie, None )
+  jobResults( job.pk, cookie, None )
+
+  settings.DISPATCH_LEASE_MAP = {}
+  _, rc = _stripcookie( processJobs( s, [ 'testing' ], 10 ) )
+  assert rc == [ { 'function': 'remote_func', 'job_id': job.pk, 'module': 'testing', 'paramaters': 'the fake count "3"' } ]
+  assert processJobs( s, [ 'testing' ], 10 ) == []  # the default lease is still good
+  assert foreman_stats.snapshot()[ 'redispatch_testing' ] == 1
+
+
+@pytest.mark.django_db()
+def test_job_results_batch( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job_id_list = []
+  for _ in range( 0, 2 ):
+    job = _queuedJob( s, 'testing.remote()' )
+    job_id_list.append( job.pk )
+
+  cookie_map = dict( ( item[ 'job_id' ], item[ 'cookie' ] ) for item in processJobs( s, [ 'testing' ], 10 ) )
+  assert sorted( cookie_map.keys() ) == job_id_list
+
+  with CaptureQueriesContext( connection ) as ctx:
+    rc = jobResultsBatch( [
+                            { 'job_id': job_id_list[0], 'cookie': 'bad', 'data': None },
+                            { 'job_id': job_id_list[0], 'cookie': cookie_map[ job_id_list[0] ], 'data': None },
+                            { 'job_id': job_id_list[1], 'cookie': 'bad', 'msg': 'it broke' },
+                            { 'job_id': job_id_list[1], 'cookie': cookie_map[ job_id_list[1] ], 'msg': 'it broke' },
+                            { 'job_id': 0, 'cookie': 'bad', 'data': None },
+                            { 'cookie': 'bad', 'data': None }
+                          ] )
+
+  assert rc == [
+                 { 'job_id': job_id_list[0], 'error': 'INVALID_RESULT', 'message': 'Error saving job results: "Bad Cookie"' },
+                 { 'job_id': job_id_list[0], 'result': 'Accepted' },
+                 { 'job_id': job_id_list[1], 'error': 'BAD_COOKIE', 'message': 'Error setting job to error: "Bad Cookie"' },
+                 { 'job_id': job_id_list[1], 'result': 'Error Set' },
+                 { 'job_id': 0, 'error': 'JOB_NOT_FOUND', 'message': 'Error saving job results: "Job Not Found"' },
+                 { 'job_id': None, 'error': 'JOB_NOT_FOUND', 'message': 'Error saving job results: "Job Not Found"' }
+               ]
+
+  assert len( [ query for query in ctx.captured_queries if 'FOR UPDATE' in query[ 'sql' ] ] ) == 1
+
+  job = BaseJob.objects.get( pk=job_id_list[0] )
+  assert job.state == 'queued'
+  assert job.waiting_on == ''
+
+  job = BaseJob.objects.get( pk=job_id_list[1] )
+  assert job.state == 'error'
+  assert job.message == 'it broke'
+
+  assert jobResultsBatch( [] ) == []
+
+
+@pytest.mark.django_db()
+def test_job_results_batch_bad_items( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job_id_list = []
+  for _ in range( 0, 2 ):
+    job = _queuedJob( s, 'testing.remote()' )
+    job_id_list.append( job.pk )
+
+  cookie_map = dict( ( item[ 'job_id' ], item[ 'cookie' ] ) for item in processJobs( s, [ 'testing' ], 10 ) )
+
+  real_jobError = lib._jobError
+
+  def _jobError( job, cookie, msg ):  # the job is saved, then the DB complains
+    real_jobError( job, cookie, msg )
+    if msg == 'explode':
+      raise DataError( 'value too long' )
+
+  mocker.patch( 'contractor.Foreman.lib._jobError', _jobError )
+
+  rc = jobResultsBatch( [
+                          'junk',
+                          { 'job_id': job_id_list[0], 'data': None },
+                          { 'job_id': job_id_list[0], 'cookie': cookie_map[ job_id_list[0] ], 'msg': 5 },
+                          { 'job_id': job_id_list[1], 'cookie': cookie_map[ job_id_list[1] ], 'msg': 'explode' },
+                          { 'job_id': job_id_list[0], 'cookie': cookie_map[ job_id_list[0] ], 'data': None },
+                          { 'job_id': job_id_list[1], 'cookie': cookie_map[ job_id_list[1] ], 'data': None }
+                        ] )
+
+  assert rc == [
+                 { 'job_id': None, 'error': 'INVALID_ITEM', 'message': 'Error saving job results: "Item is not a map"' },
+                 { 'job_id': job_id_list[0], 'error': 'INVALID_ITEM', 'message': 'Error saving job results: "cookie is missing or not a string"' },
+                 { 'job_id': job_id_list[0], 'error': 'INVALID_ITEM', 'message': 'Error saving job results: "msg is not a string"' },
+                 { 'job_id': job_id_list[1], 'error': 'INVALID_RESULT', 'message': 'Error saving job results: "value too long"' },
+                 { 'job_id': job_id_list[0], 'result': 'Accepted' },
+                 { 'job_id': job_id_list[1], 'result': 'Accepted' }
+               ]
+
+  for job_id in job_id_list:  # the failed item was rolled back, the rest went in
+    job = BaseJob.objects.get( pk=job_id )
+    assert job.state == 'queued'
+    assert job.waiting_on == ''
+
+
+@pytest.mark.django_db()
+def test_notifier( django_capture_on_commit_callbacks, settings ):
+  settings.FOREMAN_NOTIFY_LISTEN = False  # the listener's connection would keep the test database from being dropped
+  generation = workGeneration( 1 )
+  assert waitForWork( 1, generation, 0.1 ) is False
+
+  with django_capture_on_commit_callbacks( execute=True ):
+    notifyWork( 2 )
+
+  assert waitForWork( 1, generation, 0.1 ) is False
+
+  with django_capture_on_commit_callbacks( execute=True ):
+    notifyWork( 1 )
+    assert waitForWork( 1, generation, 0.1 ) is False  # not until commit
+
+  assert waitForWork( 1, generation, 0.1 ) is True
+  assert workGeneration( 1 ) == generation + 1
+
+  with CaptureQueriesContext( connection ) as ctx:
+    notifyWork( 1 )
+  assert ctx.captured_queries == []  # nothing is listening
+
+  settings.FOREMAN_NOTIFY_LISTEN = True
+  with CaptureQueriesContext( connection ) as ctx:
+    notifyWork( 1 )
+  assert [ query[ 'sql' ].startswith( 'SELECT pg_notify' ) for query in ctx.captured_queries ] == [ True ]
+
+
+@pytest.mark.django_db( transaction=True )
+def test_notifier_manual_transaction( settings ):  # cinp runs the request with autocommit off
+  settings.FOREMAN_NOTIFY_LISTEN = False
+  generation = workGeneration( 1 )
+  transaction.set_autocommit( False )
+  try:
+    with CaptureQueriesContext( connection ) as ctx:
+      notifyWork( 1 )
+      notifyWork( 1 )
+    assert ctx.captured_queries == []  # nothing is listening, so no NOTIFY
+    assert waitForWork( 1, generation, 0.1 ) is False  # not until it is committed
+
+    transaction.commit()
+    flushWork()
+  finally:
+    transaction.set_autocommit( True )
+
+  assert waitForWork( 1, generation, 0.1 ) is True
+  assert workGeneration( 1 ) == generation + 1
+  flushWork()  # nothing left
+  assert workGeneration( 1 ) == generation + 1
+
+
+@pytest.mark.django_db()
+def test_process_jobs_wait( mocker, settings ):
+  settings.FOREMAN_NOTIFY_LISTEN = False  # the listener's connection would keep the test database from being dropped
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  start = time.monotonic()
+  assert processJobs( s, [ 'testing' ], 10, 1 ) == []
+  assert 1 <= time.monotonic() - start < 3
+
+  job = _queuedJob( s, 'delay( seconds=2 )\ntesting.remote()' )
+
+  start = time.monotonic()
+  cookie, rc = _stripcookie( processJobs( s, [ 'testing' ], 10, 30 ) )  # returns when the delay is done, not at 30 seconds
+  assert rc == [ { 'function': 'remote_func', 'job_id': job.pk, 'module': 'testing', 'paramaters': 'the fake count "1"' } ]
+  assert 1 <= time.monotonic() - start < 5
+
+
+def test_fair_order():
+  assert _fairOrder( [], 10 ) == []
+  assert _fairOrder( [ ( 1, 50, 'a' ), ( 2, 50, 'a' ), ( 3, 50, 'a' ) ], 10 ) == [ 1, 2, 3 ]
+  assert _fairOrder( [ ( 1, 50, 'a' ), ( 2, 50, 'a' ), ( 3, 50, 'a' ) ], 2 ) == [ 1, 2 ]
+  assert _fairOrder( [ ( 1, 50, 'a' ), ( 2, 50, 'a' ), ( 3, 50, 'a' ), ( 4, 50, 'b' ), ( 5, 50, 'c' ), ( 6, 50, 'b' ) ], 10 ) == [ 1, 4, 5, 2, 6, 3 ]
+  assert _fairOrder( [ ( 1, 50, 'a' ), ( 2, 50, 'a' ), ( 3, 50, 'a' ), ( 4, 50, 'b' ), ( 5, 50, 'c' ), ( 6, 50, 'b' ) ], 4 ) == [ 1, 4, 5, 2 ]
+  assert _fairOrder( [ ( 1, 50, 'a' ), ( 2, 50, 'a' ), ( 3, 10, 'b' ), ( 4, 90, 'a' ), ( 5, 90, 'c' ) ], 10 ) == [ 4, 5, 1, 2, 3 ]
+  assert _fairOrder( [ ( 1, 50, 'a' ), ( 2, 50, 'a' ), ( 3, 10, 'b' ), ( 4, 90, 'a' ), ( 5, 90, 'c' ) ], 3 ) == [ 4, 5, 1 ]
+
+
+@pytest.mark.django_db()
+def test_job_priority( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job = BaseJob( site=s, state='queued', script_name='test', priority=101 )
+  job.script_runner = b''
+  with pytest.raises( ValidationError ):
+    job.full_clean()
+
+  job_id_map = {}
+  for name, script_name, priority in ( ( 'bulk1', 'create', 50 ), ( 'bulk2', 'create', 50 ), ( 'bulk3', 'create', 50 ), ( 'bulk4', 'create', 50 ), ( 'other', 'utility', 50 ), ( 'urgent', 'destroy', 90 ) ):
+    job = _queuedJob( s, 'testing.remote()', priority, script_name )
+    job_id_map[ name ] = job.pk
+
+  ( rc, deferred ) = _runQueuedJobs( [ s ], [ 'testing' ], 3 )
+  assert [ i[ 'job_id' ] for i in rc ] == [ job_id_map[ 'urgent' ], job_id_map[ 'bulk1' ], job_id_map[ 'other' ] ]
+  assert deferred == 3
+
+  ( rc, deferred ) = _runQueuedJobs( [ s ], [ 'testing' ], 3 )
+  assert [ i[ 'job_id' ] for i in rc ] == [ job_id_map[ 'bulk2' ], job_id_map[ 'bulk3' ], job_id_map[ 'bulk4' ] ]
+  assert deferred == 0
+
+  for name, script_name, priority in ( ( 'low', 'create', 10 ), ( 'high1', 'create', 90 ), ( 'high2', 'utility', 90 ), ( 'middle', 'create', 50 ) ):
+    job = _queuedJob( s, 'testing.remote()', priority, script_name )
+    job_id_map[ name ] = job.pk
+
+  key = []  # as processJobsPage runs them, highest priority then oldest, picking up after the last one run
+  ( rc, deferred ) = _runQueuedJobs( [ s ], [ 'testing' ], 2, key=key )
+  assert [ i[ 'job_id' ] for i in rc ] == [ job_id_map[ 'high1' ], job_id_map[ 'high2' ] ]
+  assert key == [ 90, job_id_map[ 'high2' ] ]
+  assert deferred == 2
+
+  ( rc, deferred ) = _runQueuedJobs( [ s ], [ 'testing' ], 2, key=key )
+  assert [ i[ 'job_id' ] for i in rc ] == [ job_id_map[ 'middle' ], job_id_map[ 'low' ] ]
+  assert key == [ 10, job_id_map[ 'low' ] ]
+  assert deferred == 0
+
+
+@pytest.mark.django_db()
+def test_process_jobs_page( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+  start_waiting = mocker.patch( 'contractor.Foreman.lib._startWaitingJobs' )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job_id_list = []
+  for script in [ 'testing.remote()' ] * 7 + [ 'testing.count( stop_at=100, count_by=1 )' ]:
+    job = _queuedJob( s, script )
+    job_id_list.append( job.pk )
+
+  rc = processJobsPage( s, [ 'testing' ], 3 )
+  assert [ i[ 'job_id' ] for i in rc[ 'job_list' ] ] == job_id_list[ :3 ]
+  assert rc[ 'cursor' ].split( ':' )[1] == '{0},{1}'.format( BaseJob.objects.get( pk=job_id_list[2] ).priority, job_id_list[2] )  # the cursor is the last job run, not every job run
+  assert start_waiting.call_count == 1
+  seen_list = [ i[ 'job_id' ] for i in rc[ 'job_list' ] ]
+
+  while rc[ 'cursor' ] is not None:
+    rc = processJobsPage( s, [ 'testing' ], 3, rc[ 'cursor' ] )
+    seen_list += [ i[ 'job_id' ] for i in rc[ 'job_list' ] ]
+
+  assert start_waiting.call_count == 1  # only the first page
+  assert seen_list == job_id_list[ :7 ]
+  counter = BaseJob.objects.get( pk=job_id_list[ 7 ] ).loadRunner()
+  assert counter.state[ -1 ][1][ 'handler' ].counter == 1  # the count job was run once for the poll, even though it is still runnable
+
+  assert processJobsPage( s, [ 'testing' ], 3 ) == { 'job_list': [], 'cursor': None }
+  assert start_waiting.call_count == 2
+
+  rc = processJobsPage( s, [ 'testing' ], 3, '{0}:'.format( int( time.time() ) - 1000 ) )  # expired, new poll
+  assert rc == { 'job_list': [], 'cursor': None }
+  assert start_waiting.call_count == 3
+
+  with pytest.raises( ForemanException ):
+    processJobsPage( s, [ 'testing' ], 3, 'bad' )
+
+  with pytest.raises( ForemanException ):
+    processJobsPage( s, [ 'testing' ], 3, '{0}:1'.format( int( time.time() ) ) )
+
+
+def test_fair_share():
+  assert _fairShare( {}, 10 ) == []
+  assert _fairShare( { 'a': [ ( 1, 50, 'x' ), ( 2, 50, 'x' ), ( 3, 50, 'x' ), ( 4, 50, 'x' ) ], 'b': [ ( 5, 50, 'x' ) ], 'c': [ ( 6, 50, 'x' ), ( 7, 50, 'x' ) ] }, 5 ) == [ 1, 5, 6, 2, 7 ]
+  assert _fairShare( { 'a': [ ( 1, 50, 'x' ), ( 2, 50, 'x' ), ( 3, 50, 'x' ), ( 4, 50, 'x' ) ], 'b': [ ( 5, 50, 'x' ) ] }, 10 ) == [ 1, 5, 2, 3, 4 ]
+  assert _fairShare( { 'a': [ ( 1, 50, 'x' ), ( 2, 50, 'y' ), ( 3, 50, 'x' ) ] }, 10 ) == [ 1, 2, 3 ]
+
+
+@pytest.mark.django_db()
+def test_process_jobs_multi( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  parent = Site( name='parent', description='parent' )
+  parent.full_clean()
+  parent.save()
+
+  site_map = { 'parent': parent }
+  for name, site_parent in ( ( 'edge1', parent ), ( 'edge2', parent ), ( 'other', None ) ):
+    site = Site( name=name, description=name, parent=site_parent )
+    site.full_clean()
+    site.save()
+    site_map[ name ] = site
+
+  site = Site( name='edge1a', description='edge1a', parent=site_map[ 'edge1' ] )
+  site.full_clean()
+  site.save()
+  site_map[ 'edge1a' ] = site
+
+  for name, count in ( ( 'parent', 1 ), ( 'edge1', 6 ), ( 'edge1a', 1 ), ( 'edge2', 2 ), ( 'other', 1 ) ):
+    for _ in range( 0, count ):
+      _queuedJob( site_map[ name ], 'testing.remote()' )
+
+  assert processJobsMulti( [], [ 'testing' ], 10 ) == []
+
+  rc = processJobsMulti( [ site_map[ 'edge1' ], site_map[ 'edge2' ] ], [ 'testing' ], 4 )
+  assert sorted( i[ 'site' ] for i in rc ) == [ 'edge1', 'edge1', 'edge2', 'edge2' ]  # each site gets half
+  assert set( rc[0].keys() ) == set( [ 'cookie', 'function', 'job_id', 'module', 'paramaters', 'site' ] )
+
+  rc = processJobsMulti( [ site_map[ 'edge1' ], site_map[ 'edge2' ] ], [ 'testing' ], 4 )
+  assert [ i[ 'site' ] for i in rc ] == [ 'edge1' ] * 4  # edge2 is out of work, edge1 gets the rest
+
+  rc = processJobsMulti( [ parent ], [ 'testing' ], 10, include_children=True )
+  assert sorted( i[ 'site' ] for i in rc ) == [ 'edge1a', 'parent' ]
+  assert BaseJob.objects.filter( site=site_map[ 'other' ], waiting_on='' ).count() == 1  # not a child, untouched
+
+
+@pytest.mark.django_db()
+def test_external_worker( mocker, settings, django_capture_on_commit_callbacks ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+  settings.FOREMAN_NOTIFY_LISTEN = False  # the listener's connection would keep the test database from being dropped
+  settings.FOREMAN_EXTERNAL_WORKER = True
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  for _ in range( 0, 3 ):
+    job = _queuedJob( s, 'testing.remote()' )
+
+  assert processJobs( s, [ 'testing' ], 10 ) == []  # nothing prepared yet, and getJobs dosen't run the jobs
+  assert BaseJob.objects.filter( waiting_on='dispatch' ).count() == 0
+
+  generation = workGeneration( [ tasksKey( s.pk ) ] )
+  with django_capture_on_commit_callbacks( execute=True ):
+    assert prepareTasks( [ s ], 2 ) == ( 2, 1 )
+
+  assert PreparedTask.objects.filter( site=s ).count() == 2
+  assert waitForWork( [ tasksKey( s.pk ) ], generation, 0.1 ) is True
+  assert processJobs( s, [ 'other' ], 10 ) == []
+
+  rc = processJobs( s, [ 'testing' ], 10 )
+  assert len( rc ) == 2
+  assert set( rc[0].keys() ) == set( [ 'cookie', 'function', 'job_id', 'module', 'paramaters' ] )
+  assert PreparedTask.objects.count() == 0
+  assert processJobs( s, [ 'testing' ], 10 ) == []
+
+  assert prepareTasks( [ s ], 2 ) == ( 1, 0 )
+  assert prepareTasks( [ s ], 2 ) == ( 0, 0 )  # allready dispatched
+  rc = processJobsMulti( [ s ], [ 'testing' ], 10 )
+  assert len( rc ) == 1
+  assert rc[0][ 'site' ] == 'test'
+
+  job = BaseJob.objects.get( pk=rc[0][ 'job_id' ] )
+  job.clearDispatched()
+  assert prepareTasks( [ s ], 2 ) == ( 1, 0 )
+  assert PreparedTask.objects.count() == 1
+  job = BaseJob.objects.get( pk=rc[0][ 'job_id' ] )
+  job.clearDispatched()  # the prepared task was not picked up, it is replaced
+  assert PreparedTask.objects.count() == 0
+  assert prepareTasks( [ s ], 2 ) == ( 1, 0 )
+  rc = processJobs( s, [ 'testing' ], 10 )
+  assert len( rc ) == 1
+
+  settings.FOREMAN_EXTERNAL_WORKER = False
+  assert processJobs( s, [ 'testing' ], 10 ) == []  # every thing is dispatched
+
+
+def test_site_shard():
+  site_id_list = [ 'site{0}'.format( i ) for i in range( 0, 20 ) ]
+  shard_map = {}
+  for site_id in site_id_list:
+    shard = siteShard( site_id, 3 )
+    assert shard == siteShard( site_id, 3 )
+    assert 0 <= shard < 3
+    shard_map.setdefault( shard, [] ).append( site_id )
+
+  assert len( shard_map ) == 3
+  assert sum( len( i ) for i in shard_map.values() ) == 20
+  assert siteShard( 'site1', 1 ) == 0
+
+
+@pytest.mark.django_db()
+def test_stats( mocker ):
+  mocker.patch( 'contractor.tscript.runner_plugins_test.Remote.toSubcontractor', _fake_toSubcontractor )
+
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  for script in ( 'testing.remote()', 'delay( minutes=1 )', 'testing.count()\ntesting.count()' ):
+    _queuedJob( s, script )
+
+  Stats.getStats( True )
+  processJobs( s, [ 'testing' ], 10 )
+  value_map = Stats.getStats()
+
+  for phase in ( 'process_jobs', 'auto_locate', 'start_waiting', 'finish_done', 'run_queued', 'job_load', 'job_run', 'job_store' ):
+    assert value_map[ phase + '_seconds' ] > 0, phase
+
+  assert value_map[ 'process_jobs_count' ] == 1
+  assert value_map[ 'job_run_count' ] == 3
+  assert value_map[ 'queued_examined' ] == 3
+  assert value_map[ 'queued_advanced' ] == 3
+  assert value_map[ 'tasks_dispatched' ] == 1
+  assert value_map[ 'run_queued_queries' ] > 0
+  assert value_map[ 'runner_ops' ] > 0
+  assert value_map[ 'runner_ops_max' ] <= value_map[ 'runner_ops' ]
+  assert value_map[ 'runner_pickle_bytes_max' ] > 0
+
+  Stats.getStats( True )
+  assert 'process_jobs_count' not in Stats.getStats()
+
+
+@pytest.mark.django_db()
+def test_job_stats( mocker ):
+  mocker.patch.dict( 'contractor.Foreman.models._job_stats_cache', {} )
+
+  si = Site( name='test', description='test' )
+  si.full_clean()
+  si.save()
+
+  si2 = Site( name='test2', description='test2' )
+  si2.full_clean()
+  si2.save()
+
+  fb = FoundationBluePrint( name='fdnb1', description='Foundation BluePrint 1' )
+  fb.foundation_type_list = [ 'Unknown' ]
+  fb.full_clean()
+  fb.save()
+
+  f = Foundation( locator='test', site=si, blueprint=fb )
+  f.full_clean()
+  f.save()
+  createJob( 'create', f, TestUser() )
+
+  for site, state in ( ( si, 'queued' ), ( si, 'queued' ), ( si, 'error' ), ( si, 'paused' ), ( si2, 'queued' ) ):
+    job = BaseJob( site=site, state=state, script_name='test', script_runner=b'' )
+    job.full_clean()
+    job.save()
+
+  with CaptureQueriesContext( connection ) as ctx:
+    stats = BaseJob.jobStatsDetail( si )
+  assert len( ctx.captured_queries ) == 1
+
+  assert stats[ 'total' ] == 5
+  assert stats[ 'type' ] == { 'foundation': 1, 'structure': 0, 'dependency': 0 }
+  assert sorted( stats[ 'state' ].keys() ) == [ 'error', 'paused', 'queued', 'waiting' ]
+  assert stats[ 'state' ][ 'queued' ][ 'count' ] == 2
+  assert stats[ 'state' ][ 'waiting' ] == { 'count': 1, 'foundation': 1, 'structure': 0, 'dependency': 0, 'oldest_age': 0 }
+
+  with CaptureQueriesContext( connection ) as ctx:
+    assert BaseJob.jobStats( si ) == { 'running': 5, 'error': 2 }  # from the cache
+  assert len( ctx.captured_queries ) == 0
+
+  with CaptureQueriesContext( connection ) as ctx:
+    stats = BaseJob.jobStatsAllSites()
+  assert len( ctx.captured_queries ) == 1
+  assert sorted( stats.keys() ) == [ 'test', 'test2' ]
+  assert stats[ 'test2' ][ 'total' ] == 1
+
+  site = Site( name='test3', description='test3' )
+  site.full_clean()
+  site.save()
+  assert BaseJob.jobStats( site ) == { 'running': 0, 'error': 0 }
+  assert BaseJob.jobStatsDetail( site ) == { 'total': 0, 'type': { 'foundation': 0, 'structure': 0, 'dependency': 0 }, 'state': {} }
+
+
+@pytest.mark.django_db()
+def test_job_log():
+  s = Site( name='test', description='test' )
+  s.full_clean()
+  s.save()
+
+  job = BaseJob( site=s, state='queued', script_name='create' )
+  job.script_runner = b''
+  job.full_clean()
+  job.save()
+
+  now = timezone.now()
+  for job_id, script_name in ( ( job.pk, 'create' ), ( 1001, 'create' ), ( 1002, 'create' ), ( 1003, 'destroy' ), ( 1004, 'create' ) ):
+    log = JobLog( site=s, job_id=job_id, target_id='t{0}'.format( job_id ), target_class='Foundation', target_description='test', script_name=script_name, creator='tester' )
+    log.full_clean()
+    log.save()
+
+  with CaptureQueriesContext( connection ) as ctx:
+    JobLog.startedList( [ job.pk, 1001, 1002, 1003 ] )
+    JobLog.finishedList( [ 1001, 1002 ] )
+    JobLog.startedList( [] )
+  assert len( ctx.captured_queries ) == 2
+
+  JobLog.canceled( BaseJob( pk=1003 ), 'tester' )
+  assert JobLog.objects.get( job_id=1001 ).started_at >= now
+  assert JobLog.objects.get( job_id=1001 ).finished_at >= now
+  assert JobLog.objects.get( job_id=1003 ).canceled_by == 'tester'
+  assert JobLog.objects.get( job_id=1004 ).started_at is None
+
+  assert rollupJobLog( now ) == 0  # nothing is old enough
+  JobLog.objects.filter( job_id=1001 ).update( started_at=now - timedelta( seconds=30 ), finished_at=now - timedelta( seconds=10 ) )
+  JobLog.objects.filter( job_id=1002 ).update( started_at=now - timedelta( seconds=10 ), finished_at=now - timedelta( seconds=5 ) )
+  assert rollupJobLog( timezone.now() ) == 4  # the job that still exists is left
+  assert list( JobLog.objects.all().values_list( 'job_id', flat=True ) ) == [ job.pk ]
+
+  rollup = JobLogRollup.objects.get( site=s, script_name='create' )
+  assert rollup.job_count == 3  # 1004 was never started, but it's job is gone
+  assert rollup.finished_count == 2
+  assert rollup.canceled_count == 0
+  assert rollup.run_seconds == 25.0
+  rollup = JobLogRollup.objects.get( site=s, script_name='destroy' )
+  assert ( rollup.job_count, rollup.finished_count, rollup.canceled_count, rollup.run_seconds ) == ( 1, 0, 1, 0.0 )
+
+  log = JobLog( site=s, job_id=1005, target_id='t1005', target_class='Foundation', target_description='test', script_name='create', creator='tester' )
+  log.full_clean()
+  log.save()
+  JobLog.finishedList( [ 1005 ] )
+  assert rollupJobLog( timezone.now() ) == 1
+  assert JobLogRollup.objects.get( site=s, script_name='create' ).job_count == 4  # added to the existing rollup
+
+  with pytest.raises( ProtectedError ):
+    JobLog.objects.get( job_id=job.pk ).delete()
+
+
 @pytest.mark.django_db()
 def test_job_create():
   si = Site()
@@ -337,6 +1352,29 @@ def test_job_create():
   assert str( execinfo.value.code ) == 'INVALID_TARGET'
 
 
+@pytest.mark.django_db()
+def test_job_runner_variables():
+  si = Site( name='test', description='test', config_values={ 'site_value': 'here' } )
+  si.full_clean()
+  si.save()
+
+  fb = FoundationBluePrint( name='fdnb1', description='Foundation BluePrint 1' )
+  fb.foundation_type_list = [ 'Unknown' ]
+  fb.full_clean()
+  fb.save()
+
+  f = Foundation( locator='test', site=si, blueprint=fb )
+  f.full_clean()
+  f.save()
+  createJob( 'create', f, TestUser() )
+
+  job = BaseJob.objects.get( site=si )
+  variable_map = job.realJob.jobRunnerVariables()
+  assert variable_map[ 'config.site_value' ] == 'here'
+  assert variable_map[ 'config._foundation_id' ] == 'test'
+  assert variable_map[ 'foundation.locator' ] == 'test'
+
+
 @pytest.mark.django_db()
 def test_foundation_job_create():  # TODO: should also do tests depending on a Dependency
   si = Site()
@@ -636,6 +1674,193 @@ def test_structure_job_create():  # TODO: test structures with dependency
   f = Foundation.objects.get( pk=f.pk )
 
 
+@pytest.mark.django_db()
+def test_create_jobs():
+  si = Site( name='test', description='test' )
+  si.full_clean()
+  si.save()
+
+  si2 = Site( name='other', description='other' )
+  si2.full_clean()
+  si2.save()
+
+  fb = FoundationBluePrint( name='fdnb1', description='Foundation BluePrint 1' )
+  fb.foundation_type_list = [ 'Unknown' ]
+  fb.full_clean()
+  fb.save()
+
+  sb = StructureBluePrint( name='strb1', description='Structure BluePrint 1' )
+  sb.full_clean()
+  sb.save()
+  sb.foundation_blueprint_list.add( fb )
+
+  structure_list = []
+  for i in range( 0, 5 ):
+    f = Foundation( locator='test{0}'.format( i ), site=si, blueprint=fb )
+    f.full_clean()
+    f.save()
+    f.setBuilt()
+
+    s = Structure( foundation=f, hostname='test{0}'.format( i ), site=si, blueprint=sb )
+    s.full_clean()
+    s.save()
+    structure_list.append( s )
+
+  f = Foundation( locator='fdn', site=si, blueprint=fb )
+  f.full_clean()
+  f.save()
+
+  structure_list[4].setBuilt()
+
+  assert createJobs( 'create', [], TestUser() ) == []
+
+  with pytest.raises( ForemanException ) as execinfo:
+    createJobs( 'create', [ structure_list[0], structure_list[0] ], TestUser() )
+  assert execinfo.value.code == 'DUPLICATE_TARGET'
+
+  with pytest.raises( ForemanException ) as execinfo:
+    createJobs( 'create', [ structure_list[0], structure_list[4] ], TestUser() )
+  assert execinfo.value.code == 'ALLREADY_BUILT'
+  assert BaseJob.objects.count() == 0
+
+  with pytest.raises( ForemanException ) as execinfo:
+    createJobs( 'create', [ structure_list[0] ], TestUser(), 200 )
+  assert execinfo.value.code == 'INVALID_PRIORITY'
+
+  job_id_list = createJobs( 'create', [ structure_list[0], f, structure_list[1] ], TestUser(), 60 )
+  assert len( job_id_list ) == 3
+  assert BaseJob.objects.count() == 3
+  assert JobLog.objects.filter( job_id__in=job_id_list ).count() == 3
+
+  job = StructureJob.objects.get( pk=job_id_list[0] )
+  assert job.structure.pk == structure_list[0].pk
+  assert job.state == 'waiting'
+  assert job.script_name == 'create'
+  assert job.priority == 60
+  runner = job.loadRunner()
+  assert [ i.cookie for i in runner.object_list if isinstance( i, SignalingPlugin ) ] == [ str( job.pk ) ]
+
+  assert FoundationJob.objects.get( pk=job_id_list[1] ).foundation.pk == f.pk
+  assert StructureJob.objects.get( pk=job_id_list[2] ).parsed_script_id == job.parsed_script_id
+
+  log = JobLog.objects.get( job_id=job_id_list[1] )
+  assert log.target_class == 'Foundation'
+  assert log.target_id == 'fdn'
+  assert log.creator == 'tester'
+
+  with pytest.raises( ForemanException ) as execinfo:
+    createJobs( 'create', [ structure_list[2], structure_list[1] ], TestUser() )
+  assert execinfo.value.code == 'JOB_EXISTS'
+
+  c = Complex( name='cplx', site=si, description='complex' )
+  c.full_clean()
+  c.save()
+  for s in structure_list[ 2:4 ]:
+    cs = ComplexStructure( complex=c, structure=s )
+    cs.full_clean()
+    cs.save()
+
+  job_id_list = c.doJobs( TestUser(), 'create' )
+  assert sorted( StructureJob.objects.get( pk=i ).structure.pk for i in job_id_list ) == [ structure_list[2].pk, structure_list[3].pk ]
+
+  with pytest.raises( SiteException ) as execinfo:
+    si2.doJobs( TestUser(), 'utility', [ structure_list[4] ] )
+  assert execinfo.value.code == 'INVALID_STRUCTURE'
+
+  job_id_list = si.doJobs( TestUser(), 'utility', [ structure_list[4] ] )
+  assert StructureJob.objects.get( pk=job_id_list[0] ).script_name == 'utility'
+
+
+@pytest.mark.django_db()
+def test_auto_locate( mocker ):
+  si = Site( name='test', description='test' )
+  si.full_clean()
+  si.save()
+
+  fb = FoundationBluePrint( name='fdnb1', description='Foundation BluePrint 1' )
+  fb.foundation_type_list = [ 'Unknown' ]
+  fb.full_clean()
+  fb.save()
+
+  sb = StructureBluePrint( name='strb1', description='Structure BluePrint 1' )
+  sb.full_clean()
+  sb.save()
+  sb.foundation_blueprint_list.add( fb )
+
+  c = Complex( name='cplx', site=si, description='complex', built_percentage=50 )
+  c.full_clean()
+  c.save()
+
+  mocker.patch.object( Foundation, 'complex', new=property( lambda self: c if self.locator.startswith( 'member' ) else None ) )
+  mocker.patch( 'contractor.Foreman.lib.AUTO_LOCATE_SWEEP_INTERVAL', 1000 )
+  mocker.patch.dict( 'contractor.Foreman.lib._auto_locate_sweep_map', { si.pk: time.monotonic() } )
+
+  structure_list = []
+  for i in range( 0, 2 ):
+    f = Foundation( locator='host{0}'.format( i ), site=si, blueprint=fb )
+    f.full_clean()
+    f.save()
+    f.setBuilt()
+
+    s = Structure( foundation=f, hostname='host{0}'.format( i ), site=si, blueprint=sb )
+    s.full_clean()
+    s.save()
+    structure_list.append( s )
+
+    cs = ComplexStructure( complex=c, structure=s )
+    cs.full_clean()
+    cs.save()
+
+  def _foundationScanned():
+    with CaptureQueriesContext( connection ) as ctx:
+      processJobs( si, [ 'testing' ], 10 )
+
+    return any( 'FROM "Building_foundation"' in query[ 'sql' ] for query in ctx.captured_queries )
+
+  assert _foundationScanned()  # from adding the ComplexStructures
+  assert not _foundationScanned()
+
+  structure_list[0].config_values = { 'aa': 'bb' }
+  structure_list[0].save( update_fields=[ 'config_values', 'updated' ] )
+  structure_list[1].full_clean()
+  structure_list[1].save()
+  Structure.objects.get( pk=structure_list[1].pk ).save()
+  si.full_clean()
+  si.save()
+  assert LocateRequest.objects.filter( site=si ).count() == 0  # built_at did not change, and not a Foundation
+
+  f = Foundation( locator='member1', site=si, blueprint=fb )
+  f.full_clean()
+  f.save()
+  assert LocateRequest.objects.filter( site=si ).count() == 1
+
+  assert _foundationScanned()
+  assert Foundation.objects.get( pk='member1' ).state == 'planned'  # complex is not built
+  assert not _foundationScanned()
+
+  structure_list[0].setBuilt()
+  assert _foundationScanned()
+  assert Foundation.objects.get( pk='member1' ).state == 'located'
+
+  f = Foundation( locator='member2', site=si, blueprint=fb )
+  f.full_clean()
+  f.save()
+  assert _foundationScanned()
+  assert Foundation.objects.get( pk='member2' ).state == 'located'
+
+  f = Foundation( locator='member3', site=si, blueprint=fb )
+  f.full_clean()
+  f.save()
+  LocateRequest.objects.all().delete()  # lost the request
+  assert not _foundationScanned()
+  assert Foundation.objects.get( pk='member3' ).state == 'planned'
+
+  _auto_locate_sweep_map[ si.pk ] = time.monotonic() - 1001  # the sweep picks it up
+  assert _foundationScanned()
+  assert Foundation.objects.get( pk='member3' ).state == 'located'
+  assert not _foundationScanned()
+
+
 @pytest.mark.django_db()
 def test_dependency_job_create():
   si = Site()
@@ -760,8 +1985,66 @@ def test_dependency_job_create():
   s = Structure.objects.get( pk=s.pk )
 
 
+@pytest.fixture( params=[ 'property', 'planner' ] )
+def can_start_via( request, mocker ):
+  # run the can_start tests with the job's can_start, and again with planStart in it's place, they should agree
+  if request.param == 'planner':
+    for job_class in ( FoundationJob, StructureJob, DependencyJob ):
+      mocker.patch.object( job_class, 'can_start', property( lambda self: planStart( [ self ] )[ self.pk ] is None ) )
+
+  return request.param
+
+
+@pytest.mark.django_db()
+def test_plan_start_reason( mocker ):
+  mocker.patch( 'contractor.Building.models.Foundation._canSetState', fake_canSetState )
+  mocker.patch( 'contractor.Building.models.Structure._canSetState', fake_canSetState )
+
+  si = Site( name='test', description='test' )
+  si.full_clean()
+  si.save()
+
+  fb = FoundationBluePrint( name='fdnb1', description='Foundation BluePrint 1' )
+  fb.foundation_type_list = [ 'Unknown' ]
+  fb.full_clean()
+  fb.save()
+
+  sb = StructureBluePrint( name='strb1', description='Structure BluePrint 1' )
+  sb.full_clean()
+  sb.save()
+  sb.foundation_blueprint_list.add( fb )
+
+  f = Foundation( locator='test', site=si, blueprint=fb )
+  f.full_clean()
+  f.save()
+
+  s = Structure( foundation=f, hostname='test', site=si, blueprint=sb )
+  s.full_clean()
+  s.save()
+
+  createJob( 'create', f, TestUser() )
+  createJob( 'create', s, TestUser() )
+  job_list = [ f.foundationjob, s.structurejob ]
+
+  with CaptureQueriesContext( connection ) as ctx:
+    plan_map = planStart( job_list )
+  assert len( ctx.captured_queries ) == 3  # the Foundation's Dependency and Structure, and the Structure's job
+  assert plan_map == { f.foundationjob.pk: 'Foundation "f-test" is planned, needs to be located', s.structurejob.pk: 'Foundation "f-test" is planned, needs to be built' }
+
+  processJobs( si, [ 'testing' ], 10 )
+  assert BaseJob.objects.get( pk=f.foundationjob.pk ).message == 'Foundation "f-test" is planned, needs to be located'
+  assert BaseJob.objects.get( pk=s.structurejob.pk ).message == 'Foundation "f-test" is planned, needs to be built'
+
+  f.setLocated()
+  processJobs( si, [ 'testing' ], 10 )
+  job = BaseJob.objects.get( pk=f.foundationjob.pk )
+  assert job.state == 'queued'
+  assert job.message != 'Foundation "f-test" is planned, needs to be located'
+  assert BaseJob.objects.get( pk=s.structurejob.pk ).message == 'Foundation "f-test" is located, needs to be built'
+
+
 @pytest.mark.django_db()
-def test_can_start_create( mocker ):
+def test_can_start_create( mocker, can_start_via ):
   mocker.patch( 'contractor.Building.models.Foundation._canSetState', fake_canSetState )  # disable the job checking
   mocker.patch( 'contractor.Building.models.Structure._canSetState', fake_canSetState )
   mocker.patch( 'contractor.Building.models.Dependency._canSetState', fake_canSetState )
@@ -885,7 +2168,7 @@ def test_can_start_create( mocker ):
 
 
 @pytest.mark.django_db()
-def test_can_start_destroy( mocker ):
+def test_can_start_destroy( mocker, can_start_via ):
   mocker.patch( 'contractor.Building.models.Foundation._canSetState', fake_canSetState )  # disable the job checking
   mocker.patch( 'contractor.Building.models.Structure._canSetState', fake_canSetState )
   mocker.patch( 'contractor.Building.models.Dependency._canSetState', fake_canSetState )
@@ -1043,7 +2326,7 @@ def test_can_start_destroy( mocker ):
 
 
 @pytest.mark.django_db()
-def test_can_start_mixed( mocker ):
+def test_can_start_mixed( mocker, can_start_via ):
   mocker.patch( 'contractor.Building.models.Foundation._canSetState', fake_canSetState )  # disable the job checking
   mocker.patch( 'contractor.Building.models.Structure._canSetState', fake_canSetState )
   mocker.patch( 'contractor.Building.models.Dependency._canSetState', fake_canSetState )
@@ -1135,3 +2418,83 @@ def test_can_start_mixed( mocker ):
   f.foundationjob.delete()
   d = Dependency.objects.get( pk=d.pk )
   f = Foundation.objects.get( pk=f.pk )
+
+
+def _processJobsQueryCount( site ):
+  with CaptureQueriesContext( connection ) as ctx:
+    processJobs( site, [ 'testing' ], 100 )
+
+  return len( ctx.captured_queries )
+
+
+@pytest.mark.django_db()
+def test_process_jobs_query_count():
+  si = Site()
+  si.name = 'test'
+  si.description = 'test'
+  si.full_clean()
+  si.save()
+  _auto_locate_sweep_map[ si.pk ] = time.monotonic()  # so the first count dosen't include the auto locate sweep
+
+  fb = FoundationBluePrint( name='fdnb1', description='Foundation BluePrint 1' )
+  fb.foundation_type_list = [ 'Unknown' ]
+  fb.full_clean()
+  fb.save()
+
+  sb = StructureBluePrint( name='strb1', description='Structure BluePrint 1' )
+  sb.full_clean()
+  sb.save()
+  sb.foundation_blueprint_list.add( fb )
+
+  def _addJobs( count ):  # the foundations are not located, so none of these jobs can start
+    for i in range( 0, count ):
+      f = Foundation()
+      f.locator = 'test{0}'.format( Foundation.objects.count() )
+      f.site = si
+      f.blueprint = fb
+      f.full_clean()
+      f.save()
+
+      s = Structure()
+      s.foundation = f
+      s.hostname = f.locator
+      s.site = si
+      s.blueprint = sb
+      s.full_clean()
+      s.save()
+
+      createJob( 'create', f, TestUser() )
+      createJob( 'create', s, TestUser() )
+
+  _addJobs( 5 )
+  count = _processJobsQueryCount( si )
+
+  _addJobs( 5 )
+  assert BaseJob.objects.filter( state='waiting' ).count() == 20
+  assert _processJobsQueryCount( si ) == count
+
+  _addJobs( 10 )
+  assert BaseJob.objects.filter( state='waiting' ).count() == 40
+  assert _processJobsQueryCount( si ) == count
+
+
+@pytest.mark.django_db()
+def test_benchmark():
+  result = runBenchmark( count=3, step_count=2, max_jobs=4, payload_size=10, name='bench' )
+  assert result[ 'jobs' ] == 6
+  assert result[ 'tasks' ] == 12
+  assert result[ 'jobs_per_second' ] > 0
+  assert result[ 'poll_p99' ] >= result[ 'poll_p50' ] > 0
+  assert result[ 'queries_per_job' ] > 0
+  assert result[ 'bytes_per_job' ] > 0
+  assert not Site.objects.filter( pk='bench' ).exists()
+  assert BaseJob.objects.count() == 0
+
+  runBenchmark( count=1, step_count=1, name='bench', keep=True )
+  assert Site.objects.filter( pk='bench' ).exists()
+  with pytest.raises( ValueError ):
+    runBenchmark( count=1, name='bench' )
+
+  removeSite( 'bench' )
+  assert not Site.objects.filter( pk='bench' ).exists()
+  assert not FoundationBluePrint.objects.filter( pk='bench-fdn' ).exists()
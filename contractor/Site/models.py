@@ -43,6 +43,19 @@ class Site( models.Model ):
   def getConfig( self ):
     return getConfig( self )
 
+  @cinp.action( return_type={ 'type': 'Integer', 'is_array': True }, paramater_type_list=[ '_USER_', 'String', { 'type': 'Model', 'model': 'contractor.Building.models.Structure', 'is_array': True } ] )
+  def doJobs( self, user, name, structure_list ):
+    """
+    Submit a job to run the script name for each of the Structures in structure_list, the
+    Structures must be in this Site.  Either all the jobs are created, or none are.
+    """
+    from contractor.Foreman.lib import createJobs
+    for structure in structure_list:
+      if structure.site_id != self.pk:
+        raise SiteException( 'INVALID_STRUCTURE', 'Structure "{0}" is not in this site'.format( structure.pk ) )
+
+    return createJobs( name, structure_list, user )
+
   @cinp.action( 'Map' )
   def getDependencyMap( self ):
     from contractor.Building.models import Dependency
@@ -111,7 +124,7 @@ class Site( models.Model ):
   @cinp.check_auth()
   @staticmethod
   def checkAuth( user, verb, id_list, action=None ):
-    return cinp.basic_auth_check( user, verb, action, Site, { 'getConfig': 'Site.view_site' } )
+    return cinp.basic_auth_check( user, verb, action, Site, { 'getConfig': 'Site.view_site', 'doJobs': 'Building.can_create_structure_job' } )
 
   def clean( self, *args, **kwargs ):
     super().clean( *args, **kwargs )
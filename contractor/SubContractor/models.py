@@ -2,7 +2,7 @@ from cinp.orm_django import DjangoCInP as CInP
 
 from contractor.Site.models import Site
 from contractor.Utilities.models import AddressBlock, NetworkAddressBlock
-from contractor.Foreman.lib import processJobs, jobResults, jobError
+from contractor.Foreman.lib import processJobs, processJobsPage, processJobsMulti, jobResults, jobError, jobResultsBatch
 from contractor.lib.config import getConfig
 
 cinp = CInP( 'SubContractor', '0.1' )
@@ -14,12 +14,22 @@ class Dispatch():
   def __init__( self ):
     super().__init__()
 
-  @cinp.action( return_type={ 'type': 'Map', 'is_array': True }, paramater_type_list=[ { 'type': 'Model', 'model': Site }, { 'type': 'String', 'is_array': True }, 'Integer' ] )
+  @cinp.action( return_type={ 'type': 'Map', 'is_array': True }, paramater_type_list=[ { 'type': 'Model', 'model': Site }, { 'type': 'String', 'is_array': True }, 'Integer', 'Integer' ] )
   @staticmethod
-  def getJobs( site, module_list, max_jobs=10 ):
-    result = processJobs( site, module_list, max_jobs )
+  def getJobs( site, module_list, max_jobs=10, wait_seconds=0 ):
+    result = processJobs( site, module_list, max_jobs, wait_seconds )
     return result
 
+  @cinp.action( return_type='Map', paramater_type_list=[ { 'type': 'Model', 'model': Site }, { 'type': 'String', 'is_array': True }, 'Integer', 'String', 'Integer' ] )
+  @staticmethod
+  def getJobsPage( site, module_list, max_jobs=10, cursor=None, wait_seconds=0 ):
+    return processJobsPage( site, module_list, max_jobs, cursor, wait_seconds )
+
+  @cinp.action( return_type={ 'type': 'Map', 'is_array': True }, paramater_type_list=[ { 'type': 'Model', 'model': Site, 'is_array': True }, { 'type': 'String', 'is_array': True }, 'Integer', 'Integer', 'Boolean' ] )
+  @staticmethod
+  def getJobsMulti( site_list, module_list, max_jobs=10, wait_seconds=0, include_children=False ):
+    return processJobsMulti( site_list, module_list, max_jobs, wait_seconds, include_children )
+
   @cinp.action( return_type='String', paramater_type_list=[ 'Integer', 'String', 'Map' ] )
   @staticmethod
   def jobResults( job_id, cookie, data ):
@@ -30,6 +40,11 @@ class Dispatch():
   def jobError( job_id, cookie, msg ):
     jobError( job_id, cookie, msg )
 
+  @cinp.action( return_type={ 'type': 'Map', 'is_array': True }, paramater_type_list=[ { 'type': 'Map', 'is_array': True } ] )
+  @staticmethod
+  def jobResultsBatch( result_list ):
+    return jobResultsBatch( result_list )
+
   @cinp.check_auth()
   @staticmethod
   def checkAuth( user, verb, id_list, action=None ):
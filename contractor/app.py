@@ -6,6 +6,8 @@ from cinp.server_werkzeug import WerkzeugServer, NoCINP
 from contractor import plugins
 from contractor.Auth.models import getUser
 from contractor.lib.config_handler import handler as config_handler
+from contractor.lib.metrics_handler import handler as metrics_handler
+from contractor.Foreman.notifier import flushWork
 
 # get plugins
 plugin_list = []
@@ -16,12 +18,20 @@ for item in os.scandir( plugin_dir ):
   plugin_list.append( 'contractor.plugins.{0}'.format( item.name ) )
 
 
+class ContractorServer( WerkzeugServer ):
+  def handle( self, envrionment ):
+    try:
+      return super().handle( envrionment )
+    finally:
+      flushWork()  # cinp has committed (or aborted) the request's transaction, wake up what was waiting on the work it signaled
+
+
 def get_app( debug ):
   extras = {}
   if settings.UI_HOSTNAME is not None:
     extras[ 'cors_allow_origin' ] = settings.UI_HOSTNAME
 
-  app = WerkzeugServer( root_path='/api/v1/', root_version='1.0', debug=debug, get_user=getUser, auth_header_list=[ 'AUTH-ID', 'AUTH-TOKEN' ], auth_cookie_list=[ 'SESSION' ], debug_dump_location=settings.DEBUG_DUMP_LOCATION, **extras )
+  app = ContractorServer( root_path='/api/v1/', root_version='1.0', debug=debug, get_user=getUser, auth_header_list=[ 'AUTH-ID', 'AUTH-TOKEN' ], auth_cookie_list=[ 'SESSION' ], debug_dump_location=settings.DEBUG_DUMP_LOCATION, **extras )
 
   app.registerNamespace( '/', 'contractor.Auth' )
   app.registerNamespace( '/', 'contractor.BluePrint' )
@@ -42,6 +52,7 @@ def get_app( debug ):
       pass
 
   app.registerPathHandler( '/config/', config_handler )
+  app.registerPathHandler( '/metrics/', metrics_handler )
 
   app.validate()
 
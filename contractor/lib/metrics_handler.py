@@ -0,0 +1,18 @@
+from django.conf import settings
+from cinp.server_common import Response
+
+from contractor.Auth.models import getUser
+from contractor.Foreman.stats import foreman_stats, metricsText
+
+
+def handler( request ):
+  if request.uri != '/metrics/':
+    return Response( 404, data='Not Found', content_type='text' )
+
+  if not getattr( settings, 'METRICS_ALLOW_ANONYMOUS', False ):
+    header_map = dict( [ ( i, request.header_map.get( i, None ) ) for i in ( 'AUTH-ID', 'AUTH-TOKEN' ) ] )
+    user = getUser( {}, header_map )
+    if user is None or not user.is_authenticated:
+      return Response( 401, data='Not Authorized', content_type='text' )
+
+  return Response( 200, data=metricsText( foreman_stats.snapshot() ), content_type='text' )
@@ -0,0 +1,60 @@
+import pytest
+
+from django.contrib.auth.models import User
+
+from contractor.Auth.models import User as AuthUser
+from contractor.Foreman.stats import Stats, foreman_stats, metricsText
+from contractor.lib.metrics_handler import handler
+
+
+class Request:
+  def __init__( self, uri, header_map=None ):
+    self.uri = uri
+    self.header_map = header_map or {}
+
+
+def test_metrics_text():
+  assert metricsText( {} ) == ''
+  assert metricsText( { 'b': 2, 'a': 1.5 } ) == 'contractor_foreman_a 1.5\ncontractor_foreman_b 2\n'
+  assert metricsText( { 'a': 1 }, prefix='' ) == 'a 1\n'
+
+
+def test_stats():
+  stats = Stats()
+  stats.add( 'thing' )
+  stats.add( 'thing', 2 )
+  stats.max( 'big', 5 )
+  stats.max( 'big', 3 )
+  with stats.timer( 'phase' ):
+    pass
+
+  value_map = stats.snapshot()
+  assert value_map[ 'thing' ] == 3
+  assert value_map[ 'big' ] == 5
+  assert value_map[ 'phase_count' ] == 1
+  assert value_map[ 'phase_queries' ] == 0
+  assert value_map[ 'phase_seconds' ] >= 0
+
+  assert stats.snapshot( reset=True )[ 'thing' ] == 3
+  assert 'thing' not in stats.snapshot()
+
+
+@pytest.mark.django_db()
+def test_handler( settings ):
+  foreman_stats.add( 'handler_test' )
+
+  assert handler( Request( '/metrics/other' ) ).http_code == 404
+
+  assert handler( Request( '/metrics/' ) ).http_code == 401
+  assert handler( Request( '/metrics/', { 'AUTH-ID': 'metrics', 'AUTH-TOKEN': 'bad' } ) ).http_code == 401
+
+  User.objects.create_user( 'metrics', password='metrics' )
+  token = AuthUser.login( 'metrics', 'metrics' )
+  response = handler( Request( '/metrics/', { 'AUTH-ID': 'metrics', 'AUTH-TOKEN': token } ) )
+  assert response.http_code == 200
+
+  settings.METRICS_ALLOW_ANONYMOUS = True
+  response = handler( Request( '/metrics/' ) )
+  assert response.http_code == 200
+  assert response.content_type == 'text'
+  assert 'contractor_foreman_handler_test ' in response.data
@@ -1,3 +1,6 @@
+import hashlib
+import threading
+from collections import OrderedDict
 from datetime import timedelta
 
 from parsimonious import Grammar, ParseError, IncompleteParseError
@@ -87,14 +90,98 @@ class ParserError( Exception ):
     return 'ParseError, line: {0}, column: {1}, "{2}"'.format( self.line, self.column, self.msg )
 
 
+AST_CACHE_SIZE = 200
+
+_grammar = None
+
+
+def _getGrammar():
+  global _grammar
+  if _grammar is None:
+    _grammar = Grammar( tscript_grammar )
+
+  return _grammar
+
+
+class ASTCache( object ):
+  """
+  LRU of parsed scripts, keyed by the scriptHash of the script text.  The
+  ASTs are shared by everything that gets them from the cache, so they must
+  not be modified.  Safe to use from more than one thread.
+  """
+  def __init__( self, size ):
+    super().__init__()
+    self.size = size
+    self.entry_map = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+    self._lock = threading.Lock()
+
+  def get( self, script_hash ):
+    with self._lock:
+      try:
+        ast = self.entry_map[ script_hash ]
+      except KeyError:
+        self.misses += 1
+        return None
+
+      self.entry_map.move_to_end( script_hash )
+      self.hits += 1
+      return ast
+
+  def set( self, script_hash, ast ):
+    with self._lock:
+      self.entry_map[ script_hash ] = ast
+      self.entry_map.move_to_end( script_hash )
+      while len( self.entry_map ) > self.size:
+        self.entry_map.popitem( last=False )
+
+  def clear( self ):
+    with self._lock:
+      self.entry_map.clear()
+      self.hits = 0
+      self.misses = 0
+
+  @property
+  def stats( self ):
+    with self._lock:
+      return { 'hits': self.hits, 'misses': self.misses, 'size': len( self.entry_map ), 'max_size': self.size }
+
+
+ast_cache = ASTCache( AST_CACHE_SIZE )
+
+
+def scriptHash( script ):
+  return hashlib.sha256( script.encode() ).hexdigest()
+
+
 def lint( script ):
+  script_hash = scriptHash( script )
+  if ast_cache.get( script_hash ) is not None:  # only sucessfully parsed scripts make it into the cache
+    return None
+
   parser = Parser()
-  return parser.lint( script )
+  ( ast, result ) = parser._lint( script )
+  if ast is not None:
+    ast_cache.set( script_hash, ast )
+
+  return result
 
 
 def parse( script ):
+  script_hash = scriptHash( script )
+  ast = ast_cache.get( script_hash )
+  if ast is not None:
+    return ast
+
   parser = Parser()
-  return parser.parse( script )
+  ast = parser.parse( script )
+  ast_cache.set( script_hash, ast )
+  return ast
+
+
+def parseCacheStats():
+  return ast_cache.stats
 
 
 class IsEmpty( Exception ):
@@ -105,29 +192,32 @@ class Parser( object ):
   def __init__( self ):
     super().__init__()
     self.line_endings = []
-    self.grammar = Grammar( tscript_grammar )
+    self.grammar = _getGrammar()
 
   def lint( self, script ):
+    return self._lint( script )[1]
+
+  def _lint( self, script ):  # returns ( ast, error ), ast is None if there is an error
     script += '\n'  # just incase the end of the script lacks a \n otherwise the *line* will not match
     self.line_endings = [ i for i, c in enumerate( script ) if c == '\n' ]
     try:
       root_node = self.grammar.parse( script )
     except IncompleteParseError as e:
-      return 'Incomplete Parsing on line: {0} column: {1}'.format( e.line(), e.column() )
+      return ( None, 'Incomplete Parsing on line: {0} column: {1}'.format( e.line(), e.column() ) )
     except ParseError as e:
-      return 'Error Parsing on line: {0} column: {1}'.format( e.line(), e.column() )
+      return ( None, 'Error Parsing on line: {0} column: {1}'.format( e.line(), e.column() ) )
 
     try:
       ast = self._eval( root_node )
     except Exception as e:
-      return 'Exception Parsing "{0}"'.format( e )
+      return ( None, 'Exception Parsing "{0}"'.format( e ) )
 
     try:
       self._check( ast )
     except ParserError as e:
-      return 'Invalid Script "{0}", line: {1} column: {2}'.format( e.msg, e.line, e.column )
+      return ( None, 'Invalid Script "{0}", line: {1} column: {2}'.format( e.msg, e.line, e.column ) )
 
-    return None
+    return ( self._wrap( ast ), None )
 
   def parse( self, script ):
     script += '\n'  # just incase the end of the script lacks a \n otherwise the *line* will not match
@@ -142,6 +232,9 @@ class Parser( object ):
     ast = self._eval( root_node )
     self._check( ast )
 
+    return self._wrap( ast )
+
+  def _wrap( self, ast ):
     # if there is allready one Scope over the full script use it
     try:
       if len( ast ) == 1 and ast[0][0] == Types.LINE and ast[0][1][0] == Types.SCOPE:
@@ -1,7 +1,8 @@
 import pytest
+import threading
 from datetime import timedelta
 
-from contractor.tscript.parser import parse, lint, ParserError, Parser
+from contractor.tscript.parser import parse, lint, ParserError, Parser, ASTCache, ast_cache, parseCacheStats
 
 
 def test_gramer_parses():
@@ -988,3 +989,68 @@ def test_exists():
                            'expression': ( 'C', 10 ) }
                          ] ),
                     1 ) ] } )
+
+
+def test_cache():
+  ast_cache.clear()
+  assert parseCacheStats() == { 'hits': 0, 'misses': 0, 'size': 0, 'max_size': 200 }
+
+  node = parse( 'aa = 1' )
+  assert node == ( 'S', { '_children': [ ( 'L', ( 'A', { 'target': ( 'V', { 'module': None, 'name': 'aa' } ), 'value': ( 'C', 1 ) } ), 1 ) ] } )
+  assert parseCacheStats() == { 'hits': 0, 'misses': 1, 'size': 1, 'max_size': 200 }
+
+  assert parse( 'aa = 1' ) is node
+  assert parseCacheStats() == { 'hits': 1, 'misses': 1, 'size': 1, 'max_size': 200 }
+
+  assert lint( 'aa = 1' ) is None
+  assert parseCacheStats() == { 'hits': 2, 'misses': 1, 'size': 1, 'max_size': 200 }
+
+  assert lint( 'bb = 2' ) is None
+  assert parseCacheStats() == { 'hits': 2, 'misses': 2, 'size': 2, 'max_size': 200 }
+  assert parse( 'bb = 2' ) == ( 'S', { '_children': [ ( 'L', ( 'A', { 'target': ( 'V', { 'module': None, 'name': 'bb' } ), 'value': ( 'C', 2 ) } ), 1 ) ] } )
+  assert parseCacheStats() == { 'hits': 3, 'misses': 2, 'size': 2, 'max_size': 200 }
+
+  assert lint( 'if 1 then' ) is not None  # errors are not cached
+  assert lint( 'if 1 then' ) is not None
+  assert parseCacheStats() == { 'hits': 3, 'misses': 4, 'size': 2, 'max_size': 200 }
+
+  with pytest.raises( ParserError ):
+    parse( 'if 1 then' )
+  assert parseCacheStats() == { 'hits': 3, 'misses': 5, 'size': 2, 'max_size': 200 }
+
+  for i in range( 0, 205 ):
+    parse( 'cc = {0}'.format( i ) )
+  assert parseCacheStats()[ 'size' ] == 200
+
+  parse( 'cc = 204' )
+  assert parseCacheStats()[ 'hits' ] == 4
+  parse( 'aa = 1' )  # fell off the end
+  assert parseCacheStats()[ 'misses' ] == 211
+
+  ast_cache.clear()
+
+
+def test_cache_threads():
+  cache = ASTCache( 5 )
+  error_list = []
+
+  def _worker( offset ):
+    try:
+      for i in range( 0, 5000 ):
+        key = str( ( i + offset ) % 8 )
+        if cache.get( key ) is None:
+          cache.set( key, key )
+    except Exception as e:
+      error_list.append( e )
+
+  thread_list = [ threading.Thread( target=_worker, args=( i, ) ) for i in range( 0, 8 ) ]
+  for thread in thread_list:
+    thread.start()
+
+  for thread in thread_list:
+    thread.join()
+
+  assert error_list == []
+  stats = cache.stats
+  assert stats[ 'size' ] == 5
+  assert stats[ 'hits' ] + stats[ 'misses' ] == 8 * 5000
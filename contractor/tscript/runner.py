@@ -1,14 +1,28 @@
 import sys
+import time
 import uuid
 import traceback
 import datetime
 import copy
 import logging
+import threading
+from collections import OrderedDict, deque
 from importlib import import_module
 from django.conf import settings
 
 from contractor.tscript.parser import Types
 
+DISPATCH_LEASE_DEFAULT = 3600  # in seconds, how long a dispatched task has to return it's results before it is dispatched again, see ExternalFunction.dispatch_lease
+TRACE_BUFFER_SIZE = 500  # default number of entries a Tracer keeps
+
+# version of what Runner.__getstate__ returns:
+#   1: dict of module_list, object_list, state (a list of lists), variable_map, cur_line, contractor_cookie, and tracer when tracing
+#   2: tuple of ( version, module_list, object_list, state, variable_map, cur_line, contractor_cookie, tracer ), the state's Frames
+#      as tuples, see Frame.toList
+#   3: version 2 + profile
+# __setstate__ loads the older versions, change the version any time what is returned changes
+STATE_VERSION = 3
+
 
 # thrown when the scipt would like to pause execution, calling run() resumes execution
 class Pause( Exception ):
@@ -153,6 +167,30 @@ class ExternalFunction( object ):
     # this can be called multiple times before and after done is True and/or the  vaule has been retrieved
     return ''
 
+  @property
+  def wake_at( self ):
+    # return the datetime (UTC) before which done can not become True on it's own, ie: without fromSubcontractor or something else
+    # outside of the script acting on this function.  The job will not be run before then, unless something outside changes it.
+    # None means done may become True at any time, and the job is run every time the jobs are processed.
+    # keep in mind that subcontractor, users, and other processes cause this to be called
+    # this is called frequently, keep it light
+    return None
+
+  @property
+  def wake_hint( self ):
+    # return False if done may become True on it's own, ie: it depends on a local timer or polls something in done/run, even while
+    # the task is dispatched.  The job is then run every time the jobs are processed, instead of being left alone untill the results
+    # come back, the dispatch lease expires, or wake_at.
+    return True
+
+  @property
+  def dispatch_lease( self ):
+    # return the number of seconds subcontractor has to return the results of toSubcontractor, after that the task is considered lost
+    # and is dispatched again (with a new cookie, so late results are rejected), be generous, this is how long the slowest valid
+    # task can take.  None means use the DISPATCH_LEASE_MAP setting for the module, or DISPATCH_LEASE_DEFAULT.
+    # keep in mind toSubcontractor is called again when the lease expires, design acordingly
+    return None
+
   @property
   def value( self ):
     # this returns the return value of this function, called only once, after done returns True
@@ -231,6 +269,11 @@ class Interrupt( Exception ):
   pass
 
 
+# break execution until something outside the script (ie: a signal from the PXE/OS being installed) changes things
+class WaitForSignal( Interrupt ):
+  pass
+
+
 class Delay( ExternalFunction ):
   def __init__( self, *args, **kwargs ):
     super().__init__( *args, **kwargs )
@@ -244,6 +287,10 @@ class Delay( ExternalFunction ):
   def message( self ):
     return 'Waiting for {0} more seconds'.format( ( self.end_at - datetime.datetime.now( datetime.UTC ) ).seconds )
 
+  @property
+  def wake_at( self ):
+    return self.end_at
+
   def setup( self, parms ):
     seconds = 0
     minutes = 0
@@ -316,6 +363,17 @@ infix_logical_operator_map = {
                                'not': lambda a, b: not bool( a )
                              }
 
+infix_operator_map = {}  # operator -> ( group, function ), for the compiled AST, the group is the map the operator is from
+for group, operator_map in ( ( 'string', infix_string_operator_map ), ( 'math', infix_math_operator_map ), ( 'logical', infix_logical_operator_map ) ):
+  for operator, function in operator_map.items():
+    infix_operator_map.setdefault( operator, ( group, function ) )
+
+IMMUTABLE_TYPES = ( int, float, bool, str, type( None ), datetime.timedelta )  # values assignment does not need to deepcopy
+
+VALUE_TYPES = frozenset( ( Types.CONSTANT, Types.VARIABLE, Types.ARRAY, Types.MAP, Types.ARRAY_MAP_ITEM, Types.INFIX, Types.FUNCTION, Types.EXISTS ) )  # all the things that "return" a value
+
+COMPILE_CACHE_SIZE = 200  # number of compiled ASTs to keep, see compileAST
+
 
 def _debugDump( message, exception, ast, state ):
   import os
@@ -373,23 +431,235 @@ def _delta_to_string( delta ):
     return '{0}{1:02}:{2:02}'.format( sign, minutes, seconds )
 
 
+class _Unset( object ):  # marks a slot of a Frame that is not set yet, None is a value
+  def __repr__( self ):
+    return 'UNSET'
+
+  def __reduce__( self ):  # copies/pickles as the one UNSET
+    return 'UNSET'
+
+
+UNSET = _Unset()
+
+
+class Frame( object ):
+  """
+  A level of Runner.state, one for each level of the AST from the root to the current execution point.  This one
+  is for the types that keep nothing (LINE, JUMP_POINT, GOTO), see frame_class_map for the rest.  For reading,
+  frames also look like the list they are stored as, [ type, data, value ] for ValueFrame and
+  [ type, position, started, expires ] for ScopeFrame, leaving off what is not set.
+  """
+  __slots__ = ( 'op_type', )
+  data = UNSET
+  value = UNSET
+
+  def __init__( self, op_type ):
+    super().__init__()
+    self.op_type = op_type
+
+  def toList( self ):
+    return [ self.op_type ]
+
+  def __len__( self ):
+    return len( self.toList() )
+
+  def __getitem__( self, index ):
+    return self.toList()[ index ]
+
+  def __eq__( self, other ):
+    if isinstance( other, Frame ):
+      other = other.toList()
+
+    return self.toList() == other
+
+  __hash__ = None
+
+  def __repr__( self ):
+    return repr( self.toList() )
+
+
+class ValueFrame( Frame ):
+  """
+  Frame for everything but SCOPE and what Frame is for, data is the work in progress, value is the value it "returns"
+  """
+  __slots__ = ( 'data', 'value' )
+
+  def __init__( self, op_type, data=UNSET, value=UNSET ):
+    super().__init__( op_type )
+    self.data = data
+    self.value = value
+
+  def toList( self ):
+    if self.value is not UNSET:
+      return [ self.op_type, None if self.data is UNSET else self.data, self.value ]
+
+    if self.data is not UNSET:
+      return [ self.op_type, self.data ]
+
+    return [ self.op_type ]
+
+
+class ScopeFrame( Frame ):
+  """
+  Frame for SCOPE, position is the index of the child being run, started is when the scope was started, and expires
+  when the max_time is up (None when it is up, and the scope will pause the next time it is run)
+  """
+  __slots__ = ( 'position', 'started', 'expires' )
+
+  def __init__( self, op_type, position=UNSET, started=UNSET, expires=UNSET ):
+    super().__init__( op_type )
+    self.position = position
+    self.started = started
+    self.expires = expires
+
+  def toList( self ):
+    result = [ self.op_type ]
+    for item in ( self.position, self.started, self.expires ):
+      if item is UNSET:
+        break
+
+      result.append( item )
+
+    return result
+
+
+frame_class_map = {
+                    Types.SCOPE: ScopeFrame,
+                    Types.LINE: Frame,
+                    Types.JUMP_POINT: Frame,
+                    Types.GOTO: Frame
+                  }  # everything else is a ValueFrame
+
+
+def _newFrame( op_type ):
+  return frame_class_map.get( op_type, ValueFrame )( op_type )
+
+
+def _loadFrame( item ):  # from what Frame.toList returns
+  return frame_class_map.get( item[0], ValueFrame )( *item )
+
+
+class Tracer( object ):
+  """
+  Records what a Runner does, set it to Runner.tracer (None, the default, means no tracing).  The last size
+  entries are kept, and are pickled with the Runner, so a job's trace spans the runs of the job.  Entries are:
+    ( time, 'enter', line, level, type ) - a node is evaluated, level is the state index, type is the node's Types
+    ( time, 'leave', line, level, type, seconds, exception ) - the node is done or interrupted, exception is the name of what interrupted it, or None
+    ( time, 'call', line, module, name ) - a function is set up (ExternalFunction) or called (builtin and plain functions)
+    ( time, 'dispatch', line, module, function, redispatch ) - a function is handed to subcontractor, see Runner.toSubcontractor
+  time is a unix timestamp.
+  """
+  def __init__( self, size=TRACE_BUFFER_SIZE ):
+    super().__init__()
+    self.entry_list = deque( maxlen=size )
+
+  def enter( self, line, level, op_type ):
+    self.entry_list.append( ( time.time(), 'enter', line, level, op_type ) )
+
+  def leave( self, line, level, op_type, seconds, exception ):
+    self.entry_list.append( ( time.time(), 'leave', line, level, op_type, seconds, exception ) )
+
+  def call( self, line, module, name ):
+    self.entry_list.append( ( time.time(), 'call', line, module, name ) )
+
+  def dispatch( self, line, module, function, redispatch ):
+    self.entry_list.append( ( time.time(), 'dispatch', line, module, function, redispatch ) )
+
+  @property
+  def entries( self ):  # as a list of lists, for returning via the API
+    return [ list( entry ) for entry in self.entry_list ]
+
+  def __getstate__( self ):
+    return ( self.entry_list.maxlen, list( self.entry_list ) )
+
+  def __setstate__( self, state ):
+    self.entry_list = deque( state[1], maxlen=state[0] )
+
+
+class Profile( object ):
+  """
+  Per line totals of what a Runner does, set it to Runner.profile (None, the default, means no profiling).  Like
+  the Tracer it is pickled with the Runner, so the totals are for all the runs of the job.  For each line:
+    ops: number of operations (nodes evaluated)
+    seconds: wall time spent running the line, each operation's time goes to the line it is on
+    dispatch_seconds: wall time from when a function was handed to subcontractor, to when the results came back
+    resumptions: number of times the script was resumed on the line (after waiting on a function, a delay, a signal...)
+  """
+  def __init__( self ):
+    super().__init__()
+    self.line_map = {}  # line -> [ ops, seconds, dispatch_seconds, resumptions ]
+    self._line = None
+    self._last = None
+
+  def _entry( self, line ):
+    try:
+      return self.line_map[ line ]
+    except KeyError:
+      entry = self.line_map[ line ] = [ 0, 0.0, 0.0, 0 ]
+      return entry
+
+  def start( self, line, resumed ):  # run is starting
+    if resumed:
+      self._entry( line )[3] += 1
+
+    self._line = line
+    self._last = time.perf_counter()
+
+  def op( self, line ):
+    now = time.perf_counter()
+    self._entry( self._line )[1] += now - self._last
+    self._entry( line )[0] += 1
+    self._line = line
+    self._last = now
+
+  def stop( self ):  # run is done
+    if self._last is not None:
+      self._entry( self._line )[1] += time.perf_counter() - self._last
+
+    self._line = None
+    self._last = None
+
+  def dispatched( self, line, seconds ):
+    self._entry( line )[2] += seconds
+
+  @property
+  def lines( self ):  # as a list of dicts, for returning via the API
+    return [ { 'line': line, 'ops': entry[0], 'seconds': entry[1], 'dispatch_seconds': entry[2], 'resumptions': entry[3] } for line, entry in sorted( self.line_map.items(), key=lambda item: -1 if item[0] is None else item[0] ) ]
+
+  def __getstate__( self ):
+    return self.line_map
+
+  def __setstate__( self, state ):
+    self.line_map = state
+    self._line = None
+    self._last = None
+
+
 class Runner( object ):
-  def __init__( self, ast ):
+  def __init__( self, ast, compiled=None ):  # compiled: run the compiled AST (see compileAST), None -> settings.TSCRIPT_COMPILE
     super().__init__()
     self.ast = ast
 
     # serilize
     self.module_list = []   # list of the loaded modules
     self.object_list = []   # list of loaded embeded objects
-    self.state = []         # list of ( <type>, work values, [ return value ] ), for each level of the AST to the curent execution point
+    self.state = []         # list of Frame, for each level of the AST to the curent execution point
     self.variable_map = {}  # map of the variables, they are all global
     self.cur_line = 0
     self.contractor_cookie = None
+    self.tracer = None      # a Tracer to record what the runner does, None for no tracing
+    self.profile = None     # a Profile to total up what the runner does by line, None for no profiling
 
     # do not serlize
+    self.waiting_for_signal = False  # set by run
     self.jump_point_map = {}
     self.function_map = {}
     self.value_map = {}
+    if compiled is None:
+      compiled = getattr( settings, 'TSCRIPT_COMPILE', False )
+
+    self.compiled = compiled
+    self._eval = self._evaluateNode if compiled else self._evaluate
 
     # scan for all the jump points
     for i in range( 0, len( ast[1][ '_children' ] ) ):
@@ -411,7 +681,6 @@ class Runner( object ):
 
   @property
   def status( self ):  # list of ( % complete, operation, paramaters )
-    logging.debug( 'runner: status state: {0}'.format( self.state ) )
     if self.done or self.aborted:
       return [ ( 100.0, 'Scope', None ) ]
     if len( self.state ) == 0:
@@ -420,10 +689,9 @@ class Runner( object ):
     item_list = []  # ( scope position, scope length, scope type, scope data )
     operation = self.ast
     for step in self.state:  # condense into on loop, last status may be a blocking function with remote and status values
-      step_type = step[0]
-      try:
-        step_data = step[1]
-      except IndexError:
+      step_type = step.op_type
+      step_data = step.position if step_type == Types.SCOPE else step.data
+      if step_data is UNSET:
         step_data = None
 
       if step_type == Types.SCOPE:
@@ -434,9 +702,9 @@ class Runner( object ):
           except ( KeyError, TypeError ):
             pass
 
-        try:
-          elapsed = datetime.datetime.now( datetime.UTC ) - step[2]
-        except IndexError:
+        if step.started is not UNSET:
+          elapsed = datetime.datetime.now( datetime.UTC ) - step.started
+        else:
           elapsed = datetime.timedelta(0)
         tmp[ 'time_elapsed' ] = _delta_to_string( elapsed )
         if 'expected_time' in operation[1]:
@@ -512,8 +780,6 @@ class Runner( object ):
       else:
         raise Exception( 'Confused step type "{0}"'.format( step_type ) )
 
-    logging.debug( 'runner: status item_list {0}'.format( item_list ) )
-
     result = []
     last_perc_complete = 0
     for item in reversed( item_list ):  # work backwards, as we go up, we scale the last perc_complete acording to the % of the curent scope
@@ -530,7 +796,7 @@ class Runner( object ):
     except KeyError:
       raise NotDefinedError( jump_point )
 
-    self.state = [ [ Types.SCOPE, pos ] ]
+    self.state = [ ScopeFrame( Types.SCOPE, pos ) ]
 
   def run( self, ttl=1000 ):
     logging.debug( 'runner: run start' )
@@ -541,10 +807,26 @@ class Runner( object ):
       return 'done'
 
     self.ttl = ttl
+    self.waiting_for_signal = False
+    root = compileAST( self.ast ) if self.compiled else self.ast
+
+    for obj in self.object_list:  # objects can cache things for the length of a run, ie: ConfigPlugin
+      if hasattr( obj, 'startRun' ):
+        obj.startRun()
+
+    if self.profile is None:
+      return self._run( root )
 
+    self.profile.start( self.cur_line, self.state != [] )
+    try:
+      return self._run( root )
+    finally:
+      self.profile.stop()
+
+  def _run( self, root ):
     while True:  # we are a while loop for the benifit of the goto
       try:
-        self._evaluate( self.ast, 0 )
+        self._eval( root, 0 )
         return ''
 
       except Goto as e:  # yank the stack to this jump point,  NOTE: jump points can only be in the global scope
@@ -555,6 +837,7 @@ class Runner( object ):
           raise NotDefinedError( e.name, e.line_no )
 
       except Interrupt as e:
+        self.waiting_for_signal = isinstance( e, WaitForSignal )
         return str( e )
 
       except ( Pause, ExecutionError ) as e:
@@ -569,19 +852,14 @@ class Runner( object ):
         logging.exception( 'runner: Unahndled Exception' )
         raise UnrecoverableError( 'Unahndled Exception ({0}): "{1}"\ntrace:\n{2}'.format( type( e ).__name__, str( e ), traceback.format_exc() ) )
 
-    logging.debug( 'runner: run finish' )
-
   def _evaluate( self, operation, state_index ):
-    logging.debug( 'runner: _evaluate level: "{0}" operation: "{1}"'.format( state_index, operation ) )
-    logging.debug( 'runner: _evaluate level: "{0}" start state: "{1}"'.format( state_index, self.state ) )
-
     op_type = operation[0]
-    op_data = operation[1]
-    try:
-      if self.state[ state_index ][0] != op_type:
-        raise Exception( 'State type does not match AST type at {0}. Expected "{1}" got "{2}"'.format( state_index, self.state[ state_index ][0], op_type ) )
-    except IndexError:
-      self.state.append( [ op_type ] )
+    state = self.state
+    if len( state ) > state_index:
+      if state[ state_index ].op_type != op_type:
+        raise Exception( 'State type does not match AST type at {0}. Expected "{1}" got "{2}"'.format( state_index, state[ state_index ].op_type, op_type ) )
+    else:
+      state.append( _newFrame( op_type ) )
 
     if self.ttl <= 0:
       raise Timeout( self.cur_line )
@@ -595,514 +873,659 @@ class Runner( object ):
     # a blocking function, so you have to check if your state has been setup
     # and sometimes it has to be set up in stages and checked as if you
     # have or haven't been through it before.
-    if op_type == Types.LINE:
-      self.cur_line = operation[2]
-      self._evaluate( op_data, state_index + 1 )
+    try:
+      evaluator = evaluator_map[ op_type ]
+    except KeyError:
+      raise ScriptError( 'Unimplemented "{0}"'.format( op_type ), self.cur_line )
 
-    elif op_type == Types.SCOPE:
-      try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( 0 )
-        self.state[ state_index ].append( datetime.datetime.now( datetime.UTC ) )
-        if 'max_time' in op_data:
-          self.state[ state_index ].append( op_data[ 'max_time' ] + datetime.datetime.now( datetime.UTC )  )
+    if self.tracer is None and self.profile is None:
+      evaluator( self, operation[1], operation, state_index )
+    else:
+      self._observeEvaluate( evaluator, op_type, operation, state_index )
 
-      try:
-        if self.state[ state_index ][3] is None:
-          self.state[ state_index ][3] = datetime.datetime.now( datetime.UTC )  # last time was a timeout, so set it so next run will timeout
+    # if the op_type we just ran does not return a value, make sure it is cleaned up
+    if op_type not in VALUE_TYPES:
+      del self.state[ state_index: ]  # remove this an evertying after from the state
+    else:
+      del self.state[ state_index + 1: ]  # remove everything after this one, save this one's return value on the stack
 
-        elif datetime.datetime.now( datetime.UTC ) > self.state[ state_index ][3]:
-          self.state[ state_index ][3] = None
-          raise Pause( 'Max Time Elapsed' )
+    if not self.state:
+      self.state = 'DONE'
+      self.cur_line = None
 
-      except IndexError:  # no max time
-        pass
+  def _evaluateNode( self, node, state_index ):  # _evaluate for the compiled AST, see compileAST, the state is the same
+    state = self.state
+    if len( state ) > state_index:
+      if state[ state_index ].op_type != node.op_type:
+        raise Exception( 'State type does not match AST type at {0}. Expected "{1}" got "{2}"'.format( state_index, state[ state_index ].op_type, node.op_type ) )
+    else:
+      state.append( node.frame_class( node.op_type ) )
 
-      while self.state[ state_index ][1] < len( op_data[ '_children' ] ):
-        self._evaluate( op_data[ '_children' ][ self.state[ state_index ][ 1 ] ], state_index + 1 )
-        self.state[ state_index ][1] += 1
+    if self.ttl <= 0:
+      raise Timeout( self.cur_line )
 
-    elif op_type == Types.CONSTANT:  # reterieve constant value
-      try:
-        self.state[ state_index ][2] = op_data
-      except IndexError:
-        self.state[ state_index ] += [ None, op_data ]
+    self.ttl -= 1
 
-    elif op_type == Types.VARIABLE:  # reterieve variable value
-      if op_data[ 'module' ] is None:
-        try:
-          value = self.variable_map[ op_data[ 'name' ] ]
-        except KeyError:
-          raise NotDefinedError( op_data[ 'name' ], self.cur_line )
+    if self.tracer is None and self.profile is None:
+      node.evaluator( self, node.data, node, state_index )
+    else:
+      self._observeEvaluate( node.evaluator, node.op_type, node, state_index )
 
-      else:
-        try:
-          module = self.value_map[ op_data[ 'module' ] ]
-        except KeyError:
-          raise NotDefinedError( op_data[ 'module' ], self.cur_line )
+    if node.returns_value:
+      del self.state[ state_index + 1: ]
+    else:
+      del self.state[ state_index: ]
 
-        try:
-          getter = module[ op_data[ 'name' ] ][0]  # index 0 is the getter
-        except KeyError:
-          raise NotDefinedError( '{0}" of module "{1}'.format( op_data[ 'name' ], op_data[ 'module' ] ), self.cur_line )
+    if not self.state:
+      self.state = 'DONE'
+      self.cur_line = None
 
-        if getter is None:
-          raise ParamaterError( 'target', '"{0}" of module "{1}" is not gettable'.format( op_data[ 'name' ], op_data[ 'module' ] ), self.cur_line )
+  def _observeEvaluate( self, evaluator, op_type, operation, state_index ):  # evaluate with the tracer and/or profile
+    line = operation[2] if op_type == Types.LINE else self.cur_line
+    if self.profile is not None:
+      self.profile.op( line )
 
-        try:
-          value = getter()
-        except Exception as e:
-          _debugDump( 'getter "{0}" in module "{1}" error during setup on line "{2}"'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line ), e, self.ast, self.state )
-          raise UnrecoverableError( 'getter "{0}" in module "{1}" error during setup on line "{2}": "{3}"({4})'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line, str( e ), e.__class__.__name__) )
+    if self.tracer is None:
+      evaluator( self, operation[1], operation, state_index )
+      return
 
+    self.tracer.enter( line, state_index, op_type )
+    start = time.perf_counter()
+    exception = None
+    try:
+      evaluator( self, operation[1], operation, state_index )
+    except Exception as e:
+      exception = type( e ).__name__
+      raise
+
+    finally:
+      self.tracer.leave( self.cur_line, state_index, op_type, time.perf_counter() - start, exception )
+
+  def _value( self, operation, state_index ):  # evaluate operation at state_index, unless it allready has it's value (from before being interrupted), returns the value and removes it from the state
+    if len( self.state ) <= state_index or self.state[ state_index ].value is UNSET:
+      self._eval( operation, state_index )
+
+    value = self.state[ state_index ].value
+    del self.state[ state_index: ]
+    return value
+
+  def _evaluateLine( self, op_data, operation, state_index ):
+    self.cur_line = operation[2]
+    self._eval( op_data, state_index + 1 )
+
+  def _evaluateScope( self, op_data, operation, state_index ):
+    frame = self.state[ state_index ]
+    if frame.position is UNSET:
+      frame.position = 0
+      frame.started = datetime.datetime.now( datetime.UTC )
+      if 'max_time' in op_data:
+        frame.expires = op_data[ 'max_time' ] + datetime.datetime.now( datetime.UTC )
+
+    if frame.expires is not UNSET:
+      if frame.expires is None:
+        frame.expires = datetime.datetime.now( datetime.UTC )  # last time was a timeout, so set it so next run will timeout
+
+      elif datetime.datetime.now( datetime.UTC ) > frame.expires:
+        frame.expires = None
+        raise Pause( 'Max Time Elapsed' )
+
+    child_list = op_data[ '_children' ]
+    while frame.position < len( child_list ):
+      self._eval( child_list[ frame.position ], state_index + 1 )
+      frame.position += 1
+
+  def _evaluateConstant( self, op_data, operation, state_index ):  # reterieve constant value
+    self.state[ state_index ].value = op_data
+
+  def _evaluateVariable( self, op_data, operation, state_index ):  # reterieve variable value
+    if op_data[ 'module' ] is None:
       try:
-        self.state[ state_index ][2] = value
-      except IndexError:
-        self.state[ state_index ] += [ None, value ]
+        value = self.variable_map[ op_data[ 'name' ] ]
+      except KeyError:
+        raise NotDefinedError( op_data[ 'name' ], self.cur_line )
 
-    elif op_type == Types.ARRAY:  # return array
+    else:
       try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( [] )
-
-      for i in range( len( self.state[ state_index ][1] ), len( op_data ) ):
-        try:
-          self.state[ state_index + 1 ][2]
-        except IndexError:
-          self._evaluate( op_data[ i ], state_index + 1 )
-
-        self.state[ state_index ][1].append( self.state[ state_index + 1 ][2] )
-        self.state = self.state[ :( state_index + 1 ) ]
-
-      self.state[ state_index ].append( self.state[ state_index ][1] )
-      self.state[ state_index ][1] = None
+        module = self.value_map[ op_data[ 'module' ] ]
+      except KeyError:
+        raise NotDefinedError( op_data[ 'module' ], self.cur_line )
 
-    elif op_type == Types.MAP:  # return map
       try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( {} )
+        getter = module[ op_data[ 'name' ] ][0]  # index 0 is the getter
+      except KeyError:
+        raise NotDefinedError( '{0}" of module "{1}'.format( op_data[ 'name' ], op_data[ 'module' ] ), self.cur_line )
 
-      for key in op_data:
-        try:
-          self.state[ state_index + 1 ][2]
-        except IndexError:
-          self._evaluate( op_data[ key ], state_index + 1 )
+      if getter is None:
+        raise ParamaterError( 'target', '"{0}" of module "{1}" is not gettable'.format( op_data[ 'name' ], op_data[ 'module' ] ), self.cur_line )
 
-        self.state[ state_index ][1][ key ] = self.state[ state_index + 1 ][2]
-        self.state = self.state[ :( state_index + 1 ) ]
+      try:
+        value = getter()
+      except Exception as e:
+        _debugDump( 'getter "{0}" in module "{1}" error during setup on line "{2}"'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line ), e, self.ast, self.state )
+        raise UnrecoverableError( 'getter "{0}" in module "{1}" error during setup on line "{2}": "{3}"({4})'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line, str( e ), e.__class__.__name__) )
 
-      self.state[ state_index ].append( self.state[ state_index ][1] )
-      self.state[ state_index ][1] = None
+    self.state[ state_index ].value = value
 
-    elif op_type == Types.ARRAY_MAP_ITEM:  # reterieve array index value
-      try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( {} )
+  def _evaluateArray( self, op_data, operation, state_index ):  # return array
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = []
 
-      # evaluate the index
-      try:
-        self.state[ state_index ][1][ 'index' ]
-      except KeyError:
-        try:
-          self.state[ state_index + 1 ][2]
-        except IndexError:
-          self._evaluate( op_data[ 'index' ], state_index + 1 )
+    for i in range( len( frame.data ), len( op_data ) ):
+      frame.data.append( self._value( op_data[ i ], state_index + 1 ) )
 
-        self.state[ state_index ][1][ 'index' ] = self.state[ state_index + 1 ][2]
-        self.state = self.state[ :( state_index + 1 ) ]
+    frame.value = frame.data
+    frame.data = None
 
-      # look up the variable
-      if op_data[ 'module' ] is None:
-        try:
-          value = self.variable_map[ op_data[ 'name' ] ]
-        except KeyError:
-          raise NotDefinedError( op_data[ 'name' ], self.cur_line )
+  def _evaluateMap( self, op_data, operation, state_index ):  # return map
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = {}
 
-      else:
-        try:
-          module = self.value_map[ op_data[ 'module' ] ]
-        except KeyError:
-          raise NotDefinedError( op_data[ 'module' ], self.cur_line )
+    for key in op_data:
+      frame.data[ key ] = self._value( op_data[ key ], state_index + 1 )
 
-        try:
-          getter = module[ op_data[ 'name' ] ][0]  # index 0 is the getter
-        except KeyError:
-          raise NotDefinedError( '{0}" of "{1}'.format( op_data[ 'module' ], op_data[ 'name' ] ), self.cur_line )
+    frame.value = frame.data
+    frame.data = None
 
-        if getter is None:
-          raise ParamaterError( 'target', '"{0}" of "{1}" is not gettable'.format( op_data[ 'module' ], op_data[ 'name' ] ), self.cur_line )
+  def _evaluateArrayMapItem( self, op_data, operation, state_index ):  # reterieve array index value
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = {}
 
-        try:
-          value = getter()
-        except Exception as e:
-          _debugDump( 'getter "{0}" in module "{1}" error during setup on line "{2}"'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line ), e, self.ast, self.state )
-          raise UnrecoverableError( 'getter "{0}" in module "{1}" error during setup on line "{2}": "{3}"({4})'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line, str( e ), e.__class__.__name__) )
+    # evaluate the index
+    if 'index' not in frame.data:
+      frame.data[ 'index' ] = self._value( op_data[ 'index' ], state_index + 1 )
 
-      index = self.state[ state_index ][1][ 'index' ]
+    # look up the variable
+    if op_data[ 'module' ] is None:
+      try:
+        value = self.variable_map[ op_data[ 'name' ] ]
+      except KeyError:
+        raise NotDefinedError( op_data[ 'name' ], self.cur_line )
 
+    else:
       try:
-        value = value[ index ]
-      except ( IndexError, KeyError ):
-        raise NotDefinedError( 'Index/Key does not exist', self.cur_line )
+        module = self.value_map[ op_data[ 'module' ] ]
+      except KeyError:
+        raise NotDefinedError( op_data[ 'module' ], self.cur_line )
 
-      self.state[ state_index ][1] = None
       try:
-        self.state[ state_index ][2] = value
-      except IndexError:
-        self.state[ state_index ].append( value )
+        getter = module[ op_data[ 'name' ] ][0]  # index 0 is the getter
+      except KeyError:
+        raise NotDefinedError( '{0}" of "{1}'.format( op_data[ 'module' ], op_data[ 'name' ] ), self.cur_line )
 
-    elif op_type == Types.ASSIGNMENT:  # get the value from 'value', and assign it to the variable defined in 'target'
-      if op_data[ 'target' ][0] not in ( Types.VARIABLE, Types.ARRAY_MAP_ITEM ) or ( op_data[ 'target' ][0] == Types.ARRAY_MAP_ITEM and op_data[ 'target' ][1][ 'module' ] is not None ):
-        raise ParamaterError( 'target', 'Can only assign to variables', self.cur_line )
+      if getter is None:
+        raise ParamaterError( 'target', '"{0}" of "{1}" is not gettable'.format( op_data[ 'module' ], op_data[ 'name' ] ), self.cur_line )
 
       try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( {} )
-
-      if op_data[ 'target' ][0] == Types.ARRAY_MAP_ITEM:
-        try:
-          self.state[ state_index ][1][ 'index' ]
-        except KeyError:
-          try:
-            self.state[ state_index + 1 ][2]
-          except IndexError:
-            self._evaluate( op_data[ 'target' ][1][ 'index' ], state_index + 1 )
+        value = getter()
+      except Exception as e:
+        _debugDump( 'getter "{0}" in module "{1}" error during setup on line "{2}"'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line ), e, self.ast, self.state )
+        raise UnrecoverableError( 'getter "{0}" in module "{1}" error during setup on line "{2}": "{3}"({4})'.format( op_data[ 'name' ], op_data[ 'module' ], self.cur_line, str( e ), e.__class__.__name__) )
 
-          self.state[ state_index ][1][ 'index' ] = self.state[ state_index + 1 ][2]
-          self.state = self.state[ :( state_index + 1 ) ]
+    index = frame.data[ 'index' ]
 
-      try:
-        self.state[ state_index ][1][ 'value' ]
-      except KeyError:
-        try:
-          self.state[ state_index + 1 ][2]
-        except IndexError:
-          self._evaluate( op_data[ 'value' ], state_index + 1 )
+    try:
+      value = value[ index ]
+    except ( IndexError, KeyError ):
+      raise NotDefinedError( 'Index/Key does not exist', self.cur_line )
 
-        self.state[ state_index ][1][ 'value' ] = self.state[ state_index + 1 ][2]
-        self.state = self.state[ :( state_index + 1 ) ]
+    frame.data = None
+    frame.value = value
 
-      target = op_data[ 'target' ][1]
-      value = copy.deepcopy( self.state[ state_index ][1][ 'value' ] )
+  def _evaluateAssignment( self, op_data, operation, state_index ):  # get the value from 'value', and assign it to the variable defined in 'target'
+    if op_data[ 'target' ][0] not in ( Types.VARIABLE, Types.ARRAY_MAP_ITEM ) or ( op_data[ 'target' ][0] == Types.ARRAY_MAP_ITEM and op_data[ 'target' ][1][ 'module' ] is not None ):
+      raise ParamaterError( 'target', 'Can only assign to variables', self.cur_line )
 
-      if target[ 'module' ] is None:  # we don't evaluate the target, it can only be a variable
-        if op_data[ 'target' ][0] == Types.ARRAY_MAP_ITEM:
-          self.variable_map[ target[ 'name' ] ][ self.state[ state_index ][1][ 'index' ] ] = value
-        else:
-         self.variable_map[ target[ 'name' ] ] = value
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = {}
 
-      else:
-        try:
-          module = self.value_map[ target[ 'module' ] ]
-        except KeyError:
-          raise NotDefinedError( target[ 'module' ], self.cur_line )
+    if op_data[ 'target' ][0] == Types.ARRAY_MAP_ITEM and 'index' not in frame.data:
+      frame.data[ 'index' ] = self._value( op_data[ 'target' ][1][ 'index' ], state_index + 1 )
 
-        try:
-          setter = module[ target[ 'name' ] ][1]  # index 1 is the setter
-        except KeyError:
-          raise NotDefinedError( '{0}" of "{1}'.format( target[ 'module' ], target[ 'name' ] ), self.cur_line )
+    if 'value' not in frame.data:
+      frame.data[ 'value' ] = self._value( op_data[ 'value' ], state_index + 1 )
 
-        if setter is None:
-          raise ParamaterError( 'target', '"{0}" of "{1}" is not settable'.format( target[ 'module' ], target[ 'name' ] ), self.cur_line )
+    target = op_data[ 'target' ][1]
+    value = copy.deepcopy( frame.data[ 'value' ] )
 
-        try:
-          setter( value )
-        except Exception as e:
-          _debugDump( 'setter "{0}" in module "{1}" error on line "{2}"'.format( target[ 'name' ], target[ 'module' ], self.cur_line ), e, self.ast, self.state )
-          raise UnrecoverableError( 'setter "{0}" in module "{1}" error on line "{2}": "{3}"({4})'.format( target[ 'name' ], target[ 'module' ], self.cur_line, str( e ), e.__class__.__name__) )
+    if target[ 'module' ] is None:  # we don't evaluate the target, it can only be a variable
+      if op_data[ 'target' ][0] == Types.ARRAY_MAP_ITEM:
+        self.variable_map[ target[ 'name' ] ][ frame.data[ 'index' ] ] = value
+      else:
+       self.variable_map[ target[ 'name' ] ] = value
 
-    elif op_type == Types.INFIX:  # infix type operators
+    else:
       try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( {} )
+        module = self.value_map[ target[ 'module' ] ]
+      except KeyError:
+        raise NotDefinedError( target[ 'module' ], self.cur_line )
 
       try:
-        self.state[ state_index ][1][ 'left' ]
+        setter = module[ target[ 'name' ] ][1]  # index 1 is the setter
       except KeyError:
-        try:
-          self.state[ state_index + 1 ][2]
-        except IndexError:
-          self._evaluate( op_data[ 'left' ], state_index + 1 )
+        raise NotDefinedError( '{0}" of "{1}'.format( target[ 'module' ], target[ 'name' ] ), self.cur_line )
 
-        self.state[ state_index ][1][ 'left' ] = self.state[ state_index + 1 ][2]
-        self.state = self.state[ :( state_index + 1 ) ]
+      if setter is None:
+        raise ParamaterError( 'target', '"{0}" of "{1}" is not settable'.format( target[ 'module' ], target[ 'name' ] ), self.cur_line )
 
       try:
-        self.state[ state_index ][1][ 'right' ]
-      except KeyError:
-        try:
-          self.state[ state_index + 1 ][2]
-        except IndexError:
-          self._evaluate( op_data[ 'right' ], state_index + 1 )
+        setter( value )
+      except Exception as e:
+        _debugDump( 'setter "{0}" in module "{1}" error on line "{2}"'.format( target[ 'name' ], target[ 'module' ], self.cur_line ), e, self.ast, self.state )
+        raise UnrecoverableError( 'setter "{0}" in module "{1}" error on line "{2}": "{3}"({4})'.format( target[ 'name' ], target[ 'module' ], self.cur_line, str( e ), e.__class__.__name__) )
 
-        self.state[ state_index ][1][ 'right' ] = self.state[ state_index + 1 ][2]
-        self.state = self.state[ :( state_index + 1 ) ]
+  def _evaluateInfix( self, op_data, operation, state_index ):  # infix type operators
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = {}
 
-      left_val = self.state[ state_index ][1][ 'left' ]
-      right_val = self.state[ state_index ][1][ 'right' ]
+    if 'left' not in frame.data:
+      frame.data[ 'left' ] = self._value( op_data[ 'left' ], state_index + 1 )
 
-      if op_data[ 'operator' ] in infix_string_operator_map:  # the string group
-        if not isinstance( left_val, str ):
-          left_val = str( left_val )
-        if not isinstance( right_val, str ):
-          right_val = str( right_val )
+    if 'right' not in frame.data:
+      frame.data[ 'right' ] = self._value( op_data[ 'right' ], state_index + 1 )
 
-        value = infix_string_operator_map[ op_data[ 'operator' ] ]( left_val, right_val )
+    left_val = frame.data[ 'left' ]
+    right_val = frame.data[ 'right' ]
 
-      elif op_data[ 'operator' ] in infix_math_operator_map:  # the number group
-        if not isinstance( left_val, ( int, float, bool ) ):
-          raise ParamaterError( 'left of operator', 'must be numeric', self.cur_line )
-        if not isinstance( right_val, ( int, float, bool ) ):
-          raise ParamaterError( 'right of operator', 'must be numeric', self.cur_line )
+    if op_data[ 'operator' ] in infix_string_operator_map:  # the string group
+      if not isinstance( left_val, str ):
+        left_val = str( left_val )
+      if not isinstance( right_val, str ):
+        right_val = str( right_val )
 
-        value = infix_math_operator_map[ op_data[ 'operator' ] ]( left_val, right_val )
+      value = infix_string_operator_map[ op_data[ 'operator' ] ]( left_val, right_val )
 
-      elif op_data[ 'operator' ] in infix_logical_operator_map:  # the logical group
-        value = infix_logical_operator_map[ op_data[ 'operator' ] ]( left_val, right_val )
+    elif op_data[ 'operator' ] in infix_math_operator_map:  # the number group
+      if not isinstance( left_val, ( int, float, bool ) ):
+        raise ParamaterError( 'left of operator', 'must be numeric', self.cur_line )
+      if not isinstance( right_val, ( int, float, bool ) ):
+        raise ParamaterError( 'right of operator', 'must be numeric', self.cur_line )
 
-      else:
-        raise NotDefinedError( op_data[ 'operator' ], self.cur_line )
+      value = infix_math_operator_map[ op_data[ 'operator' ] ]( left_val, right_val )
+
+    elif op_data[ 'operator' ] in infix_logical_operator_map:  # the logical group
+      value = infix_logical_operator_map[ op_data[ 'operator' ] ]( left_val, right_val )
+
+    else:
+      raise NotDefinedError( op_data[ 'operator' ], self.cur_line )
+
+    frame.data = None
+    frame.value = value
 
-      self.state[ state_index ][1] = None
-      self.state[ state_index ].append( value )
+  def _evaluateFunction( self, op_data, operation, state_index ):  # FUNCTION
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = { 'paramaters': {} }
+
+    if frame.data is None:  # TODO: is there a better way to handle this?
+      pass
+      # function allready executed and was an Exception last time, just let things pass by us
+
+    else:
+      # get the paramaters
+      for key in op_data[ 'paramaters' ]:
+        if key not in frame.data[ 'paramaters' ]:
+          frame.data[ 'paramaters' ][ key ] = self._value( op_data[ 'paramaters' ][ key ], state_index + 1 )
 
-    elif op_type == Types.FUNCTION:  # FUNCTION
       try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( { 'paramaters': {} } )
+        handler = frame.data[ 'handler' ]
+      except KeyError:  # handler dosen't exist, let's find it and set it up
+        if op_data[ 'module' ] is None:  # built in function
+          try:
+            handler = builtin_function_map[ op_data[ 'name' ] ]
+          except KeyError:
+            raise NotDefinedError( op_data[ 'name' ], self.cur_line )
 
-      if self.state[ state_index ][1] is None:  # TODO: is there a better way to handle this?
-        pass
-        # function allready executed and was an Exception last time, just let things pass by us
+          module = '<builtin>'
 
-      else:
-        # get the paramaters
-        for key in op_data[ 'paramaters' ]:
+        else:  # external function
           try:
-            self.state[ state_index ][1][ 'paramaters' ][ key ]
+            module = self.function_map[ op_data[ 'module' ] ]
           except KeyError:
-            try:
-              self.state[ state_index + 1 ][2]
-            except IndexError:
-              self._evaluate( op_data[ 'paramaters' ][ key ], state_index + 1 )
+            raise NotDefinedError( op_data[ 'module' ], self.cur_line )
 
-            self.state[ state_index ][1][ 'paramaters' ][ key ] = self.state[ state_index + 1 ][2]
-            self.state = self.state[ :( state_index + 1 ) ]
+          try:
+            handler = module[ op_data[ 'name' ] ]()
+          except KeyError:
+            raise NotDefinedError( '{0}" of "{1}'.format( op_data[ 'module' ], op_data[ 'name' ] ), self.cur_line )
+          except TypeError:  # hm.... this is bad
+            raise UnrecoverableError( 'Handler init function failed "{0}" on line {1}, possibly trying to call the function directly?'.format( op_data[ 'name' ], self.cur_line ) )
 
-        try:
-          handler = self.state[ state_index ][1][ 'handler' ]
-        except KeyError:  # handler dosen't exist, let's find it and set it up
-          if op_data[ 'module' ] is None:  # built in function
-            try:
-              handler = builtin_function_map[ op_data[ 'name' ] ]
-            except KeyError:
-              raise NotDefinedError( op_data[ 'name' ], self.cur_line )
-
-            module = '<builtin>'
-
-          else:  # external function
-            try:
-              module = self.function_map[ op_data[ 'module' ] ]
-            except KeyError:
-              raise NotDefinedError( op_data[ 'module' ], self.cur_line )
-
-            try:
-              handler = module[ op_data[ 'name' ] ]()
-            except KeyError:
-              raise NotDefinedError( '{0}" of "{1}'.format( op_data[ 'module' ], op_data[ 'name' ] ), self.cur_line )
-            except TypeError:  # hm.... this is bad
-              raise UnrecoverableError( 'Handler init function failed "{0}" on line {1}, possibly trying to call the function directly?'.format( op_data[ 'name' ], self.cur_line ) )
-
-            module = op_data[ 'module' ]
-
-          if isinstance( handler, tuple ):
-            module = handler[0]  # yes, overlay what ever was here
-            handler = handler[1]
-
-          if isinstance( handler, ExternalFunction ):
-            handler._runner = self
-            try:
-              handler.setup( self.state[ state_index ][1][ 'paramaters' ] )
-
-            except ( ParamaterError, Pause, ExecutionError, UnrecoverableError, Interrupt ) as e:
-              raise e
-
-            except Exception as e:
-              _debugDump( 'Handler "{0}" in module "{1}" error on line "{2}"'.format( handler.__class__.__name__, module, self.cur_line ), e, self.ast, self.state )
-              raise UnrecoverableError( 'Handler "{0}" in module "{1}" error on line "{2}": "{3}"({4})'.format( handler.__class__.__name__, module, self.cur_line, str( e ), e.__class__.__name__) )
-
-            self.contractor_cookie = str( uuid.uuid4() )
-            self.state[ state_index ][1][ 'handler' ] = handler
-            self.state[ state_index ][1][ 'module' ] = module
-            self.state[ state_index ][1][ 'dispatched' ] = False
-
-          else:
-            try:
-              paramaters = self.state[ state_index ][1][ 'paramaters' ]
-            except TypeError as e:
-              raise ParamaterError( '<unknown>', e, self.cur_line )
-
-            try:
-              value = handler( **paramaters )
-            except ( ParamaterError, Pause, ExecutionError, UnrecoverableError, Interrupt ) as e:
-              raise e
-
-            except Exception as e:
-              _debugDump( 'Handler "{0}" in module "{1}" error on line "{2}"'.format( handler.__class__.__name__, module, self.cur_line ), e, self.ast, self.state )
-              raise UnrecoverableError( 'Handler "{0}" in module "{1}" error on line "{2}": "{3}"({4})'.format( handler.__class__.__name__, module, self.cur_line, str( e ), e.__class__.__name__) )
-
-        if isinstance( handler, ExternalFunction ):  # else was allready run and set a value above
+          module = op_data[ 'module' ]
+
+        if isinstance( handler, tuple ):
+          module = handler[0]  # yes, overlay what ever was here
+          handler = handler[1]
+
+        if self.tracer is not None:
+          self.tracer.call( self.cur_line, module, op_data[ 'name' ] )
+
+        if isinstance( handler, ExternalFunction ):
           handler._runner = self
           try:
-            if not handler.done:
-              handler.run()
-              raise Interrupt( handler.message )
-
-            value = handler.value
+            handler.setup( frame.data[ 'paramaters' ] )
 
-          except ( Pause, ExecutionError, UnrecoverableError, Interrupt ) as e:
+          except ( ParamaterError, Pause, ExecutionError, UnrecoverableError, Interrupt ) as e:
             raise e
 
           except Exception as e:
-            module = op_data.get( 'module', '<builtin>' )
-            _debugDump( 'Handler "{0}" in module "{1}" error during done/message/run/value on line "{2}"'.format( handler.__class__.__name__, module, self.cur_line ), e, self.ast, self.state )
-            raise UnrecoverableError( 'Handler "{0}" in module "{1}" error during done/message/run/value on line "{2}": "{3}"({4})'.format( handler.__class__.__name__, module, self.cur_line, str( e ), e.__class__.__name__) )
+            _debugDump( 'Handler "{0}" in module "{1}" error on line "{2}"'.format( handler.__class__.__name__, module, self.cur_line ), e, self.ast, self.state )
+            raise UnrecoverableError( 'Handler "{0}" in module "{1}" error on line "{2}": "{3}"({4})'.format( handler.__class__.__name__, module, self.cur_line, str( e ), e.__class__.__name__) )
 
-        self.state[ state_index ][1] = None
-        if isinstance( value, Exception ):
-          self.state[ state_index ].append( None )
-          raise value
+          self.contractor_cookie = str( uuid.uuid4() )
+          frame.data[ 'handler' ] = handler
+          frame.data[ 'module' ] = module
+          frame.data[ 'dispatched' ] = False
 
         else:
-          self.state[ state_index ].append( value )
+          try:
+            paramaters = frame.data[ 'paramaters' ]
+          except TypeError as e:
+            raise ParamaterError( '<unknown>', e, self.cur_line )
 
-    elif op_type == Types.WHILE:
-      try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( { 'doing': 'condition' } )  # this is so we remember what it was we were doing when interrupted
+          try:
+            value = handler( **paramaters )
+          except ( ParamaterError, Pause, ExecutionError, UnrecoverableError, Interrupt ) as e:
+            raise e
 
-      while True:
-        if self.state[ state_index ][1][ 'doing' ] == 'condition':
-          self._evaluate( op_data[ 'condition' ], state_index + 1 )
-          if not self.state[ state_index + 1 ][2]:
-            break
+          except Exception as e:
+            _debugDump( 'Handler "{0}" in module "{1}" error on line "{2}"'.format( handler.__class__.__name__, module, self.cur_line ), e, self.ast, self.state )
+            raise UnrecoverableError( 'Handler "{0}" in module "{1}" error on line "{2}": "{3}"({4})'.format( handler.__class__.__name__, module, self.cur_line, str( e ), e.__class__.__name__) )
 
-          self.state[ state_index ][1][ 'doing' ] = 'expression'
-          self.state = self.state[ :( state_index + 1 ) ]
+      if isinstance( handler, ExternalFunction ):  # else was allready run and set a value above
+        handler._runner = self
+        try:
+          if not handler.done:
+            handler.run()
+            raise Interrupt( handler.message )
 
-        if self.state[ state_index ][1][ 'doing' ] == 'expression':
-          self._evaluate( op_data[ 'expression' ], state_index + 1 )
-          self.state[ state_index ][1][ 'doing' ] = 'condition'
-          self.state = self.state[ :( state_index + 1 ) ]
+          value = handler.value
 
-    elif op_type == Types.IFELSE:
-      try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( { 'index': 0, 'doing': 'condition' } )
-
-      while self.state[ state_index ][1][ 'index' ] < len( op_data ):
-        if self.state[ state_index ][1][ 'doing' ] == 'condition':
-          if op_data[ self.state[ state_index ][1][ 'index' ] ][ 'condition' ] is None:
-            do_expression = True
-          else:
-            self._evaluate( op_data[ self.state[ state_index ][1][ 'index' ] ][ 'condition' ], state_index + 1 )
-            do_expression = self.state[ state_index + 1 ][2]
-            self.state = self.state[ :( state_index + 1 ) ]
-
-          if not do_expression:
-            self.state[ state_index ][1][ 'index' ] += 1
-            continue
-
-          self.state[ state_index ][1][ 'doing' ] = 'expression'
-
-        if self.state[ state_index ][1][ 'doing' ] == 'expression':
-          self._evaluate( op_data[ self.state[ state_index ][1][ 'index' ] ][ 'expression' ], state_index + 1 )
+        except ( Pause, ExecutionError, UnrecoverableError, Interrupt ) as e:
+          raise e
+
+        except Exception as e:
+          module = op_data.get( 'module', '<builtin>' )
+          _debugDump( 'Handler "{0}" in module "{1}" error during done/message/run/value on line "{2}"'.format( handler.__class__.__name__, module, self.cur_line ), e, self.ast, self.state )
+          raise UnrecoverableError( 'Handler "{0}" in module "{1}" error during done/message/run/value on line "{2}": "{3}"({4})'.format( handler.__class__.__name__, module, self.cur_line, str( e ), e.__class__.__name__) )
+
+      frame.data = None
+      if isinstance( value, Exception ):
+        frame.value = None
+        raise value
+
+      else:
+        frame.value = value
+
+  def _evaluateWhile( self, op_data, operation, state_index ):
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = { 'doing': 'condition' }  # this is so we remember what it was we were doing when interrupted
+
+    while True:
+      if frame.data[ 'doing' ] == 'condition':
+        self._eval( op_data[ 'condition' ], state_index + 1 )
+        if not self.state[ state_index + 1 ].value:
           break
 
-        self.state = self.state[ :( state_index + 1 ) ]
+        frame.data[ 'doing' ] = 'expression'
+        del self.state[ state_index + 1: ]
 
-    elif op_type == Types.EXISTS:
-      try:
-        self.state[ state_index ][1]
-      except IndexError:
-        self.state[ state_index ].append( None )
+      if frame.data[ 'doing' ] == 'expression':
+        self._eval( op_data[ 'expression' ], state_index + 1 )
+        frame.data[ 'doing' ] = 'condition'
+        del self.state[ state_index + 1: ]
 
-      try:
-        self._evaluate( op_data, state_index + 1 )
-        result = True
-      except NotDefinedError:
-        result = False
+  def _evaluateIfElse( self, op_data, operation, state_index ):
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = { 'index': 0, 'doing': 'condition' }
 
-      try:
-        self.state[ state_index ][2] = result
-      except IndexError:
-        self.state[ state_index ].append( result )
+    while frame.data[ 'index' ] < len( op_data ):
+      if frame.data[ 'doing' ] == 'condition':
+        if op_data[ frame.data[ 'index' ] ][ 'condition' ] is None:
+          do_expression = True
+        else:
+          self._eval( op_data[ frame.data[ 'index' ] ][ 'condition' ], state_index + 1 )
+          do_expression = self.state[ state_index + 1 ].value
+          del self.state[ state_index + 1: ]
 
-    elif op_type == Types.JUMP_POINT:  # just a NOP execution wise
-      pass
+        if not do_expression:
+          frame.data[ 'index' ] += 1
+          continue
 
-    elif op_type == Types.GOTO:
-      raise Goto( op_data, self.cur_line )
+        frame.data[ 'doing' ] = 'expression'
 
-    else:
-      raise ScriptError( 'Unimplemented "{0}"'.format( op_type ), self.cur_line )
+      if frame.data[ 'doing' ] == 'expression':
+        self._eval( op_data[ frame.data[ 'index' ] ][ 'expression' ], state_index + 1 )
+        break
 
-    # if the op_type we just ran does not return a value, make sure it is cleaned up
-    if op_type not in ( Types.CONSTANT, Types.VARIABLE, Types.ARRAY, Types.MAP, Types.ARRAY_MAP_ITEM, Types.INFIX, Types.FUNCTION, Types.EXISTS ):  # all the things that "return" a value
-      self.state = self.state[ :state_index ]  # remove this an evertying after from the state
-    else:
-      self.state = self.state[ :state_index + 1 ]  # remove everything after this one, save this one's return value on the stack
+      del self.state[ state_index + 1: ]
 
-    logging.debug( 'runner: _evaluate level: "{0}" final state: {1}'.format( state_index, self.state ) )
-    if self.state == []:
-      self.state = 'DONE'
-      self.cur_line = None
+  def _evaluateExists( self, op_data, operation, state_index ):
+    frame = self.state[ state_index ]
+    if frame.data is UNSET:
+      frame.data = None
+
+    try:
+      self._eval( op_data, state_index + 1 )
+      result = True
+    except NotDefinedError:
+      result = False
+
+    frame.value = result
+
+  def _evaluateJumpPoint( self, op_data, operation, state_index ):  # just a NOP execution wise
+    pass
+
+  def _evaluateGoto( self, op_data, operation, state_index ):
+    raise Goto( op_data, self.cur_line )
+
+  # the evaluators for the compiled AST, for the common shapes of the common nodes, see _compile.  They do the
+  # same thing to the state as the _evaluateXXX for the node's type, with less looking things up.
+  def _compiledLine( self, op_data, node, state_index ):
+    self.cur_line = node[2]
+    self._evaluateNode( op_data, state_index + 1 )
+
+  def _compiledConstant( self, op_data, node, state_index ):
+    self.state[ state_index ].value = op_data
+
+  def _compiledVariable( self, op_data, node, state_index ):  # variable not in a module
+    try:
+      self.state[ state_index ].value = self.variable_map[ op_data[ 'name' ] ]
+    except KeyError:
+      raise NotDefinedError( op_data[ 'name' ], self.cur_line )
+
+  def _compiledInfix( self, op_data, node, state_index ):
+    frame = self.state[ state_index ]
+    work = frame.data
+    if work is UNSET:
+      work = frame.data = {}
+
+    if 'left' not in work:
+      work[ 'left' ] = self._value( op_data[ 'left' ], state_index + 1 )
+
+    if 'right' not in work:
+      work[ 'right' ] = self._value( op_data[ 'right' ], state_index + 1 )
+
+    left_val = work[ 'left' ]
+    right_val = work[ 'right' ]
+
+    if node.operator is None:
+      raise NotDefinedError( op_data[ 'operator' ], self.cur_line )
+
+    ( group, function ) = node.operator
+    if group == 'string':
+      if not isinstance( left_val, str ):
+        left_val = str( left_val )
+      if not isinstance( right_val, str ):
+        right_val = str( right_val )
+
+    elif group == 'math':
+      if not isinstance( left_val, ( int, float, bool ) ):
+        raise ParamaterError( 'left of operator', 'must be numeric', self.cur_line )
+      if not isinstance( right_val, ( int, float, bool ) ):
+        raise ParamaterError( 'right of operator', 'must be numeric', self.cur_line )
+
+    frame.value = function( left_val, right_val )
+    frame.data = None
+
+  def _compiledAssignment( self, op_data, node, state_index ):  # assignment to a variable not in a module
+    frame = self.state[ state_index ]
+    work = frame.data
+    if work is UNSET:
+      work = frame.data = {}
+
+    if 'value' not in work:
+      work[ 'value' ] = self._value( op_data[ 'value' ], state_index + 1 )
+
+    value = work[ 'value' ]
+    if not isinstance( value, IMMUTABLE_TYPES ):
+      value = copy.deepcopy( value )
+
+    self.variable_map[ op_data[ 'target' ][1][ 'name' ] ] = value
+
+  def _evaluateUnimplemented( self, op_data, operation, state_index ):
+    raise ScriptError( 'Unimplemented "{0}"'.format( operation[0] ), self.cur_line )
+
+  def wakeHint( self ):
+    """
+    Returns ( waiting_on, wake_at ), what the script needs before it can get any further, only meaningful after run
+    and toSubcontractor.
+      waiting_on: '' -> nothing outside the script, 'signal' -> a signal, 'dispatch' -> the results of a dispatched function
+      wake_at: datetime (UTC) when the script may be able to continue without waiting_on happening (delay ends,
+               max_time expires), None if there is no such time
+    ( '', None ) means the script may be able to continue at any time.
+    """
+    if self.done or self.aborted or self.state == []:
+      return ( '', None )
+
+    wake_at = None
+    for step in self.state:  # anything in a begin with a max_time needs to be woken up to be paused
+      if step.op_type != Types.SCOPE or step.expires is UNSET:
+        continue
+
+      if step.expires is None:  # timed out last time, and will pause next time
+        return ( '', None )
+
+      if wake_at is None or step.expires < wake_at:
+        wake_at = step.expires
+
+    function_state = self.state[ -1 ].data
+    if self.state[ -1 ].op_type != Types.FUNCTION or not isinstance( function_state, dict ):
+      return ( '', None )
+
+    if 'handler' not in function_state:  # not an ExternalFunction, it is called each time it is run
+      if self.waiting_for_signal:
+        return ( 'signal', wake_at )
+
+      return ( '', None )
+
+    if not self._handlerHint( function_state, 'wake_hint', True ):
+      return ( '', None )
+
+    if function_state.get( 'dispatched', False ):
+      lease_expires = self._dispatchLeaseExpires( function_state )
+      if lease_expires is not None and ( wake_at is None or lease_expires < wake_at ):
+        wake_at = lease_expires
+
+      return ( 'dispatch', wake_at )
+
+    handler_wake_at = self._handlerHint( function_state, 'wake_at', None )
+    if handler_wake_at is None:
+      return ( '', None )
+
+    if wake_at is None or handler_wake_at < wake_at:
+      wake_at = handler_wake_at
+
+    return ( '', wake_at )
+
+  def _handlerHint( self, function_state, name, default ):  # a bug in the plugin's property, should not stop the job from being saved
+    try:
+      return getattr( function_state[ 'handler' ], name )
+    except Exception:
+      logging.exception( 'runner: Handler "{0}" in module "{1}" error getting "{2}" on line "{3}", using "{4}"'.format( function_state[ 'handler' ].__class__.__name__, function_state[ 'module' ], name, self.cur_line, default ) )
+      return default
 
   def toSubcontractor( self, subcontractor_module_list ):
     # return None if we done, or not started
     if self.done or self.aborted or self.state == []:
       return None
 
-    operation = self.state[ -1 ]
-
-    if operation[0] != Types.FUNCTION and operation[0]:  # not a function
+    if self.state[ -1 ].op_type != Types.FUNCTION:  # not a function
       return None
 
-    if operation[1] is None:  # the operation isn't setup yet
+    function_state = self.state[ -1 ].data
+    if not isinstance( function_state, dict ):  # the function isn't setup yet, or is done
       return None
 
     try:
-      if operation[1][ 'module' ] not in subcontractor_module_list:
-        return None
+      module = function_state[ 'module' ]
     except KeyError:
       return None  # function is not external
 
-    if operation[1][ 'dispatched' ] is True:  # allready dispatchced, don't send anything else until something comes back
+    if subcontractor_module_list is not None and module not in subcontractor_module_list:  # None is any module, see Foreman.lib.prepareTasks
       return None
 
-    handler = operation[1][ 'handler' ]
+    redispatch = False
+    if function_state[ 'dispatched' ] is True:  # allready dispatchced, don't send anything else until something comes back, or the lease expires
+      if not self.dispatchExpired():
+        return None
+
+      redispatch = True
+
+    handler = function_state[ 'handler' ]
     handler._runner = self
     try:
       paramaters = handler.toSubcontractor()
     except Exception as e:
-      _debugDump( 'Handler "{0}" in module "{1}" error during toSubcontractor on line "{2}"'.format( handler.__class__.__name__, operation[1][ 'module' ], self.cur_line ), e, self.ast, self.state )
+      _debugDump( 'Handler "{0}" in module "{1}" error during toSubcontractor on line "{2}"'.format( handler.__class__.__name__, function_state[ 'module' ], self.cur_line ), e, self.ast, self.state )
       return None  # TODO: log something?
 
     if paramaters is None:
       return None
 
-    operation[1][ 'dispatched' ] = True
+    if redispatch:
+      self.contractor_cookie = str( uuid.uuid4() )  # revoke the lost task, so if it does come back it is rejected
+      function_state[ 'redispatch_count' ] = function_state.get( 'redispatch_count', 0 ) + 1
+
+    function_state[ 'dispatched' ] = True
+    function_state[ 'dispatched_at' ] = datetime.datetime.now( datetime.UTC )
+    if self.tracer is not None:
+      self.tracer.dispatch( self.cur_line, function_state[ 'module' ], paramaters[0], redispatch )
+
+    return { 'module': function_state[ 'module' ], 'function': paramaters[0], 'cookie': self.contractor_cookie, 'paramaters': paramaters[1] }
+
+  def _dispatchLeaseExpires( self, function_state ):
+    try:
+      dispatched_at = function_state[ 'dispatched_at' ]
+    except KeyError:
+      return None  # dispatched before the leases, those are left waiting
+
+    lease = function_state[ 'handler' ].dispatch_lease
+    if lease is None:
+      lease = getattr( settings, 'DISPATCH_LEASE_MAP', {} ).get( function_state[ 'module' ], DISPATCH_LEASE_DEFAULT )
 
-    return { 'module': operation[1][ 'module' ], 'function': paramaters[0], 'cookie': self.contractor_cookie, 'paramaters': paramaters[1] }
+    return dispatched_at + datetime.timedelta( seconds=lease )
+
+  def dispatchExpired( self ):
+    """
+    Returns True if the current function was dispatched to subcontractor and the results did not come back
+    before the dispatch lease expired, toSubcontractor will dispatch it again.
+    """
+    if self.done or self.aborted or self.state == []:
+      return False
+
+    function_state = self.state[ -1 ].data
+    if self.state[ -1 ].op_type != Types.FUNCTION or not isinstance( function_state, dict ) or not function_state.get( 'dispatched', False ):
+      return False
+
+    lease_expires = self._dispatchLeaseExpires( function_state )
+    return lease_expires is not None and lease_expires <= datetime.datetime.now( datetime.UTC )
 
   def fromSubcontractor( self, cookie, data ):
     if self.done or self.aborted or self.state == []:
@@ -1111,23 +1534,25 @@ class Runner( object ):
     if cookie != self.contractor_cookie:
       return ( 'Bad Cookie', None )
 
-    operation = self.state[ -1 ]
-
-    if operation[0] != Types.FUNCTION:
+    if self.state[ -1 ].op_type != Types.FUNCTION:
       return ( 'Not At a Function', None )
 
-    if operation[1][ 'dispatched' ] is False:
+    function_state = self.state[ -1 ].data
+
+    if function_state[ 'dispatched' ] is False:
       return ( 'Not Expecting Anything', None )
 
-    handler = operation[1][ 'handler' ]
+    handler = function_state[ 'handler' ]
     handler._runner = self
     try:
       handler.fromSubcontractor( data )
     except Exception as e:
-      _debugDump( 'Handler "{0}" in module "{1}" error during fromSubcontractor on line "{2}"'.format( handler.__class__.__name__, operation[1][ 'module' ], self.cur_line ), e, self.ast, self.state )
+      _debugDump( 'Handler "{0}" in module "{1}" error during fromSubcontractor on line "{2}"'.format( handler.__class__.__name__, function_state[ 'module' ], self.cur_line ), e, self.ast, self.state )
       return ( 'Error', None )  # TODO: log something?
 
-    operation[1][ 'dispatched' ] = False
+    function_state[ 'dispatched' ] = False
+    if self.profile is not None and 'dispatched_at' in function_state:
+      self.profile.dispatched( self.cur_line, ( datetime.datetime.now( datetime.UTC ) - function_state[ 'dispatched_at' ] ).total_seconds() )
 
     return ( 'Accepted', handler.message )
 
@@ -1135,15 +1560,14 @@ class Runner( object ):
     if self.done or self.aborted or self.state == []:
       return
 
-    operation = self.state[ -1 ]
-
-    if operation[0] != Types.FUNCTION:
+    if self.state[ -1 ].op_type != Types.FUNCTION:
       return
 
-    if not isinstance( operation[1], dict ) or 'dispatched' not in operation[1]:
+    function_state = self.state[ -1 ].data
+    if not isinstance( function_state, dict ) or 'dispatched' not in function_state:
       return  # or?: raise Exception( 'Function is not dispatched or has allready returned its value' ), we don't say anything if it's not a function
 
-    operation[1][ 'dispatched' ] = False
+    function_state[ 'dispatched' ] = False
 
     return
 
@@ -1151,12 +1575,12 @@ class Runner( object ):
     if self.done or self.aborted or self.state == []:
       return 'Script not Running'
 
-    operation = self.state[ -1 ]
-
-    if operation[0] != Types.FUNCTION:
+    if self.state[ -1 ].op_type != Types.FUNCTION:
       return 'Not At a Function'
 
-    handler = operation[1][ 'handler' ]
+    function_state = self.state[ -1 ].data
+
+    handler = function_state[ 'handler' ]
     try:
       handler.rollback()
 
@@ -1164,11 +1588,11 @@ class Runner( object ):
       return 'Rollback not possible'
 
     except Exception as e:
-      _debugDump( 'Handler "{0}" in module "{1}" error starting rollback on line "{2}"'.format( handler.__class__.__name__, operation[1][ 'module' ], self.cur_line ), e, self.ast, self.state )
+      _debugDump( 'Handler "{0}" in module "{1}" error starting rollback on line "{2}"'.format( handler.__class__.__name__, function_state[ 'module' ], self.cur_line ), e, self.ast, self.state )
       return 'Exception while trying to rollback'  # TODO: log?
 
     self.contractor_cookie = str( uuid.uuid4() )  # revoke any outstanding tasks, TODO: do we also rotate cookie on reset?  if not, should we rotate keys even if rollback is  not possible
-    operation[1][ 'dispatched' ] = False
+    function_state[ 'dispatched' ] = False
 
     return 'Done'
 
@@ -1207,16 +1631,170 @@ class Runner( object ):
   def __reduce__( self ):
     return ( self.__class__, ( self.ast, ), self.__getstate__() )
 
-  def __getstate__( self ):
-    return { 'module_list': self.module_list, 'object_list': self.object_list, 'state': self.state, 'variable_map': self.variable_map, 'cur_line': self.cur_line, 'contractor_cookie': self.contractor_cookie }
+  def dumpState( self ):
+    """
+    Returns the state as lists, see Frame, or the 'DONE'/'ABORTED' string.
+    """
+    if isinstance( self.state, str ):
+      return self.state
+
+    return [ frame.toList() for frame in self.state ]
+
+  def __getstate__( self ):  # see STATE_VERSION
+    if isinstance( self.state, str ):
+      state = self.state
+    else:
+      state = [ tuple( frame.toList() ) for frame in self.state ]
+
+    return ( STATE_VERSION, self.module_list, self.object_list, state, self.variable_map, self.cur_line, self.contractor_cookie, self.tracer, self.profile )
 
   def __setstate__( self, state ):
-    self.state = state[ 'state' ]
-    self.variable_map = state[ 'variable_map' ]
-    self.cur_line = state[ 'cur_line' ]
-    self.contractor_cookie = state[ 'contractor_cookie' ]
-    for module in state[ 'module_list' ]:
+    if isinstance( state, dict ):  # version 1
+      state = ( 1, state[ 'module_list' ], state[ 'object_list' ], state[ 'state' ], state[ 'variable_map' ], state[ 'cur_line' ], state[ 'contractor_cookie' ], state.get( 'tracer', None ) )
+
+    if state[0] > STATE_VERSION:
+      raise ValueError( 'Runner state version "{0}" is newer than this Runner\'s "{1}"'.format( state[0], STATE_VERSION ) )
+
+    if state[0] < 3:
+      state = tuple( state ) + ( None, )
+
+    ( _, module_list, object_list, frame_list, self.variable_map, self.cur_line, self.contractor_cookie, self.tracer, self.profile ) = state
+    if isinstance( frame_list, str ):
+      self.state = frame_list
+    else:
+      self.state = [ _loadFrame( item ) for item in frame_list ]
+
+    for module in module_list:
       self.registerModule( module )
 
-    for obj in state[ 'object_list' ]:
+    for obj in object_list:
       self.registerObject( obj )
+
+
+evaluator_map = {
+                  Types.LINE: Runner._evaluateLine,
+                  Types.SCOPE: Runner._evaluateScope,
+                  Types.CONSTANT: Runner._evaluateConstant,
+                  Types.VARIABLE: Runner._evaluateVariable,
+                  Types.ARRAY: Runner._evaluateArray,
+                  Types.MAP: Runner._evaluateMap,
+                  Types.ARRAY_MAP_ITEM: Runner._evaluateArrayMapItem,
+                  Types.ASSIGNMENT: Runner._evaluateAssignment,
+                  Types.INFIX: Runner._evaluateInfix,
+                  Types.FUNCTION: Runner._evaluateFunction,
+                  Types.WHILE: Runner._evaluateWhile,
+                  Types.IFELSE: Runner._evaluateIfElse,
+                  Types.EXISTS: Runner._evaluateExists,
+                  Types.JUMP_POINT: Runner._evaluateJumpPoint,
+                  Types.GOTO: Runner._evaluateGoto
+                }
+
+
+class Node( tuple ):
+  """
+  A node of the compiled AST, it is the same tuple as the parser's ( type, data[, line ] ), with the operations
+  in data replaced by their Nodes, so everything that looks at the AST works the same.  The evaluator is picked
+  when compiled, by the type and for some types by the shape of the node (see _compile), instead
+  of every time the node is run.
+  """
+  def __new__( cls, operation, data ):
+    node = super().__new__( cls, ( operation[0], data ) + tuple( operation[ 2: ] ) )
+    node.op_type = operation[0]
+    node.data = data
+    node.evaluator = evaluator_map.get( operation[0], Runner._evaluateUnimplemented )
+    node.returns_value = operation[0] in VALUE_TYPES
+    node.frame_class = frame_class_map.get( operation[0], ValueFrame )
+    node.operator = None
+    return node
+
+  def __reduce__( self ):  # pickle/copy as the plain AST
+    return ( tuple, ( tuple( self ), ) )
+
+
+def _compile( operation ):
+  op_type = operation[0]
+  op_data = operation[1]
+
+  if op_type in ( Types.LINE, Types.EXISTS ):
+    data = _compile( op_data )
+
+  elif op_type == Types.SCOPE:
+    data = dict( op_data )
+    data[ '_children' ] = [ _compile( i ) for i in op_data[ '_children' ] ]
+
+  elif op_type == Types.ARRAY:
+    data = [ _compile( i ) for i in op_data ]
+
+  elif op_type == Types.MAP:
+    data = dict( ( key, _compile( value ) ) for key, value in op_data.items() )
+
+  elif op_type == Types.ARRAY_MAP_ITEM:
+    data = dict( op_data )
+    data[ 'index' ] = _compile( op_data[ 'index' ] )
+
+  elif op_type == Types.ASSIGNMENT:
+    data = { 'target': _compile( op_data[ 'target' ] ), 'value': _compile( op_data[ 'value' ] ) }
+
+  elif op_type == Types.INFIX:
+    data = dict( op_data )
+    data[ 'left' ] = _compile( op_data[ 'left' ] )
+    data[ 'right' ] = _compile( op_data[ 'right' ] )
+
+  elif op_type == Types.FUNCTION:
+    data = dict( op_data )
+    data[ 'paramaters' ] = dict( ( key, _compile( value ) ) for key, value in op_data[ 'paramaters' ].items() )
+
+  elif op_type == Types.WHILE:
+    data = { 'condition': _compile( op_data[ 'condition' ] ), 'expression': _compile( op_data[ 'expression' ] ) }
+
+  elif op_type == Types.IFELSE:
+    data = [ { 'condition': None if branch[ 'condition' ] is None else _compile( branch[ 'condition' ] ), 'expression': _compile( branch[ 'expression' ] ) } for branch in op_data ]
+
+  else:  # CONSTANT, VARIABLE, JUMP_POINT, GOTO, and anything else, have no operations in their data
+    data = op_data
+
+  node = Node( operation, data )
+
+  if op_type == Types.LINE:
+    node.evaluator = Runner._compiledLine
+
+  elif op_type == Types.CONSTANT:
+    node.evaluator = Runner._compiledConstant
+
+  elif op_type == Types.VARIABLE and op_data[ 'module' ] is None:
+    node.evaluator = Runner._compiledVariable
+
+  elif op_type == Types.INFIX:
+    node.evaluator = Runner._compiledInfix
+    node.operator = infix_operator_map.get( op_data[ 'operator' ], None )
+
+  elif op_type == Types.ASSIGNMENT and op_data[ 'target' ][0] == Types.VARIABLE and op_data[ 'target' ][1][ 'module' ] is None:
+    node.evaluator = Runner._compiledAssignment
+
+  return node
+
+
+_compile_cache = OrderedDict()  # id( ast ) -> ( ast, compiled ast ), the ast is kept so it's id is not reused while it is in the cache
+_compile_cache_lock = threading.Lock()
+
+
+def compileAST( ast ):
+  """
+  Returns the compiled ast, for Runner.  The ASTs from the parser (and ParsedScript) are shared and not modified
+  so the compiled ASTs are cached by the ast's identity.  An entry is only used if it's ast is ast, so an ast
+  that has been freed, and another ast that is given it's id, do not share the compiled ast.
+  """
+  key = id( ast )
+  with _compile_cache_lock:
+    entry = _compile_cache.get( key, None )
+    if entry is not None and entry[0] is ast:
+      _compile_cache.move_to_end( key )
+      return entry[1]
+
+  compiled = _compile( ast )  # outside of the lock, if another thread is compiling the same ast, the last one is kept
+  with _compile_cache_lock:
+    _compile_cache[ key ] = ( ast, compiled )
+    while len( _compile_cache ) > COMPILE_CACHE_SIZE:
+      _compile_cache.popitem( last=False )
+
+  return compiled
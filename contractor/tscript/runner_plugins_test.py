@@ -74,6 +74,12 @@ class Remote( ExternalFunction ):
     self.counter = state[1]
 
 
+class RemotePolling( Remote ):  # done can become True without the results, ie: it polls something
+  @property
+  def wake_hint( self ):
+    return False
+
+
 class Count( ExternalFunction ):
   def __init__( self, *args, **kwargs ):
     super().__init__( *args, **kwargs )
@@ -143,6 +149,7 @@ TSCRIPT_FUNCTIONS = {
                       'constant': Constant,
                       'multiply': Multiply,
                       'remote': Remote,
+                      'remote_polling': RemotePolling,
                       'count': Count
                     }
 
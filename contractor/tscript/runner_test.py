@@ -1,13 +1,23 @@
+import copy
 import pytest
 import pickle
 import time
+import threading
+from datetime import datetime, timedelta, timezone
 
+from contractor.tscript import runner_plugins_test
 from contractor.tscript.parser import parse
-from contractor.tscript.runner import Runner, ExecutionError, UnrecoverableError, ParamaterError, NotDefinedError, Timeout, Pause
+from contractor.tscript.runner import Runner, Tracer, Profile, ScopeFrame, ValueFrame, compileAST, COMPILE_CACHE_SIZE, STATE_VERSION, DISPATCH_LEASE_DEFAULT, ExecutionError, UnrecoverableError, ParamaterError, NotDefinedError, Timeout, Pause, WaitForSignal
 
 # TODO: test the assignment deepcopy, ie: a = {}, b = a  make sure changes to b are not reflected in a
 
 
+@pytest.fixture( autouse=True, params=[ False, True ], ids=[ 'interpreted', 'compiled' ] )
+def tscript_compile( request, settings ):  # run everything with and without the compiled AST
+  settings.TSCRIPT_COMPILE = request.param
+  return request.param
+
+
 class testExternalObject( object ):
   TSCRIPT_NAME = 'test_obj'
 
@@ -246,6 +256,8 @@ def test_map():
 
 
 def test_module_values():  # TODO: add pickling testing
+  runner_plugins_test.set_otherstuff( None )  # left over from the last tscript_compile run
+
   runner = Runner( parse( 'asdf = testing.bigstuff' ) )
   runner.registerModule( 'contractor.tscript.runner_plugins_test' )
   assert runner.variable_map == {}
@@ -725,6 +737,162 @@ def test_message():
   assert runner.done
 
 
+class Signaler():
+  TSCRIPT_NAME = 'signaler'
+
+  def __init__( self ):
+    self.complete = False
+
+  def getValues( self ):
+    return {}
+
+  def getFunctions( self ):
+    return { 'wait': lambda: self.wait }
+
+  def wait( self ):
+    if not self.complete:
+      raise WaitForSignal( 'Waiting' )
+
+
+def test_wake_hint():
+  runner = Runner( parse( 'testing.constant()' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  assert runner.wakeHint() == ( '', None )
+  runner.run()
+  assert runner.done
+  assert runner.wakeHint() == ( '', None )
+
+  runner = Runner( parse( 'delay( seconds=30 )' ) )
+  start = datetime.now( timezone.utc )
+  assert runner.run() == 'Waiting for 29 more seconds'
+  ( waiting_on, wake_at ) = runner.wakeHint()
+  assert waiting_on == ''
+  assert start + timedelta( seconds=29 ) < wake_at < start + timedelta( seconds=31 )
+
+  runner = Runner( parse( 'begin( max_time=0:10 )\ndelay( minutes=1 )\nend' ) )
+  start = datetime.now( timezone.utc )
+  runner.run()
+  ( waiting_on, wake_at ) = runner.wakeHint()
+  assert waiting_on == ''
+  assert start + timedelta( seconds=9 ) < wake_at < start + timedelta( seconds=11 )
+
+  runner = Runner( parse( 'testing.count( count_by=1, stop_at=2 )' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  runner.run()
+  assert runner.wakeHint() == ( '', None )
+
+  runner = Runner( parse( 'testing.remote()' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  runner.run()
+  assert runner.wakeHint() == ( '', None )
+  assert runner.toSubcontractor( [ 'nothing' ] ) is None
+  assert runner.wakeHint() == ( '', None )
+  start = datetime.now( timezone.utc )
+  assert runner.toSubcontractor( [ 'testing' ] ) is not None
+  ( waiting_on, wake_at ) = runner.wakeHint()
+  assert waiting_on == 'dispatch'
+  assert start + timedelta( seconds=DISPATCH_LEASE_DEFAULT ) <= wake_at < start + timedelta( seconds=DISPATCH_LEASE_DEFAULT + 1 )  # the dispatch lease
+  runner.fromSubcontractor( runner.contractor_cookie, 'stuff' )
+  assert runner.wakeHint() == ( '', None )
+
+  runner = Runner( parse( 'testing.remote_polling()' ) )  # opted out, it is run every time
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  runner.run()
+  assert runner.toSubcontractor( [ 'testing' ] ) is not None
+  assert runner.wakeHint() == ( '', None )
+
+  runner = Runner( parse( 'begin( max_time=0:10 )\ntesting.remote()\nend' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  start = datetime.now( timezone.utc )
+  runner.run()
+  runner.toSubcontractor( [ 'testing' ] )
+  ( waiting_on, wake_at ) = runner.wakeHint()
+  assert waiting_on == 'dispatch'
+  assert start + timedelta( seconds=9 ) < wake_at < start + timedelta( seconds=11 )
+
+  signaler = Signaler()
+  runner = Runner( parse( 'signaler.wait()' ) )
+  runner.registerObject( signaler )
+  assert runner.run() == 'Waiting'
+  assert runner.wakeHint() == ( 'signal', None )
+  signaler.complete = True
+  runner.run()
+  assert runner.done
+  assert runner.wakeHint() == ( '', None )
+
+  runner = Runner( parse( 'message( msg="Hello World" )' ) )
+  assert runner.run() == 'Hello World'
+  assert runner.wakeHint() == ( '', None )
+
+
+def test_wake_hint_error( mocker, caplog ):
+  def _broken( self ):
+    raise ValueError( 'broken' )
+
+  runner = Runner( parse( 'testing.remote()' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  runner.run()
+  mocker.patch.object( runner_plugins_test.Remote, 'wake_at', new=property( _broken ) )
+  assert runner.wakeHint() == ( '', None )
+  assert 'error getting "wake_at"' in caplog.text
+
+  runner.toSubcontractor( [ 'testing' ] )
+  mocker.patch.object( runner_plugins_test.Remote, 'wake_hint', new=property( _broken ) )
+  caplog.clear()
+  assert runner.wakeHint()[0] == 'dispatch'  # the error is logged, and the job still waits on the dispatch
+  assert 'error getting "wake_hint"' in caplog.text
+
+
+def test_dispatch_lease( settings ):
+  runner = Runner( parse( 'testing.remote()' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  assert runner.dispatchExpired() is False
+  runner.run()
+  assert runner.dispatchExpired() is False
+  task = runner.toSubcontractor( [ 'testing' ] )
+  assert task[ 'paramaters' ] == 'the count "1"'
+  old_cookie = task[ 'cookie' ]
+  assert runner.dispatchExpired() is False
+  assert runner.toSubcontractor( [ 'testing' ] ) is None
+
+  runner.state[ -1 ][1][ 'dispatched_at' ] -= timedelta( seconds=DISPATCH_LEASE_DEFAULT + 1 )
+  assert runner.dispatchExpired() is True
+  ( waiting_on, wake_at ) = runner.wakeHint()
+  assert waiting_on == 'dispatch'
+  assert wake_at < datetime.now( timezone.utc )
+  assert runner.run() == 'Not Initilized'
+  task = runner.toSubcontractor( [ 'testing' ] )
+  assert task[ 'paramaters' ] == 'the count "2"'
+  assert task[ 'cookie' ] != old_cookie
+  assert task[ 'cookie' ] == runner.contractor_cookie
+  assert runner.dispatchExpired() is False
+  assert runner.state[ -1 ][1][ 'redispatch_count' ] == 1
+  assert runner.fromSubcontractor( old_cookie, True ) == ( 'Bad Cookie', None )
+  assert runner.fromSubcontractor( task[ 'cookie' ], True ) == ( 'Accepted', 'Current State "True"' )
+  assert runner.dispatchExpired() is False
+  runner.run()
+  assert runner.done
+
+  settings.DISPATCH_LEASE_MAP = { 'testing': 10 }
+  runner = Runner( parse( 'testing.remote()' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  runner.run()
+  start = datetime.now( timezone.utc )
+  runner.toSubcontractor( [ 'testing' ] )
+  ( waiting_on, wake_at ) = runner.wakeHint()
+  assert start + timedelta( seconds=10 ) <= wake_at < start + timedelta( seconds=11 )
+  runner.state[ -1 ][1][ 'dispatched_at' ] -= timedelta( seconds=11 )
+  assert runner.dispatchExpired() is True
+
+  runner = pickle.loads( pickle.dumps( runner ) )
+  assert runner.dispatchExpired() is True
+
+  del runner.state[ -1 ][1][ 'dispatched_at' ]  # dispatched before there were leases
+  assert runner.dispatchExpired() is False
+  assert runner.wakeHint() == ( 'dispatch', None )
+  assert runner.toSubcontractor( [ 'testing' ] ) is None
+
+
 def test_object_functions():  # TODO: this and pickleing too
   pass
 
@@ -952,6 +1120,188 @@ def test_serilizer():
   assert runner2.done
 
 
+def test_state_version():
+  ast = parse( 'start = 1\nbegin( max_time=1:00 )\n  value = testing.count( stop_at=2, count_by=1 )\nend' )
+  runner = Runner( ast )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  runner.run()
+  assert not runner.done
+
+  state_list = runner.dumpState()
+  assert [ i[0] for i in state_list ] == [ 'S', 'L', 'S', 'L', 'A', 'F' ]
+  assert len( state_list[2] ) == 4  # the max_time
+  assert isinstance( runner.state[2], ScopeFrame )
+  assert isinstance( runner.state[5], ValueFrame )
+  assert runner.state == state_list
+  assert runner.state[5][1][ 'paramaters' ] == { 'stop_at': 2, 'count_by': 1 }
+
+  state = runner.__getstate__()
+  assert state[0] == STATE_VERSION
+  assert state[3] == [ tuple( i ) for i in state_list ]
+
+  # version 1, the state as lists in a dict
+  old_state = { 'module_list': runner.module_list, 'object_list': runner.object_list, 'state': state_list, 'variable_map': runner.variable_map, 'cur_line': runner.cur_line, 'contractor_cookie': runner.contractor_cookie }
+  assert len( pickle.dumps( state ) ) < len( pickle.dumps( old_state ) )
+
+  runner2 = Runner( ast )
+  runner2.__setstate__( pickle.loads( pickle.dumps( old_state ) ) )
+  assert runner2.dumpState()[ :5 ] == state_list[ :5 ]
+  assert runner2.dumpState()[5][1][ 'paramaters' ] == state_list[5][1][ 'paramaters' ]  # the handler is a copy
+  assert runner2.wakeHint() == runner.wakeHint()
+  assert runner2.status == runner.status
+  runner2.run()
+  runner2.run()
+  assert runner2.done
+  assert runner2.variable_map == { 'start': 1, 'value': None }
+  assert runner2.dumpState() == 'DONE'
+  assert runner2.__getstate__()[3] == 'DONE'
+
+  runner2 = Runner( ast )
+  runner2.__setstate__( pickle.loads( pickle.dumps( state ) ) )
+  assert runner2.dumpState()[ :5 ] == state_list[ :5 ]
+  runner2.run()
+  runner2.run()
+  assert runner2.done
+
+  with pytest.raises( ValueError ):
+    Runner( ast ).__setstate__( ( STATE_VERSION + 1, ) + state[ 1: ] )
+
+
+def test_compile_cache_threads():
+  ast_list = [ parse( 'aa = {0}'.format( i ) ) for i in range( 0, COMPILE_CACHE_SIZE + 10 ) ]
+  error_list = []
+
+  def _worker( offset ):
+    try:
+      for i in range( 0, 2000 ):
+        ast = ast_list[ ( i * 7 + offset ) % len( ast_list ) ]
+        assert compileAST( ast ) == ast
+
+    except Exception as e:
+      error_list.append( e )
+
+  thread_list = [ threading.Thread( target=_worker, args=( i, ) ) for i in range( 0, 8 ) ]
+  for thread in thread_list:
+    thread.start()
+
+  for thread in thread_list:
+    thread.join()
+
+  assert error_list == []
+
+
+def test_compiled_resume():  # the compiled and interpreted runners have the same state, so a job can switch between them
+  script = 'cnt = 0\nwhile ( cnt < 3 ) do\nbegin()\n  cnt = ( cnt + 1 )\n  value = testing.remote()\nend\ndone = ( cnt * 10 )'
+  ast = parse( script )
+
+  compiled = compileAST( ast )
+  assert compiled == ast
+  assert compileAST( ast ) is compiled
+  assert type( pickle.loads( pickle.dumps( compiled ) ) ) is tuple
+
+  other = copy.deepcopy( ast )  # the cache is by identity, an equal ast is compiled on it's own
+  assert other == ast and other is not ast
+  assert compileAST( other ) is not compiled
+  assert compileAST( other ) == compiled
+
+  def _step( runner ):
+    result = runner.run()
+    task = runner.toSubcontractor( [ 'testing' ] )
+    if task is not None:
+      runner.fromSubcontractor( runner.contractor_cookie, 'ok' )
+
+    return ( result, runner.line, runner.status, runner.state if runner.done else len( runner.state ) )
+
+  reference = Runner( ast, compiled=False )
+  reference.registerModule( 'contractor.tscript.runner_plugins_test' )
+  reference_list = []
+  while not reference.done:
+    reference_list.append( _step( reference ) )
+
+  assert reference.variable_map == { 'cnt': 3, 'value': 'ok', 'done': 30 }
+
+  for compiled in ( True, False ):
+    runner = Runner( ast, compiled=compiled )
+    runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+    step_list = []
+    while not runner.done:
+      step_list.append( _step( runner ) )
+      state = runner.__getstate__()
+      runner = Runner( ast, compiled=not runner.compiled )  # resume with the other one
+      runner.__setstate__( pickle.loads( pickle.dumps( state ) ) )
+
+    assert step_list == reference_list
+    assert runner.variable_map == reference.variable_map
+
+
+def test_tracer():
+  runner = Runner( parse( 'aa = ( 1 + 2 )\nbb = len( array=[1,2] )' ) )
+  assert runner.tracer is None
+  assert runner.__getstate__()[7] is None
+  runner.run()
+  assert runner.done
+
+  runner = Runner( parse( 'aa = ( 1 + 2 )\nbb = len( array=[1,2] )' ) )
+  runner.tracer = Tracer()
+  runner.run()
+  assert runner.done
+  assert runner.variable_map == { 'aa': 3, 'bb': 2 }
+  entry_list = runner.tracer.entries
+  assert [ entry[1:5] for entry in entry_list if entry[1] == 'enter' ] == [ [ 'enter', 0, 0, 'S' ], [ 'enter', 1, 1, 'L' ], [ 'enter', 1, 2, 'A' ], [ 'enter', 1, 3, 'X' ], [ 'enter', 1, 4, 'C' ], [ 'enter', 1, 4, 'C' ],
+                                                                            [ 'enter', 2, 1, 'L' ], [ 'enter', 2, 2, 'A' ], [ 'enter', 2, 3, 'F' ], [ 'enter', 2, 4, 'Y' ], [ 'enter', 2, 5, 'C' ], [ 'enter', 2, 5, 'C' ] ]
+  assert [ entry[1:] for entry in entry_list if entry[1] == 'call' ] == [ [ 'call', 2, '<builtin>', 'len' ] ]
+  leave_list = [ entry for entry in entry_list if entry[1] == 'leave' ]
+  assert len( leave_list ) == 12
+  assert leave_list[-1][1:5] == [ 'leave', 2, 0, 'S' ]
+  assert leave_list[-1][5] >= 0.0
+  assert leave_list[-1][6] is None
+
+  runner = pickle.loads( pickle.dumps( runner ) )
+  assert runner.tracer.entries == entry_list
+
+  tracer = Tracer( size=5 )
+  for i in range( 0, 10 ):
+    tracer.call( i, 'mod', 'func' )
+  assert [ entry[2] for entry in tracer.entries ] == [ 5, 6, 7, 8, 9 ]
+  tracer = pickle.loads( pickle.dumps( tracer ) )
+  assert [ entry[2] for entry in tracer.entries ] == [ 5, 6, 7, 8, 9 ]
+  tracer.call( 10, 'mod', 'func' )
+  assert [ entry[2] for entry in tracer.entries ] == [ 6, 7, 8, 9, 10 ]
+
+  runner = Runner( parse( 'while True do 1' ) )  # interrupted nodes are left with the exception
+  runner.tracer = Tracer()
+  with pytest.raises( Timeout ):
+    runner.run( 3 )
+  assert [ entry[6] for entry in runner.tracer.entries if entry[1] == 'leave' ][-1] == 'Timeout'
+
+
+def test_profile():
+  runner = Runner( parse( 'cnt = 0\nwhile ( cnt < 3 ) do cnt = ( cnt + 1 )\nvalue = testing.remote()' ) )
+  runner.registerModule( 'contractor.tscript.runner_plugins_test' )
+  assert runner.profile is None
+  runner.profile = Profile()
+  assert runner.profile.lines == []
+
+  assert runner.run() == 'Not Initilized'
+  assert runner.toSubcontractor( [ 'testing' ] ) is not None
+  assert [ ( i[ 'line' ], i[ 'ops' ], i[ 'resumptions' ] ) for i in runner.profile.lines ] == [ ( 0, 1, 0 ), ( 1, 3, 0 ), ( 2, 26, 0 ), ( 3, 3, 0 ) ]
+
+  runner = pickle.loads( pickle.dumps( runner ) )
+  assert runner.fromSubcontractor( runner.contractor_cookie, 'ok' ) == ( 'Accepted', 'Current State "ok"' )
+  runner.run()
+  assert runner.done
+  assert runner.variable_map == { 'cnt': 3, 'value': 'ok' }
+
+  line_list = runner.profile.lines
+  assert [ ( i[ 'line' ], i[ 'ops' ], i[ 'resumptions' ] ) for i in line_list ] == [ ( 0, 1, 0 ), ( 1, 3, 0 ), ( 2, 26, 0 ), ( 3, 7, 1 ) ]  # the resumed run starts from the top of the stack
+  assert [ i[ 'dispatch_seconds' ] > 0.0 for i in line_list ] == [ False, False, False, True ]
+  assert [ i[ 'seconds' ] >= 0.0 for i in line_list ] == [ True, True, True, True ]
+  assert line_list[2][ 'seconds' ] > 0.0
+
+  runner.run()  # done, nothing changes
+  assert runner.profile.lines == line_list
+
+
 def test_while():
   # first we will test the ttl
   runner = Runner( parse( 'while True do 1' ) )